@@ -0,0 +1,191 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from load_data import Batch
+
+# How each label of a raw mini-batch follows the flip and crop of the images
+NEAREST_LABELS = ['mask', 'canny']
+BILINEAR_LABELS = ['ab', 'denoised']
+BOX_LABELS = ['bbox']
+# Labels in the colour space of the images, which get the same colour jitter
+JITTERED_LABELS = ['denoised']
+
+
+class BatchAugment:
+    """
+    Random horizontal flips, crops rescaled back to the image size and colour jitter, applied to a
+    whole raw mini-batch (load_data.Batch) on its device before it is normalised.
+
+    The flip and crop of every sample are folded into one affine sampling grid, so the images and
+    each dense label are resampled with a single grid_sample call (nearest for the masks and canny
+    edge maps, bilinear for the ab channels and clean images) and the bounding boxes are moved with
+    the same transform. The colour jitter is applied to the images and to the clean images of the
+    denoising models. Labels the engine does not know (ie: 'classification', 'index') are unchanged.
+
+    Bounding boxes are read as pixel coordinates, (x_min, y_min, x_max, y_max) or (x_min, y_min,
+    width, height) depending on box_format. A crop that misses the object
+    clips its box to an empty box on the border of the crop.
+    """
+
+    def __init__(self, flip=0.5, crop_scale=(0.7, 1.0), brightness=0.2, contrast=0.2, saturation=0.2,
+                 box_format='xyxy', seed=0):
+        """
+        @params:
+        flip(float): Probability of a horizontal flip
+        crop_scale(tuple): Range of the side of the crop, as a fraction of the image side
+        brightness(float): Brightness factors are drawn from [1 - brightness, 1 + brightness]
+        contrast(float): Contrast factors are drawn from [1 - contrast, 1 + contrast]
+        saturation(float): Saturation factors are drawn from [1 - saturation, 1 + saturation], RGB images only
+        box_format(string): Layout of the bounding boxes, 'xyxy' or 'xywh'
+        seed(int): Seed of the transforms, drawn for every mini-batch from (seed, epoch, batch), see set_epoch
+        """
+        if box_format not in ('xyxy', 'xywh'):
+            raise ValueError(f"box_format must be 'xyxy' or 'xywh', got {box_format}")
+        self.flip = flip
+        self.crop_scale = crop_scale
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.box_format = box_format
+        self.seed = seed
+        self.generator = torch.Generator()
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch, start_batch=0):
+        """Sets the epoch of the next mini-batches, the first of which is batch start_batch of that epoch.
+
+        The transforms of every mini-batch are drawn from (seed, epoch, batch), so a run resumed part way
+        through an epoch augments the remaining mini-batches as the uninterrupted run did.
+        """
+        self.epoch = epoch
+        self.batch = start_batch
+
+    def reseed(self):
+        """Seeds the generator for the next mini-batch from (seed, epoch, batch) and moves on to the next batch."""
+        state = np.random.SeedSequence([self.seed, self.epoch, self.batch]).generate_state(1)[0]
+        self.generator.manual_seed(int(state))
+        self.batch += 1
+
+    def uniform(self, n_samples, low, high):
+        """Returns n_samples values drawn from [low, high) with the generator of the augmentation."""
+        return low + (high - low) * torch.rand(n_samples, generator=self.generator)
+
+    @torch.no_grad()
+    def __call__(self, batch):
+        """A function for augmenting a raw mini-batch and its labels with the same random transforms.
+
+        Args:
+            batch (Batch): Mini-batch on the compute device, as returned by the data loaders. Its images are
+            of shape (batch, height, width, channels) with values 0-255 (RGB images, noisy images or L channels).
+
+        Returns:
+            batch (Batch): A new mini-batch with the augmented images and labels, of the same dtypes.
+        """
+        self.reseed()
+        images = batch.image
+        n_samples, height, width, channels = images.shape
+        device = images.device
+
+        # Sampling coordinates in [-1, 1]: source = scale * sign * output + shift
+        scale = self.uniform(n_samples, *self.crop_scale)
+        sign = torch.where(torch.rand(n_samples, generator=self.generator) < self.flip, -1.0, 1.0)
+        shift_x = (1 - scale) * self.uniform(n_samples, -1, 1)
+        shift_y = (1 - scale) * self.uniform(n_samples, -1, 1)
+        theta = torch.zeros(n_samples, 2, 3)
+        theta[:, 0, 0] = scale * sign
+        theta[:, 0, 2] = shift_x
+        theta[:, 1, 1] = scale
+        theta[:, 1, 2] = shift_y
+        grid = F.affine_grid(theta.to(device), [n_samples, 1, height, width], align_corners=False)
+        factors = [self.uniform(n_samples, 1 - amount, 1 + amount).view(-1, 1, 1, 1).to(device)
+                   for amount in (self.brightness, self.contrast, self.saturation)]
+
+        fields = batch.fields()
+        fields['image'] = cast(jitter(resample(images, grid, 'bilinear'), *factors), images.dtype)
+        for label, target in fields.items():
+            if label in NEAREST_LABELS:
+                fields[label] = cast(resample(target, grid, 'nearest'), target.dtype)
+            elif label in BILINEAR_LABELS:
+                augmented = resample(target, grid, 'bilinear')
+                if label in JITTERED_LABELS:
+                    augmented = jitter(augmented, *factors)
+                fields[label] = cast(augmented, target.dtype)
+            elif label in BOX_LABELS:
+                fields[label] = self.move_boxes(target, scale, sign, shift_x, shift_y, width, height)
+        return Batch(**fields)
+
+    def move_boxes(self, boxes, scale, sign, shift_x, shift_y, width, height):
+        """A function for moving the bounding boxes of a mini-batch with the flip and crop of their images.
+
+        Args:
+            boxes (tensor): float32 boxes of shape (batch, 4), in pixels.
+            scale, sign, shift_x, shift_y (tensor): Transform of every sample, see __call__.
+            width, height (int): Size of the images.
+
+        Returns:
+            boxes (tensor): float32 boxes in the augmented images, clipped to them.
+        """
+        scale, sign, shift_x, shift_y = [value.to(boxes.device).view(-1, 1)
+                                          for value in (scale, sign, shift_x, shift_y)]
+        x_min, y_min, x_max, y_max = boxes.unbind(dim=1)
+        if self.box_format == 'xywh':
+            x_max, y_max = x_min + x_max, y_min + y_max
+
+        # Pixel edges to [-1, 1], through the inverse of the sampling transform and back to pixels
+        xs = (torch.stack([x_min, x_max], dim=1) / width * 2 - 1 - shift_x) / (scale * sign)
+        ys = (torch.stack([y_min, y_max], dim=1) / height * 2 - 1 - shift_y) / scale
+        xs = ((xs + 1) / 2 * width).clamp(0, width)
+        ys = ((ys + 1) / 2 * height).clamp(0, height)
+        x_min, x_max = xs.min(dim=1).values, xs.max(dim=1).values
+        y_min, y_max = ys.min(dim=1).values, ys.max(dim=1).values
+
+        if self.box_format == 'xywh':
+            x_max, y_max = x_max - x_min, y_max - y_min
+        return torch.stack([x_min, y_min, x_max, y_max], dim=1)
+
+
+def resample(batch, grid, mode):
+    """A function for sampling a channel last mini-batch at the points of an affine grid.
+
+    Args:
+        batch (tensor): Tensor of shape (batch, height, width, channels) or (batch, height, width).
+        grid (tensor): Sampling grid of shape (batch, height, width, 2), see torch.nn.functional.affine_grid.
+        mode (string): 'bilinear' for images, 'nearest' for label maps.
+
+    Returns:
+        resampled (tensor): float32 tensor of the same shape as batch.
+    """
+    values = batch.unsqueeze(1) if batch.dim() == 3 else batch.permute(0, 3, 1, 2)
+    resampled = F.grid_sample(values.float(), grid, mode=mode, padding_mode='border', align_corners=False)
+    if batch.dim() == 3:
+        return resampled.squeeze(1)
+    return resampled.permute(0, 2, 3, 1)
+
+
+def jitter(images, brightness, contrast, saturation):
+    """A function for changing the brightness, contrast and saturation of a mini-batch of images.
+
+    Args:
+        images (tensor): float32 images of shape (batch, height, width, channels), values 0-255.
+        brightness, contrast, saturation (tensor): Factors of every sample, of shape (batch, 1, 1, 1).
+        The saturation only applies to RGB images.
+
+    Returns:
+        images (tensor): float32 images of the same shape, clipped to 0-255.
+    """
+    images = images * brightness
+    if images.shape[-1] == 3:
+        gray = images[..., 0:1] * 0.299 + images[..., 1:2] * 0.587 + images[..., 2:3] * 0.114
+        images = gray + (images - gray) * saturation
+    else:
+        gray = images.mean(dim=-1, keepdim=True)
+    mean = gray.mean(dim=(1, 2), keepdim=True)
+    images = (images - mean) * contrast + mean
+    return images.clamp(0, 255)
+
+
+def cast(values, dtype):
+    """Returns float32 values cast back to dtype, rounded first for integer types."""
+    if not dtype.is_floating_point:
+        values = values.round()
+    return values.to(dtype)
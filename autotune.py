@@ -0,0 +1,246 @@
+import os
+import gc
+import json
+import time
+import socket
+import itertools
+import multiprocessing
+from datetime import datetime
+import torch
+import model_utils
+import load_data
+from load_data import normalise_batch
+from mmap_cache import MANIFEST
+
+# Loader configurations tried, per storage of the split
+PREFETCH_FACTORS = [2, 4]
+STORAGES = ['h5', 'preload', 'mmap']
+AUTOTUNE_FILE = 'autotune.json'
+
+
+def process_memory(pid='self'):
+    """A function for measuring the memory of a process, counting the pages it shares in proportion.
+
+    Shared pages (ie: a preloaded split mapped by every worker) are split between the processes mapping
+    them, so the memory of a process and its workers can be summed. Only available on Linux.
+
+    Args:
+        pid (int or string, optional): Process id. Defaults to 'self'.
+
+    Returns:
+        memory (int): Proportional set size of the process in bytes, 0 when it cannot be read.
+    """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as file:
+            for line in file:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def worker_candidates():
+    """Returns the numbers of DataLoader workers tried, 0 and then powers of 2 up to the usable cpu cores."""
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    return [0] + [2 ** power for power in range(cores.bit_length()) if 2 ** power <= cores]
+
+
+def train_step(model, optimizer, inputs):
+    """Runs one forward and backward pass of model, with the mean of every output standing in for the loss."""
+    optimizer.zero_grad()
+    outputs = model(inputs)
+    outputs = outputs if isinstance(outputs, (list, tuple)) else [outputs]
+    loss = sum(output.float().mean() for output in outputs if torch.is_tensor(output))
+    loss.backward()
+    optimizer.step()
+
+
+def synchronize(device):
+    """Waits for the queued kernels of device, so that they are timed."""
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize(device)
+
+
+def time_steps(model_type, data_path, batch_sizes, device, providers=None, n_steps=5):
+    """A function for timing a training step of model_type at every batch size.
+
+    A separate copy of the model is trained on the first mini-batch of the split, so the model that
+    is trained afterwards is not touched. Batch sizes that run out of memory are skipped.
+
+    Args:
+        model_type (string): The model type.
+        data_path (path): Split the mini-batches are read from (ie: 'data/train/').
+        batch_sizes (list): Batch sizes to time.
+        device (string): The device the model is trained on (cpu or cuda).
+        providers (list, optional): TargetProvider objects of the model type. Defaults to the images, masks,
+        bounding boxes and classes.
+        n_steps (int, optional): Steps timed per batch size, after one warm up step. Defaults to 5.
+
+    Returns:
+        step_seconds (dict): Seconds per training step of every batch size that fits.
+    """
+    model, optimizer, _ = model_utils.get_model(model_type=model_type, device=device)
+    model.train()
+    step_seconds = {}
+    for batch_size in sorted(batch_sizes):
+        data_loader = load_data.build_data_loader(data_path, batch_size=batch_size, shuffle=False, providers=providers,
+                                                  exclude=False)
+        inputs = normalise_batch(next(iter(data_loader)).image.to(device))
+        try:
+            train_step(model, optimizer, inputs)
+            synchronize(device)
+            start = time.perf_counter()
+            for _ in range(n_steps):
+                train_step(model, optimizer, inputs)
+            synchronize(device)
+        except torch.cuda.OutOfMemoryError:
+            print(f'autotune: batch size {batch_size} does not fit on {device}')
+            break
+        step_seconds[batch_size] = (time.perf_counter() - start) / n_steps
+        print(f'autotune: batch size {batch_size}, {step_seconds[batch_size] * 1000:.1f} ms per step, '
+              f'{batch_size / step_seconds[batch_size]:.1f} samples/s')
+    del model, optimizer
+    if str(device).startswith('cuda'):
+        torch.cuda.empty_cache()
+    return step_seconds
+
+
+def choose_batch_size(step_seconds, tolerance=0.9):
+    """Returns the smallest batch size training at least tolerance times as many samples per second as the best."""
+    throughput = {batch_size: batch_size / seconds for batch_size, seconds in step_seconds.items()}
+    best = max(throughput.values())
+    return min(batch_size for batch_size, samples in throughput.items() if samples >= tolerance * best)
+
+
+def time_loader(data_path, batch_size, num_workers, prefetch_factor, storage, providers=None, n_batches=10):
+    """A function for measuring how fast a loader configuration delivers mini-batches, and its memory.
+
+    The first mini-batch, which waits for the workers to start, is not timed. The memory is that
+    of the main process gained while the loader was built and read, plus that of its workers.
+
+    Args:
+        data_path (path): Split the mini-batches are read from (ie: 'data/train/').
+        batch_size (int): Size of the mini-batches.
+        num_workers (int): Number of DataLoader worker processes.
+        prefetch_factor (int): Batches loaded in advance by each worker.
+        storage (string): 'h5', 'preload' or 'mmap', see load_data.build_data_loader.
+        providers (list, optional): TargetProvider objects of the model type. Defaults to None.
+        n_batches (int, optional): Mini-batches timed, the split is read again if it holds fewer. Defaults to 10.
+
+    Returns:
+        load_seconds (float), memory (int): Seconds per mini-batch and bytes of memory.
+    """
+    gc.collect()
+    workers_before = set(multiprocessing.active_children())
+    memory_before = process_memory()
+    data_loader = load_data.build_data_loader(data_path, batch_size=batch_size, num_workers=num_workers,
+                                              prefetch_factor=prefetch_factor, preload=storage == 'preload',
+                                              mmap=storage == 'mmap', providers=providers, exclude=False)
+    batches = itertools.chain.from_iterable(data_loader for _ in itertools.count())
+    next(batches)
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        next(batches)
+    load_seconds = (time.perf_counter() - start) / n_batches
+
+    workers = set(multiprocessing.active_children()) - workers_before
+    memory = process_memory() - memory_before + sum(process_memory(worker.pid) for worker in workers)
+    del batches, data_loader
+    gc.collect()
+    return load_seconds, max(0, memory)
+
+
+def tune_loader(data_path, model_type, device, providers=None, batch_sizes=(4, 8, 16, 32), headroom=1.1,
+                n_batches=10):
+    """A function for choosing the batch size, workers, prefetch factor and storage that keep model_type fed.
+
+    A training step of model_type is timed at every batch size, and the smallest batch size close to
+    the best throughput is kept (see choose_batch_size). At that batch size, for every storage, the
+    number of workers and the prefetch factor are raised until the loader delivers a mini-batch headroom
+    times faster than a step. Of the configurations that keep up, the one using the least memory is
+    chosen, otherwise the fastest one.
+
+    Args:
+        data_path (path): Training split (ie: 'data/train/').
+        model_type (string): The model type.
+        device (string): The device the model is trained on (cpu or cuda).
+        providers (list, optional): TargetProvider objects of the model type. Defaults to None.
+        batch_sizes (tuple, optional): Batch sizes tried. Defaults to (4, 8, 16, 32).
+        headroom (float, optional): How much faster than a step a mini-batch must load. Defaults to 1.1.
+        n_batches (int, optional): Mini-batches timed per loader configuration. Defaults to 10.
+
+    Returns:
+        config (dict): batch_size, num_workers, prefetch_factor, preload and mmap, with the measurements.
+    """
+    step_seconds = time_steps(model_type, data_path, batch_sizes, device, providers=providers)
+    if not step_seconds:
+        raise RuntimeError(f'autotune: none of the batch sizes {list(batch_sizes)} fit on {device}')
+    batch_size = choose_batch_size(step_seconds)
+    storages = [storage for storage in STORAGES
+                if storage != 'mmap' or os.path.isfile(os.path.join(data_path, 'mmap', MANIFEST))]
+
+    results = []
+    for storage in storages:
+        for num_workers in worker_candidates():
+            for prefetch_factor in PREFETCH_FACTORS if num_workers else PREFETCH_FACTORS[:1]:
+                load_seconds, memory = time_loader(data_path, batch_size, num_workers, prefetch_factor, storage,
+                                                   providers=providers, n_batches=n_batches)
+                fed = load_seconds * headroom <= step_seconds[batch_size]
+                results.append({'batch_size': batch_size, 'num_workers': num_workers,
+                                'prefetch_factor': prefetch_factor, 'preload': storage == 'preload',
+                                'mmap': storage == 'mmap', 'step_seconds': step_seconds[batch_size],
+                                'load_seconds': load_seconds, 'memory_mb': memory / 2 ** 20, 'fed': fed})
+                print(f'autotune: {storage}, {num_workers} workers, prefetch factor {prefetch_factor}: '
+                      f'{load_seconds * 1000:.1f} ms per mini-batch, {memory / 2 ** 20:.1f} MB'
+                      f'{", keeps up" if fed else ""}')
+                if fed:
+                    break
+            # More workers would only use more memory
+            if results[-1]['fed']:
+                break
+
+    fed = [result for result in results if result['fed']]
+    if fed:
+        return min(fed, key=lambda result: result['memory_mb'])
+    print(f'autotune: no loader keeps up with {model_type} on {device}, choosing the fastest one')
+    return min(results, key=lambda result: result['load_seconds'])
+
+
+def autotune(data_path, model_type, device, providers=None, batch_sizes=(4, 8, 16, 32), cache_path=AUTOTUNE_FILE,
+             force=False):
+    """A function for looking up the tuned loader configuration of this host, tuning it when there is none.
+
+    The choices are kept in the JSON file cache_path under the host name, the model type, the device
+    and the training split, so a folder shared between hosts keeps one choice per host.
+
+    Args:
+        data_path (path): Training split (ie: 'data/train/').
+        model_type (string): The model type.
+        device (string): The device the model is trained on (cpu or cuda).
+        providers (list, optional): TargetProvider objects of the model type. Defaults to None.
+        batch_sizes (tuple, optional): Batch sizes tried. Defaults to (4, 8, 16, 32).
+        cache_path (path, optional): JSON file holding the choices. Defaults to AUTOTUNE_FILE.
+        force (bool, optional): Tune again even if a choice was cached. Defaults to False.
+
+    Returns:
+        config (dict): batch_size, num_workers, prefetch_factor, preload and mmap, see tune_loader.
+    """
+    host = socket.gethostname()
+    key = f'{model_type}:{device}:{os.path.realpath(data_path)}'
+    choices = {}
+    if os.path.isfile(cache_path):
+        with open(cache_path) as file:
+            choices = json.load(file)
+    if not force and key in choices.get(host, {}):
+        print(f'autotune: using the choice cached in {cache_path} on {choices[host][key]["tuned"]}')
+        return choices[host][key]
+
+    config = tune_loader(data_path, model_type, device, providers=providers, batch_sizes=batch_sizes)
+    config['tuned'] = datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
+    choices.setdefault(host, {})[key] = config
+    partial_path = f'{cache_path}.{os.getpid()}.partial'
+    with open(partial_path, 'w') as file:
+        json.dump(choices, file, indent=2)
+    os.replace(partial_path, cache_path)
+    return config
@@ -7,8 +7,51 @@ import train_color
 import train_canny
 import train_denoising
 import denoising_loader
+import shard_loader
 import data_loader_canny
+from target_cache import TargetCache
+from augment import BatchAugment
+import autotune
 import argparse
+import os
+
+# Model types trained with an extra target on top of the masks, bounding boxes and classes
+COLORIZATION_MODELS = ['MTL-segnet-with-colorization', 'MTL-Attention-with-colorization']
+DENOISING_MODELS = ['MTL-Attention-with-denoising']
+CANNY_MODELS = ['MTL-Attention-with-canny', 'MTL-segnet-with-canny']
+
+
+def target_providers(model_type, cache=None):
+    """A function used to select the fields read by the data loaders for a model type.
+    Files the model and its loss do not use are never opened.
+
+    Args:
+        model_type (str): Name of the model defined in the cw2_main.py.
+        cache (TargetCache, optional): Memoise the Lab images, noisy images or canny edge maps in this cache
+        instead of computing them per batch on the device. Defaults to None.
+
+    Returns:
+        providers (list): load_data.TargetProvider objects for the input and the targets.
+    """
+    if model_type in COLORIZATION_MODELS:
+        return lab_loader.lab_providers(cache)
+    if cache is not None and model_type in DENOISING_MODELS:
+        return denoising_loader.noisy_providers(cache)
+    if cache is not None and model_type in CANNY_MODELS:
+        return data_loader_canny.canny_providers(opencv_filters=True, cache=cache)
+    if model_type in DENOISING_MODELS:
+        # The noisy inputs are generated per batch on the device (see denoising_loader.OnlineNoise)
+        return denoising_loader.ONLINE_NOISE_PROVIDERS
+    if model_type in CANNY_MODELS:
+        # The canny edge maps are computed per batch on the device (see train_canny.prepare_batch)
+        return load_data.DEFAULT_PROVIDERS
+    if model_type in ['Segnet-1task-no-pretrained', 'Segnet-1task']:
+        return [load_data.IMAGE, load_data.MASK]
+    if model_type == 'MTL-Attention-without-bbox':
+        return [load_data.IMAGE, load_data.MASK, load_data.CLASSIFICATION]
+    if model_type == 'MTL-Attention-without-classification':
+        return [load_data.IMAGE, load_data.MASK, load_data.BBOX]
+    return load_data.DEFAULT_PROVIDERS
 
 
 def run_cw2(args, train=True, test=False, visualize=False):
@@ -17,48 +60,80 @@ def run_cw2(args, train=True, test=False, visualize=False):
     ###############################
     # Load data
     ###############################
-    train_path = 'data/train/'
-    validation_path = 'data/val/'
-    test_path = 'data/test/'
+    train_path = os.path.join(args.data_path, 'train/')
+    validation_path = os.path.join(args.data_path, 'val/')
+    test_path = os.path.join(args.data_path, 'test/')
     batch_size = int(args.batch_size)
     device = args.device
     model_type = args.model_type
     epochs = int(args.epochs)
+    num_workers = int(args.num_workers)
+    prefetch_factor = int(args.prefetch_factor)
+    prefetch_depth = int(args.prefetch_depth)
+    preload = args.preload == 'y'
+    mmap = args.mmap == 'y'
+    shm = args.shared_memory == 'y'
+    swmr = args.swmr == 'y'
+    sharded = args.sharded == 'y'
+    seed = int(args.seed)
+    block_shuffle = args.block_shuffle == 'y'
+    checkpoint_path = args.checkpoint
+    checkpoint_every = int(args.checkpoint_every)
+    augment = BatchAugment(box_format=args.box_format, seed=seed) if args.augment == 'y' else None
+    cache = TargetCache(args.target_cache, max_bytes=int(args.target_cache_mb) * 2 ** 20) if args.target_cache else None
+    providers = target_providers(model_type, cache)
+
+    # The batch size, workers, prefetch factor and preload/mmap are replaced by those tuned for this host
+    if args.autotune_loader == 'y':
+        if shm or swmr or sharded:
+            raise ValueError('the autotuner chooses between the h5 files, preload and mmap, '
+                             'it cannot be combined with shm, swmr or sharded')
+        batch_sizes = [int(size) for size in args.autotune_batch_sizes.split(',')]
+        tuned = autotune.autotune(train_path, model_type, device, providers=providers, batch_sizes=batch_sizes,
+                                  cache_path=args.autotune_cache, force=args.autotune_force == 'y')
+        batch_size, num_workers, prefetch_factor = tuned['batch_size'], tuned['num_workers'], tuned['prefetch_factor']
+        preload, mmap = tuned['preload'], tuned['mmap']
 
     print("--------------------------------------------------------------------------------")
     print(f"Model chosen: {model_type} , device: {device}, mini-batch size: {batch_size}")
-    print(f"Train: {train}, Number of Epochs: {epochs}, Test: {test}")
+    print(f"Train: {train}, Number of Epochs: {epochs}, Test: {test}, seed: {seed}, checkpoint: {checkpoint_path}, "
+          f"augment: {augment is not None}")
+    print(f"Data loader workers: {num_workers}, prefetch factor: {prefetch_factor}, preload: {preload}, "
+          f"mmap: {mmap}, shared memory: {shm}, swmr: {swmr}, sharded: {sharded}, prefetch depth: {prefetch_depth}, "
+          f"target cache: {args.target_cache}")
     print("--------------------------------------------------------------------------------")
 
     # data loaders
-    if model_type == 'MTL-segnet-with-colorization' or model_type == 'MTL-Attention-with-colorization':
-        print("in here!")
-        train_loader, validation_loader, test_loader = lab_loader.create_data_loaders(train_path=train_path,
-                                                                                      validation_path=validation_path,
-                                                                                      test_path=test_path,
-                                                                                      batch_size=batch_size,
-                                                                                      )
-
-    elif model_type == 'MTL-Attention-with-denoising':
-        train_loader, validation_loader, test_loader = denoising_loader.create_data_loaders(train_path=train_path,
-                                                                                            validation_path=validation_path,
-                                                                                            test_path=test_path,
-                                                                                            batch_size=batch_size,
-                                                                                            noisy=True
-                                                                                            )
-    elif model_type == 'MTL-Attention-with-canny':
-        train_loader, validation_loader, test_loader = data_loader_canny.create_data_loaders(train_path=train_path,
-                                                                                             validation_path=validation_path,
-                                                                                             test_path=test_path,
-                                                                                             batch_size=batch_size,
-                                                                                             opencv_filters=True,
-                                                                                             )
+    if sharded:
+        # Raises for the model types whose inputs or targets are derived from the h5 files (ie: colourisation)
+        train_loader, validation_loader, test_loader = shard_loader.create_data_loaders(train_path=train_path,
+                                                                                        validation_path=validation_path,
+                                                                                        test_path=test_path,
+                                                                                        batch_size=batch_size,
+                                                                                        num_workers=num_workers,
+                                                                                        prefetch_factor=prefetch_factor,
+                                                                                        seed=seed,
+                                                                                        providers=providers,
+                                                                                        exclude=args.exclude == 'y',
+                                                                                        )
 
     else:
         train_loader, validation_loader, test_loader = load_data.create_data_loaders(train_path=train_path,
                                                                                      validation_path=validation_path,
                                                                                      test_path=test_path,
                                                                                      batch_size=batch_size,
+                                                                                     num_workers=num_workers,
+                                                                                     prefetch_factor=prefetch_factor,
+                                                                                     preload=preload,
+                                                                                     mmap=mmap,
+                                                                                     shm=shm,
+                                                                                     swmr=swmr,
+                                                                                     exclude=args.exclude == 'y',
+                                                                                     providers=providers,
+                                                                                     seed=seed,
+                                                                                     block_shuffle=block_shuffle,
+                                                                                     block_window=int(
+                                                                                         args.block_window),
                                                                                      )
 
     # fetch model, loss criterion and optimizer
@@ -72,28 +147,40 @@ def run_cw2(args, train=True, test=False, visualize=False):
     if train:
         print("Training the model!")
 
-        if model_type == 'MTL-segnet-with-colorization' or model_type == 'MTL-Attention-with-colorization':
+        if model_type in COLORIZATION_MODELS:
 
             model = train_color.train_model(model_type=model_type, train_loader=train_loader,
                                             validation_loader=validation_loader,
                                             model=model, optimizer=optimizer, loss_criterion=loss_criterion,
                                             epochs=epochs,
-                                            device=device
+                                            device=device,
+                                            prefetch_depth=prefetch_depth,
+                                            checkpoint_path=checkpoint_path,
+                                            checkpoint_every=checkpoint_every,
+                                            augment=augment
                                             )
-        elif model_type == 'MTL-Attention-with-denoising':
+        elif model_type in DENOISING_MODELS:
             model = train_denoising.train_model(model_type=model_type, train_loader=train_loader,
                                                 validation_loader=validation_loader,
                                                 model=model, optimizer=optimizer, loss_criterion=loss_criterion,
                                                 epochs=epochs,
-                                                device=device
+                                                device=device,
+                                                prefetch_depth=prefetch_depth,
+                                                checkpoint_path=checkpoint_path,
+                                                checkpoint_every=checkpoint_every,
+                                                augment=augment
                                                 )
 
-        elif model_type == 'MTL-Attention-with-canny':
+        elif model_type in CANNY_MODELS:
             model = train_canny.train_model(model_type=model_type, train_loader=train_loader,
                                             validation_loader=validation_loader,
                                             model=model, optimizer=optimizer, loss_criterion=loss_criterion,
                                             epochs=epochs,
-                                            device=device
+                                            device=device,
+                                            prefetch_depth=prefetch_depth,
+                                            checkpoint_path=checkpoint_path,
+                                            checkpoint_every=checkpoint_every,
+                                            augment=augment
                                             )
 
         else:
@@ -101,7 +188,11 @@ def run_cw2(args, train=True, test=False, visualize=False):
                                             validation_loader=validation_loader,
                                             model=model, optimizer=optimizer, loss_criterion=loss_criterion,
                                             epochs=epochs,
-                                            device=device
+                                            device=device,
+                                            prefetch_depth=prefetch_depth,
+                                            checkpoint_path=checkpoint_path,
+                                            checkpoint_every=checkpoint_every,
+                                            augment=augment
                                             )
     ###############################
     # Test Model
@@ -126,56 +217,32 @@ def run_cw2(args, train=True, test=False, visualize=False):
 
         model_path = params_dict[model_type]
 
-        if model_type == 'MTL-segnet-with-colorization' or model_type == 'MTL-Attention-with-colorization':
+        # The test loader built above only reads what the model needs
+        model, optimizer, loss_criterion = model_utils.get_model(model_type=model_type, device=device)
+        model = model_utils.load_model(model=model, model_path=model_path, device=device)
 
-            model, optimizer, loss_criterion = model_utils.get_model(model_type=model_type, device=device)
-            train_loader, validation_loader, test_loader = lab_loader.create_data_loaders(train_path=train_path,
-                                                                                          validation_path=validation_path,
-                                                                                          test_path=test_path,
-                                                                                          batch_size=batch_size,
-                                                                                          )
-
-            model = model_utils.load_model(model=model, model_path=model_path, device=device)
+        if model_type in COLORIZATION_MODELS:
             test_model.evaluate_color_on_data(test_loader=test_loader, model=model, device=device,
-                                              loss_criterion=loss_criterion, model_name=model_path)
-
-        elif model_type == 'MTL-Attention-with-denoising':
-            train_loader, validation_loader, test_loader = denoising_loader.create_data_loaders(
-                train_path=train_path,
-                validation_path=validation_path,
-                test_path=test_path,
-                batch_size=batch_size, noisy=True
-            )
-            model, optimizer, loss_criterion = model_utils.get_model(model_type=model_type, device=device)
-            model = model_utils.load_model(model=model, model_path=model_path, device=device)
+                                              loss_criterion=loss_criterion, model_name=model_path,
+                                              prefetch_depth=prefetch_depth)
 
+        elif model_type in DENOISING_MODELS:
             test_model.evaluate_denoising(test_loader=test_loader, model=model, device=device,
-                                          loss_criterion=loss_criterion, model_name=model_path)
-
-        elif model_type == 'MTL-Attention-with-canny':
-
-            train_loader, validation_loader, test_loader = load_data.create_data_loaders(train_path=train_path,
-                                                                                         validation_path=validation_path,
-                                                                                         test_path=test_path,
-                                                                                         batch_size=batch_size)
+                                          loss_criterion=loss_criterion, model_name=model_path,
+                                          prefetch_depth=prefetch_depth)
 
-            model, optimizer, loss_criterion = model_utils.get_model(model_type=model_type, device=device)
-            model = model_utils.load_model(model=model, model_path=model_path, device=device)
+        elif model_type in CANNY_MODELS:
             test_model.evaluate_opencv_filters(test_loader=test_loader, model=model, device=device,
-                                               loss_criterion=loss_criterion, model_name=model_path)
+                                               loss_criterion=loss_criterion, model_name=model_path,
+                                               prefetch_depth=prefetch_depth)
 
         else:
-            train_loader, validation_loader, test_loader = load_data.create_data_loaders(train_path=train_path,
-                                                                                         validation_path=validation_path,
-                                                                                         test_path=test_path,
-                                                                                         batch_size=batch_size)
-
-            model, optimizer, loss_criterion = model_utils.get_model(model_type=model_type, device=device)
-
-            model = model_utils.load_model(model=model, model_path=model_path, device=device)
             test_model.evaluate_model_on_data(test_loader=test_loader, model=model, device=device,
-                                              loss_criterion=loss_criterion, model_name=model_path)
+                                              loss_criterion=loss_criterion, model_name=model_path,
+                                              prefetch_depth=prefetch_depth)
 
+    if cache is not None:
+        print(cache.report())
     print('Completed!')
 
 
@@ -196,6 +263,39 @@ def process_args():
     ap.add_argument("-tr", '--train', help='train the model (y/n)', default='n')
     ap.add_argument("-ts", '--test', help='test the model (y/n)', default='y')
     ap.add_argument("-e", '--epochs', help='Number of epochs', default=30)
+    ap.add_argument("-w", '--num_workers', help='number of data loading worker processes', default=0)
+    ap.add_argument("-pf", '--prefetch_factor', help='mini-batches loaded in advance by each worker', default=2)
+    ap.add_argument("-pl", '--preload', help='keep the dataset splits in shared memory (y/n)', default='n')
+    ap.add_argument("-mm", '--mmap', help='read the memory mapped copy written by mmap_cache.py (y/n)', default='n')
+    ap.add_argument("-sm", '--shared_memory', help='read the splits served by shm_server.py (y/n)', default='n')
+    ap.add_argument("-sw", '--swmr', help='read the h5 files as SWMR readers, picking up ingest.py appends (y/n)',
+                    default='n')
+    ap.add_argument("-ex", '--exclude', help='skip the near-duplicates listed by dedup.py (y/n)', default='y')
+    ap.add_argument("-sh", '--sharded', help='stream the shards written by shard_loader.py (y/n)', default='n')
+    ap.add_argument("-pd", '--prefetch_depth', help='mini-batches moved to the device ahead of the training step',
+                    default=2)
+    ap.add_argument("-dp", '--data_path', help='folder holding the train/val/test splits', default='data/')
+    ap.add_argument("-sd", '--seed', help='seed of the training shuffle, combined with the epoch', default=0)
+    ap.add_argument("-bsh", '--block_shuffle', help='shuffle the training data by h5 chunks (y/n)', default='n',
+                    choices=['y', 'n'])
+    ap.add_argument("-bw", '--block_window', help='chunks whose samples are mixed by the block shuffle', default=4)
+    ap.add_argument("-ck", '--checkpoint', help='file the training state is saved to and resumed from', default=None)
+    ap.add_argument("-ce", '--checkpoint_every', default=0,
+                    help='also save the training state every n mini-batches (0 per epoch only)')
+    ap.add_argument("-tc", '--target_cache', help='folder memoising the derived targets (Lab, noisy, canny)',
+                    default=None)
+    ap.add_argument("-tm", '--target_cache_mb', help='size budget of the target cache in MB', default=1024)
+    ap.add_argument("-au", '--augment', help='random flips, crops and colour jitter of the training batches (y/n)',
+                    default='n')
+    ap.add_argument("-bf", '--box_format', help='layout of the bounding boxes moved by the augmentation (xyxy/xywh)',
+                    default='xyxy')
+    ap.add_argument("-at", '--autotune_loader', default='n',
+                    help='benchmark the batch size and loader settings on this host and use the best (y/n)')
+    ap.add_argument("-ab", '--autotune_batch_sizes', help='comma separated batch sizes tried by the autotuner',
+                    default='4,8,16,32')
+    ap.add_argument("-ac", '--autotune_cache', help='JSON file keeping the tuned settings of every host',
+                    default=autotune.AUTOTUNE_FILE)
+    ap.add_argument("-af", '--autotune_force', help='tune again even if the settings were cached (y/n)', default='n')
     # ap.add_argument("-v", '--visualize', help='visualise the dataset (y/n)', default='n')
     return ap.parse_args()
 
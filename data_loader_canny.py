@@ -1,52 +1,169 @@
+import os
+import argparse
 import h5py
+import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as transforms
-import pathlib
-
-
-def create_data_loaders(train_path, validation_path, test_path, batch_size=16, opencv_filters=False):
-    # Train data
-    train_transform = transforms.Compose(
-        [transforms.ToTensor(),
-         transforms.Normalize((127.5, 127.5, 127.5), (127.5, 127.5, 127.5)),
-         ])
-    train_loader = build_data_loader(data_path=train_path, pt_transforms=train_transform, batch_size=batch_size,
-                                     opencv_filters=opencv_filters)
-    # Validation data
-    validation_transform = train_transform
-    validation_loader = build_data_loader(data_path=validation_path, pt_transforms=validation_transform,
-                                          batch_size=batch_size, opencv_filters=opencv_filters)
-    # Test data
-    test_transform = transforms.Compose(
-        [transforms.ToTensor(),
-         transforms.Normalize((127.5, 127.5, 127.5), (127.5, 127.5, 127.5)),
-         ])
-    test_loader = build_data_loader(data_path=test_path, pt_transforms=test_transform, batch_size=batch_size,
-                                    opencv_filters=opencv_filters)
-
-    return train_loader, validation_loader, test_loader
-
-
-def build_data_loader(data_path, pt_transforms, batch_size=16, opencv_filters=False):
-    # Define paths
-    images_filepath = pathlib.Path(data_path + '/images.h5')
-    masks_filepath = pathlib.Path(data_path + '/masks.h5')
-    bboxes_filepath = pathlib.Path(data_path + '/bboxes.h5')
-    labels_filepath = pathlib.Path(data_path + '/binary.h5')
-    if opencv_filters:
-        canny_filepath = pathlib.Path(data_path + '/canny_filter.h5')
-    else:
-        canny_filepath = None
-
-    # Create loader
-    image_loader = H5ImageLoader(img_file=images_filepath, mask_file=masks_filepath, bbox_file=bboxes_filepath,
-                                 classification_file=labels_filepath, transform=pt_transforms,
-                                 canny_file=canny_filepath)  # All data paths
-    # Create pytorch loader
-    data_loader = DataLoader(image_loader, batch_size=batch_size, shuffle=True)
-
-    return data_loader
+import torch.nn.functional as F
+import load_data
+from load_data import LazyH5Files, MultiTaskDataset, TargetProvider, DEFAULT_PROVIDERS
+from target_cache import CachedTarget
+
+# Canny edge maps of the images, written to canny_filter.h5
+CANNY = TargetProvider('canny', 'canny_filter')
+
+
+def canny_providers(opencv_filters=False, cache=None):
+    """Returns the providers of the canny loaders, reading canny_filter.h5 or memoising the edge maps in cache."""
+    if not opencv_filters:
+        return DEFAULT_PROVIDERS
+    return DEFAULT_PROVIDERS + [CachedTarget('canny', 'canny_filter', cache) if cache is not None else CANNY]
+
+
+# Gaussian kernels opencv uses for 8 bit images when sigma is 0, in 1/256 units
+GAUSSIAN_KERNELS = {3: [64, 128, 64], 5: [16, 64, 96, 64, 16], 7: [8, 28, 56, 72, 56, 28, 8]}
+# tan(22.5 degrees) in the fixed point precision of opencv's non-maximum suppression
+TAN_22_5 = int(0.4142135623730950488016887242097 * 2 ** 15 + 0.5)
+
+
+def rgb_to_gray(images):
+    """A function for converting a batch of uint8 RGB images to grayscale with opencv's integer weights.
+
+    Args:
+        images (tensor): uint8 images of shape (batch, height, width, 3).
+
+    Returns:
+        gray (tensor): float32 grayscale images of shape (batch, 1, height, width), holding whole numbers 0-255.
+    """
+    images = images.to(torch.int32)
+    gray = (images[..., 0] * 9798 + images[..., 1] * 19235 + images[..., 2] * 3735 + 2 ** 14) >> 15
+    return gray.unsqueeze(1).float()
+
+
+def gaussian_blur(gray, blur_size=5):
+    """A function for blurring a batch of grayscale images the way cv2.GaussianBlur(gray, (k, k), 0) does.
+
+    The sums are whole numbers below 2 ** 24, so the float32 convolution is exact.
+
+    Args:
+        gray (tensor): float32 images of shape (batch, 1, height, width) holding whole numbers 0-255.
+        blur_size (int, optional): Size of the kernel, 3, 5 or 7. Defaults to 5.
+
+    Returns:
+        blurred (tensor): float32 images of the same shape, rounded as opencv rounds its uint8 output.
+    """
+    if blur_size not in GAUSSIAN_KERNELS:
+        raise ValueError(f'blur_size must be one of {list(GAUSSIAN_KERNELS)}, got {blur_size}')
+    kernel = torch.tensor(GAUSSIAN_KERNELS[blur_size], dtype=torch.float32, device=gray.device)
+    kernel = torch.outer(kernel, kernel).view(1, 1, blur_size, blur_size)
+    padding = blur_size // 2
+    padded = F.pad(gray, (padding, padding, padding, padding), mode='reflect')
+    return torch.floor((F.conv2d(padded, kernel) + 2 ** 15) / 2 ** 16)
+
+
+def sobel(gray):
+    """Returns the 3x3 sobel derivatives (dx, dy) of a batch of images, replicating the border like cv2.Canny."""
+    kernel_x = torch.tensor([[-1., 0., 1.], [-2., 0., 2.], [-1., 0., 1.]], device=gray.device)
+    kernels = torch.stack([kernel_x, kernel_x.t()]).unsqueeze(1)
+    gradients = F.conv2d(F.pad(gray, (1, 1, 1, 1), mode='replicate'), kernels)
+    return gradients[:, 0].to(torch.int32), gradients[:, 1].to(torch.int32)
+
+
+def non_maximum_suppression(dx, dy, magnitude):
+    """A function for keeping the pixels whose gradient magnitude is a maximum across the edge.
+
+    The gradient direction is quantised to horizontal, vertical or one of the diagonals with the
+    same fixed point test and the same tie breaking as cv2.Canny.
+
+    Args:
+        dx, dy (tensor): int32 sobel derivatives of shape (batch, height, width).
+        magnitude (tensor): int32 L1 gradient magnitude of the same shape.
+
+    Returns:
+        maxima (tensor): bool tensor of the same shape.
+    """
+    height, width = magnitude.shape[1:]
+    padded = F.pad(magnitude, (1, 1, 1, 1))
+
+    def neighbour(row, column):
+        return padded[:, 1 + row:1 + row + height, 1 + column:1 + column + width]
+
+    x = dx.abs().long()
+    y = dy.abs().long() << 15
+    tan_22_5_x = x * TAN_22_5
+    horizontal = y < tan_22_5_x
+    vertical = ~horizontal & (y > tan_22_5_x + (x << 16))
+    diagonal = ~horizontal & ~vertical
+    # Derivatives of opposite signs run along the anti-diagonal
+    anti = (dx ^ dy) < 0
+
+    maxima = horizontal & (magnitude > neighbour(0, -1)) & (magnitude >= neighbour(0, 1))
+    maxima |= vertical & (magnitude > neighbour(-1, 0)) & (magnitude >= neighbour(1, 0))
+    maxima |= diagonal & anti & (magnitude > neighbour(-1, 1)) & (magnitude > neighbour(1, -1))
+    maxima |= diagonal & ~anti & (magnitude > neighbour(-1, -1)) & (magnitude > neighbour(1, 1))
+    return maxima
+
+
+def hysteresis(strong, weak):
+    """A function for growing the strong edges along the 8-connected weak edges until nothing changes.
+
+    Args:
+        strong (tensor): bool tensor of shape (batch, height, width), pixels above the high threshold.
+        weak (tensor): bool tensor of the same shape, pixels above the low threshold (including strong).
+
+    Returns:
+        edges (tensor): bool tensor of the same shape.
+    """
+    edges = strong.float().unsqueeze(1)
+    weak = weak.unsqueeze(1)
+    while True:
+        grown = (F.max_pool2d(edges, 3, stride=1, padding=1) > 0) & weak
+        grown = grown.float()
+        if torch.equal(grown, edges):
+            return edges.squeeze(1) > 0
+        edges = grown
+
+
+@torch.no_grad()
+def batch_canny(images, blur_size=5, low_threshold=100, high_threshold=200):
+    """A function for computing the canny edge maps of a batch of RGB images on their device.
+
+    Matches precompute_targets.canny_chunk (grayscale, cv2.GaussianBlur and cv2.Canny with a 3x3
+    aperture and L1 gradient), so the canny target can be made per batch instead of read from
+    canny_filter.h5.
+
+    Args:
+        images (tensor): uint8 images of shape (batch, height, width, 3), as returned by the data loaders.
+        blur_size (int, optional): Size of the gaussian kernel, 3, 5 or 7. Defaults to 5.
+        low_threshold (int, optional): Gradients above it are kept if connected to a strong edge. Defaults to 100.
+        high_threshold (int, optional): Gradients above it are strong edges. Defaults to 200.
+
+    Returns:
+        edges (tensor): uint8 edge maps of shape (batch, height, width), 1 on the edges and 0 elsewhere.
+    """
+    low_threshold, high_threshold = sorted((int(low_threshold), int(high_threshold)))
+    gray = gaussian_blur(rgb_to_gray(images), blur_size)
+    dx, dy = sobel(gray)
+    magnitude = dx.abs() + dy.abs()
+    maxima = non_maximum_suppression(dx, dy, magnitude)
+    weak = maxima & (magnitude > low_threshold)
+    strong = weak & (magnitude > high_threshold)
+    return hysteresis(strong, weak).to(torch.uint8)
+
+
+def create_data_loaders(train_path, validation_path, test_path, batch_size=16, opencv_filters=False, num_workers=0,
+                        prefetch_factor=2, preload=False, mmap=False, cache=None):
+    providers = canny_providers(opencv_filters, cache)
+    return load_data.create_data_loaders(train_path, validation_path, test_path, batch_size=batch_size,
+                                         num_workers=num_workers, prefetch_factor=prefetch_factor, preload=preload,
+                                         mmap=mmap, providers=providers)
+
+
+def build_data_loader(data_path, pt_transforms=None, batch_size=16, opencv_filters=False, num_workers=0,
+                      prefetch_factor=2, preload=False, mmap=False, cache=None):
+    providers = canny_providers(opencv_filters, cache)
+    return load_data.build_data_loader(data_path, pt_transforms=pt_transforms, batch_size=batch_size,
+                                       num_workers=num_workers, prefetch_factor=prefetch_factor, preload=preload,
+                                       mmap=mmap, providers=providers)
 
 
 def take_random_samples(data_loader, n_samples):
@@ -57,13 +174,12 @@ def take_random_samples(data_loader, n_samples):
     return images, labels, segmentations, bboxes
 
 
-class H5ImageLoader(Dataset):
+class H5ImageLoader(MultiTaskDataset):
     """
-    Dataloader containing __len__ & __getitem__ as per
-    Pytorch dataloader specifications
+    MultiTaskDataset reading the images, masks, bounding boxes, classes and optionally the canny edge maps
     """
 
-    def __init__(self, img_file, mask_file, bbox_file, classification_file, transform, canny_file=None):
+    def __init__(self, img_file, mask_file, bbox_file, classification_file, transform, canny_file=None, preload=False):
         """
         @params:
         img_file(string): Path for images
@@ -71,41 +187,62 @@ class H5ImageLoader(Dataset):
         bbox_file(string): Path for bounding boxes
         classification_file(string): Path for classes (0 or 1)
         transform(callable): Transform to be applied to the images ## ONLY TRAINING IMAGES, MASKS? ( I DONT THINK SO)
+        canny_file(string): Path for the canny edge maps, optional
+        preload(bool): Keep the raw arrays in shared memory instead of reading the h5 files every epoch
         """
-
-        self.img_h5 = h5py.File(img_file, 'r')
-        self.mask_h5 = h5py.File(mask_file, 'r')
-        self.bbox_h5 = h5py.File(bbox_file, 'r')
-        self.classifcation_h5 = h5py.File(classification_file, 'r')
-
-        self.dataset_list = list(self.img_h5.keys())[0]
-        self.mask_list = list(self.mask_h5.keys())[0]
-        self.bbox_list = list(self.bbox_h5.keys())[0]
-        self.classification_list = list(self.classifcation_h5.keys())[0]
-
-        self.transform = transform
-        self.canny_file = canny_file
-
-        if canny_file is not None:
-            self.canny_h5 = h5py.File(canny_file, 'r')
-            self.canny_list = list(self.canny_h5.keys())[0]
-
-    def __len__(self):
-        return self.img_h5[list(self.img_h5.keys())[0]].shape[0]
-
-    def __getitem__(self, idx):
-        image = self.img_h5[self.dataset_list][idx]
-        mask = self.mask_h5[self.mask_list][idx]
-        bbox = self.bbox_h5[self.bbox_list][idx]
-        classification = self.classifcation_h5[self.classification_list][idx]
-
-        if self.transform:
-            image = self.transform(image).to(
-                torch.float32)  # float32 for pytorch compatibility (weights initialized to the same)
-
-        # Return input and output for the network.
-        if self.canny_file:
-            canny = self.canny_h5[self.canny_list][idx]
-            return image, {'mask': mask, 'bbox': bbox, 'classification': classification, 'canny': canny}
-        else:
-            return image, {'mask': mask, 'bbox': bbox, 'classification': classification}
+        # Files are opened lazily so that every DataLoader worker gets its own handles
+        files = LazyH5Files(images=img_file, masks=mask_file, bboxes=bbox_file, binary=classification_file,
+                            canny_filter=canny_file)
+        providers = DEFAULT_PROVIDERS + [CANNY] if canny_file is not None else DEFAULT_PROVIDERS
+        super().__init__(files, providers=providers, transform=transform, preload=preload)
+
+
+def validate(data_path, n_samples=100, device='cpu', batch_size=16, **params):
+    """A function for comparing batch_canny with the opencv edge maps on the first images of a split.
+
+    Args:
+        data_path (path): Folder holding the images.h5 file of the split (ie: 'data/test/').
+        n_samples (int, optional): Number of images compared. Defaults to 100.
+        device (string, optional): Device batch_canny runs on. Defaults to 'cpu'.
+        batch_size (int, optional): Images per batch. Defaults to 16.
+        params (dict): blur_size, low_threshold and high_threshold, defaults as in precompute_targets.
+
+    Returns:
+        agreement (float), identical (int), compared (int): Fraction of pixels that agree, number of identical
+        edge maps and number of images compared.
+    """
+    import precompute_targets
+    params = dict(precompute_targets.DEFAULT_PARAMS['canny_filter'], **params)
+    with h5py.File(os.path.join(data_path, 'images.h5'), 'r') as h5_file:
+        images = h5_file[list(h5_file.keys())[0]][:n_samples].astype(np.uint8)
+
+    agreeing = 0
+    identical = 0
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        expected = precompute_targets.canny_chunk(chunk, start, params)
+        edges = batch_canny(torch.from_numpy(chunk).to(device), **params).cpu().numpy()
+        agreeing += int((edges == expected).sum())
+        identical += int(sum(np.array_equal(a, b) for a, b in zip(edges, expected)))
+    return agreeing / images[..., 0].size, identical, len(images)
+
+
+def process_args():
+    """A function used to validate the torch canny edge maps against opencv from the terminal.
+
+    Returns:
+        Interprets the arguments added to the argument parser object during the running of the script.
+    """
+    ap = argparse.ArgumentParser(description="Compare the batched torch canny edge maps with cv2.Canny")
+    ap.add_argument('splits', nargs='*', help='split folders to sample the images from', default=['data/test/'])
+    ap.add_argument("-n", '--n_samples', help='number of images compared per split', default=100)
+    ap.add_argument("-d", '--device', help='device the torch implementation runs on (cpu/cuda)', default='cpu')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_args()
+    for split in args.splits:
+        agreement, identical, compared = validate(split, n_samples=int(args.n_samples), device=args.device)
+        print(f'{split}: {agreement * 100:.4f}% of the pixels agree, {identical} of {compared} '
+              f'edge maps identical')
@@ -0,0 +1,197 @@
+import os
+import json
+import math
+import argparse
+import h5py
+import numpy as np
+import torch
+import torch.nn.functional as F
+from load_data import EXCLUDE_FILE
+
+# Side of the grayscale thumbnail transformed by the DCT, and of the block of low frequencies hashed
+DCT_SIZE = 32
+HASH_SIZE = 8
+
+
+def dct_matrix(size, device='cpu'):
+    """Returns the orthonormal DCT-II matrix of shape (size, size), so that dct(x) = matrix @ x."""
+    n = torch.arange(size, dtype=torch.float64, device=device)
+    matrix = torch.cos(math.pi / size * (n[None, :] + 0.5) * n[:, None]) * math.sqrt(2 / size)
+    matrix[0] /= math.sqrt(2)
+    return matrix.float()
+
+
+@torch.no_grad()
+def phash(images):
+    """A function for computing the 64 bit perceptual hashes of a batch of images.
+
+    Every image is converted to grayscale and shrunk to DCT_SIZE x DCT_SIZE. Each bit of the hash
+    tells whether one of the HASH_SIZE x HASH_SIZE lowest frequencies of its DCT is above their
+    median (the constant term left out). Resizing, compression and small colour changes keep
+    most bits, so near-duplicates have hashes a few bits apart.
+
+    Args:
+        images (tensor): uint8 images of shape (batch, height, width, channels), as stored in images.h5.
+
+    Returns:
+        hashes (numpy array): uint64 hashes of shape (batch,).
+    """
+    images = images.float()
+    if images.shape[-1] == 3:
+        gray = images[..., 0] * 0.299 + images[..., 1] * 0.587 + images[..., 2] * 0.114
+    else:
+        gray = images.mean(dim=-1)
+    thumbnails = F.interpolate(gray.unsqueeze(1), size=(DCT_SIZE, DCT_SIZE), mode='area').squeeze(1)
+    matrix = dct_matrix(DCT_SIZE, images.device)
+    frequencies = (matrix @ thumbnails @ matrix.t())[:, :HASH_SIZE, :HASH_SIZE].reshape(len(images), -1)
+    median = frequencies[:, 1:].median(dim=1, keepdim=True).values
+    bits = (frequencies > median).cpu().numpy()
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def hash_split(data_path, batch_size=256, device='cpu'):
+    """A function for hashing every image of a split, reading images.h5 a mini-batch at a time.
+
+    Args:
+        data_path (path): Folder holding the images.h5 file of the split (ie: 'data/train/').
+        batch_size (int, optional): Images hashed at a time. Defaults to 256.
+        device (string, optional): Device the hashes are computed on. Defaults to 'cpu'.
+
+    Returns:
+        hashes (numpy array): uint64 hash of every image, in the order of images.h5.
+    """
+    with h5py.File(os.path.join(data_path, 'images.h5'), 'r') as h5_file:
+        dataset = h5_file[list(h5_file.keys())[0]]
+        hashes = [phash(torch.from_numpy(dataset[start:start + batch_size]).to(device))
+                  for start in range(0, dataset.shape[0], batch_size)]
+    return np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+
+
+def hamming(first, second):
+    """Returns the number of bits that differ between two arrays of uint64 hashes, element wise."""
+    different = np.bitwise_xor(first, second).astype(np.uint64)
+    return np.unpackbits(different.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def near_duplicates(hashes, max_distance=4):
+    """A function for finding the pairs of hashes at most max_distance bits apart, without comparing all pairs.
+
+    Multi-index hashing: the 64 bits are cut into max_distance + 1 substrings, and two hashes at
+    most max_distance bits apart agree on at least one of them. Only the hashes sharing a substring
+    are compared, which are found by sorting the substrings.
+
+    Args:
+        hashes (numpy array): uint64 hashes.
+        max_distance (int, optional): Largest number of differing bits of a near-duplicate. Defaults to 4.
+
+    Returns:
+        pairs (numpy array): int64 array of shape (n_pairs, 2) holding the indices (i, j), i < j, of every pair.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    bounds = np.linspace(0, 64, max_distance + 2).astype(np.uint64)
+    pairs = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        substrings = (hashes >> start) & np.uint64((1 << int(stop - start)) - 1)
+        order = np.argsort(substrings, kind='stable')
+        boundaries = np.flatnonzero(np.diff(substrings[order])) + 1
+        for bucket in np.split(order, boundaries):
+            if len(bucket) < 2:
+                continue
+            first, second = np.triu_indices(len(bucket), k=1)
+            close = hamming(hashes[bucket[first]], hashes[bucket[second]]) <= max_distance
+            pairs.append(np.stack([bucket[first][close], bucket[second][close]], axis=1))
+
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    # Pairs agreeing on several substrings are found once per substring
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return np.unique(pairs, axis=0).astype(np.int64)
+
+
+def group_duplicates(n_samples, pairs):
+    """A function for joining the near-duplicate pairs into groups, keeping the lowest index of every group.
+
+    Args:
+        n_samples (int): Number of hashes the pairs index into.
+        pairs (numpy array): Pairs of near-duplicates, see near_duplicates.
+
+    Returns:
+        kept (numpy array): Index of the sample kept in place of every sample, itself for the samples kept.
+    """
+    parents = np.arange(n_samples)
+
+    def root(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for first, second in pairs:
+        first, second = root(first), root(second)
+        if first != second:
+            parents[max(first, second)] = min(first, second)
+    return np.array([root(index) for index in range(n_samples)], dtype=np.int64)
+
+
+def deduplicate(splits, max_distance=4, batch_size=256, device='cpu'):
+    """A function for listing the near-duplicate images of one or more splits, which the loaders then skip.
+
+    The splits are deduplicated together, so an image of a later split that duplicates one of an
+    earlier split is excluded as well (ie: a validation image seen during training). Of every group of
+    near-duplicates the first image of the first split is kept. Every split gets an EXCLUDE_FILE
+    listing its excluded indices, read by load_data.read_exclusions.
+
+    Args:
+        splits (list): Split folders, in the order of preference (ie: ['data/train/', 'data/val/', 'data/test/']).
+        max_distance (int, optional): Largest number of differing hash bits of a near-duplicate. Defaults to 4.
+        batch_size (int, optional): Images hashed at a time. Defaults to 256.
+        device (string, optional): Device the hashes are computed on. Defaults to 'cpu'.
+
+    Returns:
+        excluded (dict): Excluded indices of every split.
+    """
+    hashes = [hash_split(split, batch_size=batch_size, device=device) for split in splits]
+    offsets = np.cumsum([0] + [len(split_hashes) for split_hashes in hashes])
+    # Identical hashes are paired with their first occurrence, so only the distinct ones are compared
+    unique, first, inverse = np.unique(np.concatenate(hashes), return_index=True, return_inverse=True)
+    pairs = np.concatenate([first[near_duplicates(unique, max_distance)],
+                            np.stack([first[inverse], np.arange(offsets[-1])], axis=1)])
+    kept = group_duplicates(offsets[-1], pairs)
+
+    def location(index):
+        split = int(np.searchsorted(offsets, index, side='right')) - 1
+        return splits[split], int(index - offsets[split])
+
+    excluded = {}
+    for split, start, stop in zip(splits, offsets[:-1], offsets[1:]):
+        duplicates = np.flatnonzero(kept[start:stop] != np.arange(start, stop))
+        excluded[split] = duplicates.tolist()
+        exclusions = {'excluded': excluded[split], 'num_samples': int(stop - start), 'max_distance': max_distance,
+                      'duplicate_of': {int(index): location(kept[start + index]) for index in duplicates}}
+        exclude_filepath = os.path.join(split, EXCLUDE_FILE)
+        with open(exclude_filepath + '.partial', 'w') as file:
+            json.dump(exclusions, file, indent=2)
+        os.replace(exclude_filepath + '.partial', exclude_filepath)
+        print(f'{split}: {len(duplicates)} of {stop - start} images are near-duplicates, listed in {exclude_filepath}')
+    return excluded
+
+
+def process_args():
+    """A function used to deduplicate the dataset splits from the terminal.
+
+    Returns:
+        Interprets the arguments added to the argument parser object during the running of the script.
+    """
+    ap = argparse.ArgumentParser(description="List the near-duplicate images of the splits, which the loaders skip")
+    ap.add_argument('splits', nargs='+', help='split folders, the earlier splits keep their images (ie: data/train/)')
+    ap.add_argument("-md", '--max_distance', help='largest number of differing hash bits of a near-duplicate',
+                    default=4)
+    ap.add_argument("-b", '--batch_size', help='images hashed at a time', default=256)
+    ap.add_argument("-d", '--device', help='device the hashes are computed on (cpu/cuda)', default='cpu')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_args()
+    deduplicate(args.splits, max_distance=int(args.max_distance), batch_size=int(args.batch_size),
+                device=args.device)
@@ -1,13 +1,160 @@
-import h5py
-import torch
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as transforms
-import pathlib
+import math
 import numpy as np
+import torch
 from generate_noisy_data import add_noise
+import precompute_targets
+import load_data
+from load_data import (LazyH5Files, MultiTaskDataset, TargetProvider, DEFAULT_PROVIDERS, IMAGE, MASK, BBOX,
+                       CLASSIFICATION)
+from target_cache import CachedTarget
+
+MASK32 = 0xffffffff
+
+
+class NoisyTarget(TargetProvider):
+    """
+    Provides the noisy images as the input of the network and the clean images as the denoising target.
+    The noisy images are generated once per split by generate_noisy_data.add_noise.
+    """
+
+    def __init__(self):
+        super().__init__('denoised', 'noisy_data', image=True)
+        self.filenames = ['noisy_data', 'images']
+
+    def prepare(self, data_path):
+        add_noise(data_path)
+
+    def read(self, dataset, indices):
+        return {'image': dataset.read_field('noisy_data', indices), 'denoised': dataset.read_field('images', indices)}
+
+
+NOISY = NoisyTarget()
+
+
+class CachedNoisyTarget(CachedTarget):
+    """
+    Provides the noisy input and clean target like NoisyTarget, with the noisy images of every sample
+    computed on first use and memoised in a TargetCache instead of written to noisy_data.h5.
+    """
+
+    def __init__(self, cache):
+        super().__init__('denoised', 'noisy_data', cache, image=True)
+
+    def labels(self, images, noisy_images):
+        return {'image': noisy_images, 'denoised': images}
+
 
+class SampleIndex(TargetProvider):
+    """
+    Provides the index of every sample in its split, which seeds the noise added on the device by OnlineNoise.
+    No file is read.
+    """
+
+    def __init__(self):
+        super().__init__('index', None)
+        self.filenames = []
+
+    def read(self, dataset, indices):
+        return {'index': np.asarray(indices, dtype=np.int64)}
+
+
+SAMPLE_INDEX = SampleIndex()
+
+
+def noisy_providers(cache=None):
+    """Returns the providers of the noisy images read from noisy_data.h5, or memoised in cache when given."""
+    return [CachedNoisyTarget(cache) if cache is not None else NOISY, MASK, BBOX, CLASSIFICATION]
+
+
+# Clean images and their indices, the noisy inputs are generated per batch on the device
+ONLINE_NOISE_PROVIDERS = [IMAGE, SAMPLE_INDEX, MASK, BBOX, CLASSIFICATION]
 
-def create_data_loaders(train_path, validation_path, test_path, batch_size=16, noisy=False):
+
+def hash32(values):
+    """A function for hashing the low 32 bits of an int64 tensor (lowbias32 integer hash).
+
+    Args:
+        values (tensor): int64 tensor.
+
+    Returns:
+        hashed (tensor): int64 tensor of the same shape, holding values in 0 to 2 ** 32 - 1.
+    """
+    values = values & MASK32
+    values = values ^ (values >> 16)
+    values = (values * 0x7feb352d) & MASK32
+    values = values ^ (values >> 15)
+    values = (values * 0x846ca68b) & MASK32
+    return values ^ (values >> 16)
+
+
+class OnlineNoise:
+    """
+    Adds gaussian noise to mini-batches of raw images on their device, instead of reading noisy_data.h5.
+
+    Every value of the noise is a hash of (seed, epoch, sample index, position in the image) turned into
+    a gaussian with the Box-Muller transform, so the noise of a sample only depends on those and not on
+    the batch it is in, the order of the batches or the number of workers. Training calls set_epoch to
+    draw new noise every epoch, evaluation keeps EVALUATION_EPOCH, which no training epoch reaches, so the
+    noisy inputs of a validation sample never change and never equal those of a training sample.
+    """
+
+    def __init__(self, mean=None, std=None, seed=None, epoch=0):
+        """
+        @params:
+        mean(float): Mean of the noise, defaults to the one of precompute_targets.DEFAULT_PARAMS
+        std(float): Standard deviation of the noise, defaults to the one of precompute_targets.DEFAULT_PARAMS
+        seed(int): Seed of the noise, defaults to the one of precompute_targets.DEFAULT_PARAMS
+        epoch(int): Epoch the noise is drawn for
+        """
+        params = precompute_targets.DEFAULT_PARAMS['noisy_data']
+        self.mean = params['mean'] if mean is None else mean
+        self.std = params['std'] if std is None else std
+        self.seed = params['seed'] if seed is None else seed
+        self.epoch = epoch
+
+    def set_epoch(self, epoch):
+        """Sets the epoch the noise of the next batches is drawn for."""
+        if epoch < 0:
+            raise ValueError(f'training epochs start at 0, got {epoch}')
+        self.epoch = epoch
+
+    @torch.no_grad()
+    def __call__(self, images, indices):
+        """
+        @params:
+        images(tensor): uint8 images of shape (batch, ...), as returned by the data loaders
+        indices(tensor): Index of every image in its split
+
+        Returns the noisy images, uint8 of the same shape and clipped to 0-255.
+        """
+        device = images.device
+        key = hash32(hash32(torch.tensor(self.seed, dtype=torch.int64, device=device)) ^ self.epoch)
+        sample_keys = hash32(key ^ indices.to(device, torch.int64))
+
+        n_values = images[0].numel()
+        n_pairs = (n_values + 1) // 2
+        counters = hash32(torch.arange(2 * n_pairs, dtype=torch.int64, device=device))
+        bits = hash32(sample_keys.view(-1, 1) ^ counters) >> 8
+
+        # Box-Muller transform of two uniforms with 24 bits each, u1 in (0, 1] and u2 in [0, 1)
+        u1 = (bits[:, 0::2] + 1).float() * 2 ** -24
+        u2 = bits[:, 1::2].float() * 2 ** -24
+        radius = torch.sqrt(-2 * torch.log(u1))
+        angle = 2 * math.pi * u2
+        normal = torch.stack([radius * torch.cos(angle), radius * torch.sin(angle)], dim=-1)
+        normal = normal.view(len(images), 2 * n_pairs)[:, :n_values].view(images.shape)
+
+        noisy_images = torch.round(images.float() + normal * self.std + self.mean)
+        return noisy_images.clamp(0, 255).to(torch.uint8)
+
+
+# Noise of the validation and testing batches, always drawn for an epoch training never reaches
+EVALUATION_EPOCH = -1
+EVALUATION_NOISE = OnlineNoise(epoch=EVALUATION_EPOCH)
+
+
+def create_data_loaders(train_path, validation_path, test_path, batch_size=16, noisy=False, num_workers=0,
+                        prefetch_factor=2, preload=False, mmap=False, online_noise=False, cache=None):
     """A function for creating pytorch training, validation and testing dataloader objects.
 
     Args:
@@ -16,65 +163,59 @@ def create_data_loaders(train_path, validation_path, test_path, batch_size=16, n
         test_path (path): The path for the testing data.
         batch_size (int, optional): Size of the batch. Defaults to 16.
         noisy (bool, optional): Boolean for addition of noise. Defaults to False.
+        num_workers (int, optional): Number of DataLoader worker processes. Defaults to 0.
+        prefetch_factor (int, optional): Batches loaded in advance by each worker. Defaults to 2.
+        preload (bool, optional): Load every split into shared memory once instead of reading the
+        h5 files every epoch. Defaults to False.
+        mmap (bool, optional): Read the memory mapped copy of every split written by mmap_cache.py.
+        Defaults to False.
+        online_noise (bool, optional): Return the clean images with their indices, the noise is added on the
+        device by train_denoising.prepare_batch instead of being read from noisy_data.h5. Defaults to False.
+        cache (TargetCache, optional): Memoise the noisy images in this cache instead of reading noisy_data.h5.
+        Defaults to None.
 
     Returns:
         train_loader, val_loader, test_loader are the torch.DataLoader() objects for their respective datasets;
         training, validation and testing sets.
     """
-    # Train data
-    train_transform = transforms.Compose(
-        [transforms.ToTensor(),
-         transforms.Normalize((127.5, 127.5, 127.5), (127.5, 127.5, 127.5)),
-         ])
-    train_loader = build_data_loader(data_path=train_path, pt_transforms=train_transform, batch_size=batch_size,
-                                     noisy=noisy)
-    # Validation data
-    validation_transform = train_transform
-    validation_loader = build_data_loader(data_path=validation_path, pt_transforms=validation_transform,
-                                          batch_size=batch_size, noisy=noisy)
-    # Test data
-    test_transform = transforms.Compose(
-        [transforms.ToTensor(),
-         transforms.Normalize((127.5, 127.5, 127.5), (127.5, 127.5, 127.5)),
-         ])
-    test_loader = build_data_loader(data_path=test_path, pt_transforms=test_transform, batch_size=batch_size, noisy=noisy)
-
-    return train_loader, validation_loader, test_loader
-
-
-def build_data_loader(data_path, pt_transforms, batch_size=16, noisy=False):
+    if online_noise:
+        providers = ONLINE_NOISE_PROVIDERS
+    else:
+        providers = noisy_providers(cache) if noisy else DEFAULT_PROVIDERS
+    return load_data.create_data_loaders(train_path, validation_path, test_path, batch_size=batch_size,
+                                         num_workers=num_workers, prefetch_factor=prefetch_factor, preload=preload,
+                                         mmap=mmap, providers=providers)
+
+
+def build_data_loader(data_path, pt_transforms=None, batch_size=16, noisy=False, num_workers=0, prefetch_factor=2,
+                      preload=False, mmap=False, online_noise=False, cache=None):
     """A function used for creating a single data loader.
 
     Args:
         data_path (path): Path used to access the data.
-        pt_transforms (pytorch object): Pytorch transforms to be applied onto the dataset, contained
-        as a list inside a pytorch transforms object. 
+        pt_transforms (pytorch object, optional): Pytorch transforms to be applied onto the dataset, contained
+        as a list inside a pytorch transforms object. Defaults to None, which keeps the raw images.
         batch_size (int, optional): Size of the batch. Defaults to 16.
         noisy (bool, optional): Boolean for addition of noise. Defaults to False.
+        num_workers (int, optional): Number of DataLoader worker processes. Defaults to 0.
+        prefetch_factor (int, optional): Batches loaded in advance by each worker. Defaults to 2.
+        preload (bool, optional): Load the split into shared memory once. Defaults to False.
+        mmap (bool, optional): Read the memory mapped copy in the 'mmap' folder of data_path. Defaults to False.
+        online_noise (bool, optional): Return the clean images with their indices, the noise is added on the
+        device by train_denoising.prepare_batch instead of being read from noisy_data.h5. Defaults to False.
+        cache (TargetCache, optional): Memoise the noisy images in this cache instead of reading noisy_data.h5.
+        Defaults to None.
 
     Returns:
         data_loader (pytorch object): DataLoader object for a specific dataset.
     """
-    if noisy:
-       noisy_file_path = add_noise(data_path)
-       images_filepath = noisy_file_path
-       denoised_outputs_filepath = pathlib.Path(data_path + '/images.h5') 
-        
-    else: 
-        images_filepath = pathlib.Path(data_path + '/images.h5')
-        denoised_outputs_filepath = None 
-
-    masks_filepath = pathlib.Path(data_path + '/masks.h5')
-    bboxes_filepath = pathlib.Path(data_path + '/bboxes.h5')
-    labels_filepath = pathlib.Path(data_path + '/binary.h5')
-
-    # Create loader
-    image_loader = H5ImageLoader(img_file=images_filepath, mask_file=masks_filepath, bbox_file=bboxes_filepath,
-                                 classification_file=labels_filepath, transform=pt_transforms,denoised_file = denoised_outputs_filepath)  # All data paths
-    # Create pytorch loader
-    data_loader = DataLoader(image_loader, batch_size=batch_size, shuffle=True,num_workers=0)
-
-    return data_loader
+    if online_noise:
+        providers = ONLINE_NOISE_PROVIDERS
+    else:
+        providers = noisy_providers(cache) if noisy else DEFAULT_PROVIDERS
+    return load_data.build_data_loader(data_path, pt_transforms=pt_transforms, batch_size=batch_size,
+                                       num_workers=num_workers, prefetch_factor=prefetch_factor, preload=preload,
+                                       mmap=mmap, providers=providers)
 
 
 def take_random_samples(data_loader, n_samples):
@@ -85,14 +226,13 @@ def take_random_samples(data_loader, n_samples):
     return images, labels, segmentations, bboxes
 
 
-class H5ImageLoader(Dataset):
+class H5ImageLoader(MultiTaskDataset):
     """
-    Dataloader containing __len__ & __getitem__ as per
-    Pytorch dataloader specifications
-
+    MultiTaskDataset reading the images (noisy ones when a denoised_file is given, paired with the
+    clean images as target), masks, bounding boxes and classes
     """
 
-    def __init__(self, img_file, mask_file, bbox_file, classification_file, transform,denoised_file):
+    def __init__(self, img_file, mask_file, bbox_file, classification_file, transform,denoised_file, preload=False):
         """
 
         @params:
@@ -102,56 +242,15 @@ class H5ImageLoader(Dataset):
         classification_file(string): Path for classes (0 or 1)
 
         transform(callable): Transform to be applied to the images ## ONLY TRAINING IMAGES, MASKS? ( I DONT THINK SO)
+        denoised_file(string): Path for the clean images used as denoising target, optional
+        preload(bool): Keep the raw arrays in shared memory instead of reading the h5 files every epoch
         """
-
-        self.img_h5 = h5py.File(img_file, 'r')
-        self.dataset_list = list(self.img_h5.keys())[0]
-
-        if denoised_file: 
-            self.create_denoised_set = True
-            self.denoised_h5 = h5py.File(denoised_file, 'r')
-            self.denoised_list = list(self.denoised_h5.keys())[0]
-
-        else: self.create_denoised_set = False
-
-        self.mask_h5 = h5py.File(mask_file, 'r')
-        self.bbox_h5 = h5py.File(bbox_file, 'r')
-        self.classifcation_h5 = h5py.File(classification_file, 'r')
-        self.mask_list = list(self.mask_h5.keys())[0]
-        self.bbox_list = list(self.bbox_h5.keys())[0]
-        self.classification_list = list(self.classifcation_h5.keys())[0]
-
-        self.transform = transform
-
-    def __len__(self):
-        return self.img_h5[list(self.img_h5.keys())[0]].shape[0]
-
-    # return 40
-
-    def __getitem__(self, idx):      
-        
-        image = self.img_h5[self.dataset_list][idx]
-        mask = self.mask_h5[self.mask_list][idx]
-        bbox = self.bbox_h5[self.bbox_list][idx]
-        classification = self.classifcation_h5[self.classification_list][idx]
-
-        if self.transform:
-            #    # mask_transform = transforms.Compose(
-            #      [transforms.ToTensor(),
-            #       transforms.Resize((64,64))])
-            image = self.transform(image).to(
-                torch.float32)  # float32 for pytorch compatibility (weights initialized to the same)
-
-            # mask= mask_transform(mask)
-        labels_dict = {'mask': mask, 'bbox': bbox, 'classification': classification}
-        if self.create_denoised_set:
-            denoised = self.denoised_h5[self.denoised_list][idx]
-            if self.transform:
-                denoised = self.transform(denoised).to(
-                    torch.float32)
-            labels_dict['denoised'] = denoised
-
-        return image,labels_dict
-
-
-
+        # Files are opened lazily so that every DataLoader worker gets its own handles
+        if denoised_file:
+            files = LazyH5Files(noisy_data=img_file, images=denoised_file, masks=mask_file, bboxes=bbox_file,
+                                binary=classification_file)
+            providers = [NOISY, MASK, BBOX, CLASSIFICATION]
+        else:
+            files = LazyH5Files(images=img_file, masks=mask_file, bboxes=bbox_file, binary=classification_file)
+            providers = DEFAULT_PROVIDERS
+        super().__init__(files, providers=providers, transform=transform, preload=preload)
@@ -0,0 +1,135 @@
+import os
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from load_data import normalise_batch, collate_batch, Batch
+from lab_loader import rgb_to_lab
+from letterbox import letterbox, reduction_factor
+
+# Files read as images when a folder is walked
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def list_images(source):
+    """A function for listing the images to read, from a folder or from a file list.
+
+    Args:
+        source (path): Folder walked recursively for the files with one of IMAGE_EXTENSIONS, or a text
+        file holding one image path per line (relative paths are taken from the folder of the list).
+
+    Returns:
+        paths (list): Paths of the images, sorted when a folder is walked.
+    """
+    if os.path.isdir(source):
+        return sorted(os.path.join(folder, name) for folder, _, names in os.walk(source) for name in names
+                      if name.lower().endswith(IMAGE_EXTENSIONS))
+    with open(source) as file:
+        return [os.path.join(os.path.dirname(source), line.strip()) for line in file if line.strip()]
+
+
+def decode_image(path, size=256, mode='letterbox'):
+    """A function for decoding an image file into a uint8 RGB array, shrunk for the input size of the networks.
+
+    Large images are shrunk by the integer factor of letterbox.reduction_factor by averaging blocks
+    of pixels, so they are not aliased when letterbox resamples them to the input size, and the
+    canvas of a mini-batch stays small. opencv releases the GIL while it decodes and resizes, so the
+    images of a mini-batch are decoded in parallel by the threads of ImageFolderLoader.
+
+    Args:
+        path (path): JPEG, PNG or any other format opencv reads.
+        size (int, optional): Height and width of the network input. Defaults to 256.
+        mode (string, optional): One of letterbox.RESIZE_MODES. Defaults to 'letterbox'.
+
+    Returns:
+        image (numpy array): uint8 image of shape (height, width, 3), at most twice as large as its fitted copy.
+        original_size (tuple): (height, width) of the file.
+    """
+    image = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f'{path} is not an image opencv can read')
+    height, width = image.shape[:2]
+    factor = reduction_factor(height, width, size, mode)
+    if factor > 1:
+        image = cv2.resize(image, (max(1, width // factor), max(1, height // factor)), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), (height, width)
+
+
+class ImageFolderLoader:
+    """
+    Data loader reading a folder (or a list) of image files of any size instead of the h5 files of a
+    split, for predicting on images as they arrive. Mini-batches are decoded by a pool of threads,
+    prefetch of them ahead of the one returned, and collated into the raw load_data.Batch of the h5
+    loaders: 'image' holds the uint8 RGB images channels last, top left in a canvas as large as the
+    largest of them (fitted to the networks and normalised on the device, see prepare_images), 'index'
+    the position of every image in paths, the 'size' extra its original (height, width) and the
+    'extent' extra its (height, width) in the canvas.
+    """
+
+    def __init__(self, source, batch_size=16, size=256, num_threads=None, prefetch=2, mode='letterbox'):
+        """
+        @params:
+        source(path or list): Folder or file list read by list_images, or a list of image paths
+        batch_size(int): Size of the mini-batches
+        size(int): Height and width of the network input the images are fitted to
+        num_threads(int): Threads decoding the images. Defaults to the number of cores
+        prefetch(int): Mini-batches decoded ahead of the one returned
+        mode(string): How the images are fitted to the network input, one of letterbox.RESIZE_MODES
+        """
+        self.paths = list(source) if isinstance(source, (list, tuple)) else list_images(source)
+        self.batch_size = batch_size
+        self.size = size
+        self.mode = mode
+        self.num_threads = num_threads or os.cpu_count()
+        self.prefetch = max(1, prefetch)
+
+    def __len__(self):
+        return (len(self.paths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=self.num_threads) as pool:
+            pending = collections.deque()
+            for start in range(0, len(self.paths), self.batch_size):
+                paths = self.paths[start:start + self.batch_size]
+                pending.append((start, [pool.submit(decode_image, path, self.size, self.mode) for path in paths]))
+                if len(pending) > self.prefetch:
+                    yield self.collate(*pending.popleft())
+            while pending:
+                yield self.collate(*pending.popleft())
+
+    def collate(self, start, decoded):
+        """Returns the Batch of the images decoded by the futures of decoded, the first of which is paths[start]."""
+        images, sizes = zip(*[future.result() for future in decoded])
+        extents = np.array([image.shape[:2] for image in images], dtype=np.int64)
+        canvas = np.zeros((len(images),) + tuple(extents.max(axis=0)) + (3,), dtype=np.uint8)
+        for i, (image, (height, width)) in enumerate(zip(images, extents)):
+            canvas[i, :height, :width] = image
+        return collate_batch({'image': canvas, 'index': np.arange(start, start + len(images)),
+                              'size': np.array(sizes, dtype=np.int64), 'extent': extents})
+
+
+def prepare_images(batch_data, device, lab=False, rescale=None, size=256, mode='letterbox'):
+    """A function used for moving a mini-batch of decoded images to the device, fitting them to the networks
+    and normalising them.
+
+    Args:
+        batch_data (Batch): Raw images, as returned by ImageFolderLoader.
+        device (string): the device the model runs on (cpu or cuda).
+        lab (bool, optional): Feed the L channel of the images, for the colourisation models. Defaults to False.
+        rescale (bool, optional): Passed to normalise_batch, False for the denoising models which are trained on
+        images normalised from 0-255 (see train_denoising.prepare_batch). Defaults to None.
+        size (int, optional): Height and width of the network input. Defaults to 256.
+        mode (string, optional): One of letterbox.RESIZE_MODES, as given to the ImageFolderLoader. Defaults to
+        'letterbox'.
+
+    Returns:
+        inputs, batch (tensor, Batch): Normalised network inputs and the mini-batch on the device, its images
+        fitted to the network and the 'transform' extra holding their transforms (see letterbox.letterbox_transforms).
+    """
+    batch = batch_data.to(device, non_blocking=True)
+    images, transforms = letterbox(batch.image, batch.extras['extent'], batch.extras['size'], size, mode)
+    batch = Batch(**dict(batch.fields(), image=images, transform=transforms))
+    if lab:
+        # Lab values are normalised from 0-255, as in train_color.prepare_batch
+        return normalise_batch(rgb_to_lab(batch.image)[..., 0:1], rescale=False), batch
+    return normalise_batch(batch.image, rescale=rescale), batch
@@ -0,0 +1,197 @@
+import os
+import fcntl
+import argparse
+import h5py
+import numpy as np
+from mmap_cache import H5_FILES
+from repack_h5 import PACKED_FILE
+
+# Lock file inside a split folder, held by the single writer appending to it
+LOCK_FILE = '.ingest.lock'
+
+
+def split_files(data_path):
+    """Returns the names of the h5 files present in a split folder, without extension."""
+    return [name for name in H5_FILES if os.path.isfile(os.path.join(data_path, name + '.h5'))]
+
+
+def first_dataset(h5_file):
+    """Returns the first dataset of an h5 file, the one the loaders read."""
+    return h5_file[list(h5_file.keys())[0]]
+
+
+def is_appendable(filepath):
+    """Returns True when the first dataset of filepath can grow along the sample axis under a SWMR writer."""
+    with h5py.File(filepath, 'r', locking=False) as h5_file:
+        dataset = first_dataset(h5_file)
+        # SWMR writers need the version 3 superblock of the latest file format
+        superblock = h5_file.id.get_create_plist().get_version()[0]
+        return superblock >= 3 and dataset.chunks is not None and dataset.maxshape[0] is None
+
+
+def make_appendable(data_path, chunk_rows=16, chunk_bytes=64 * 2 ** 20):
+    """A function for rewriting the h5 files of a split so that ingest can append samples to them.
+
+    The first dataset of every file becomes chunked and unlimited along the sample axis, in the latest
+    file format that SWMR requires. Its name, dtype, chunks, compression and attributes are kept, and
+    every file is written next to the original and then renamed over it. Runs that opened the old files
+    keep reading them, so the split is converted once before the training runs that follow it start.
+
+    Args:
+        data_path (path): Folder holding the h5 files of the split (ie: 'data/train/').
+        chunk_rows (int, optional): Samples per chunk of the datasets that were not chunked. Defaults to 16.
+        chunk_bytes (int, optional): Approximate number of bytes copied at a time. Defaults to 64MB.
+
+    Returns:
+        converted (list): Names of the files that were rewritten.
+    """
+    converted = []
+    for name in split_files(data_path):
+        filepath = os.path.join(data_path, name + '.h5')
+        if is_appendable(filepath):
+            continue
+        partial_filepath = filepath + '.partial'
+        with h5py.File(filepath, 'r') as source, h5py.File(partial_filepath, 'w', libver='latest') as target:
+            dataset = first_dataset(source)
+            chunks = dataset.chunks or (max(1, min(chunk_rows, dataset.shape[0])),) + dataset.shape[1:]
+            appendable = target.create_dataset(dataset.name, shape=dataset.shape, dtype=dataset.dtype, chunks=chunks,
+                                               maxshape=(None,) + dataset.shape[1:], compression=dataset.compression,
+                                               compression_opts=dataset.compression_opts, shuffle=dataset.shuffle)
+            appendable.attrs.update(dataset.attrs)
+            target.attrs.update(source.attrs)
+
+            row_bytes = max(1, dataset.dtype.itemsize * int(np.prod(dataset.shape[1:])))
+            rows = max(chunks[0], chunk_bytes // row_bytes // chunks[0] * chunks[0])
+            for start in range(0, dataset.shape[0], rows):
+                appendable[start:start + rows] = dataset[start:start + rows]
+        os.replace(partial_filepath, filepath)
+        converted.append(name)
+        print(f'{filepath}: {dataset.shape} {dataset.dtype} chunks {chunks} appendable')
+    return converted
+
+
+def open_writer(filepath):
+    """Opens filepath as the SWMR writer, readers opened with swmr=True and locking=False keep reading it."""
+    h5_file = h5py.File(filepath, 'a', libver='latest')
+    h5_file.swmr_mode = True
+    return h5_file
+
+
+def repair(data_path, names):
+    """A function for undoing an append that was interrupted part way through the files of a split.
+
+    Readers only count a sample once every file holds it (see MultiTaskDataset.refresh), so the rows
+    a longer file has past the shortest one were never read and are dropped.
+
+    Args:
+        data_path (path): Folder holding the h5 files of the split.
+        names (list): Names of the files appended to together.
+
+    Returns:
+        num_samples (int): Number of samples held by every file.
+    """
+    lengths = {}
+    for name in names:
+        with h5py.File(os.path.join(data_path, name + '.h5'), 'r', locking=False) as h5_file:
+            lengths[name] = first_dataset(h5_file).shape[0]
+    num_samples = min(lengths.values())
+    for name, length in lengths.items():
+        if length > num_samples:
+            with open_writer(os.path.join(data_path, name + '.h5')) as h5_file:
+                dataset = first_dataset(h5_file)
+                dataset.resize(num_samples, axis=0)
+                dataset.flush()
+            print(f'{name}: dropped {length - num_samples} samples of an interrupted append')
+    return num_samples
+
+
+def ingest(data_path, new_path, chunk_bytes=64 * 2 ** 20):
+    """A function for appending the samples of a folder of h5 files to the files of a split.
+
+    new_path holds one h5 file per split file to append to (ie: images.h5, masks.h5, bboxes.h5 and
+    binary.h5), named as in the split, with the new samples in their first dataset. The files are
+    appended one after the other as the SWMR writer, each block resized, written and flushed. The
+    new samples appear to the readers once the last file is flushed, as they only count the samples
+    every file holds, so training runs reading the split with swmr pick them up at their next epoch.
+
+    A lock file in the split keeps a single writer at a time, and an append that was interrupted is
+    undone first (see repair).
+
+    Args:
+        data_path (path): Split folder the samples are appended to (ie: 'data/train/'), converted by make_appendable.
+        new_path (path): Folder holding the h5 files of the new samples.
+        chunk_bytes (int, optional): Approximate number of bytes appended at a time. Defaults to 64MB.
+
+    Returns:
+        num_samples (int): Number of samples of the split after the append.
+    """
+    if os.path.isfile(os.path.join(data_path, PACKED_FILE)):
+        raise ValueError(f'{data_path} is read from {PACKED_FILE}, which ingest does not append to')
+    names = split_files(data_path)
+    new_names = split_files(new_path)
+    if not new_names:
+        raise FileNotFoundError(f'{new_path} holds none of the h5 files {H5_FILES}')
+    missing = [name for name in new_names if name not in names]
+    if missing:
+        raise ValueError(f'{data_path} has no {missing} files to append to')
+    not_appendable = [name for name in new_names if not is_appendable(os.path.join(data_path, name + '.h5'))]
+    if not_appendable:
+        raise ValueError(f'{not_appendable} of {data_path} cannot grow, convert them first with '
+                         f"'python ingest.py {data_path} -c y'")
+
+    with h5py.File(os.path.join(new_path, new_names[0] + '.h5'), 'r') as h5_file:
+        n_new = first_dataset(h5_file).shape[0]
+    for name in new_names:
+        with h5py.File(os.path.join(new_path, name + '.h5'), 'r') as new, \
+                h5py.File(os.path.join(data_path, name + '.h5'), 'r', locking=False) as old:
+            new_dataset, old_dataset = first_dataset(new), first_dataset(old)
+            if new_dataset.shape[0] != n_new:
+                raise ValueError(f'{new_path}: {name} holds {new_dataset.shape[0]} samples, {new_names[0]} {n_new}')
+            if new_dataset.shape[1:] != old_dataset.shape[1:]:
+                raise ValueError(f'{name}: samples of shape {new_dataset.shape[1:]} cannot be appended to samples '
+                                 f'of shape {old_dataset.shape[1:]}')
+
+    with open(os.path.join(data_path, LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        num_samples = repair(data_path, new_names)
+        for name in new_names:
+            with h5py.File(os.path.join(new_path, name + '.h5'), 'r') as new, \
+                    open_writer(os.path.join(data_path, name + '.h5')) as h5_file:
+                new_dataset, dataset = first_dataset(new), first_dataset(h5_file)
+                row_bytes = max(1, dataset.dtype.itemsize * int(np.prod(dataset.shape[1:])))
+                rows = max(1, chunk_bytes // row_bytes)
+                for start in range(0, n_new, rows):
+                    block = new_dataset[start:start + rows]
+                    dataset.resize(num_samples + start + len(block), axis=0)
+                    dataset[num_samples + start:num_samples + start + len(block)] = block
+                    dataset.flush()
+
+    lagging = [name for name in names if name not in new_names]
+    if lagging:
+        print(f'{data_path}: {lagging} were not appended to, runs reading them do not see the new samples '
+              f'until they are computed again')
+    print(f'{data_path}: appended {n_new} samples to {new_names}, {num_samples + n_new} samples')
+    return num_samples + n_new
+
+
+def process_args():
+    """A function used to append new samples to a split from the terminal.
+
+    Returns:
+        Interprets the arguments added to the argument parser object during the running of the script.
+    """
+    ap = argparse.ArgumentParser(description="Append new samples to the h5 files of a split, as the SWMR writer")
+    ap.add_argument('split', help='split folder the samples are appended to (ie: data/train/)')
+    ap.add_argument('new', nargs='?', help='folder holding the h5 files of the new samples', default=None)
+    ap.add_argument("-c", '--convert', help='rewrite the files of the split so that they can grow (y/n)',
+                    default='n')
+    ap.add_argument("-cr", '--chunk_rows', help='samples per chunk of the files that were not chunked', default=16)
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_args()
+    if args.convert == 'y':
+        make_appendable(args.split, chunk_rows=int(args.chunk_rows))
+    if args.new is not None:
+        ingest(args.split, args.new)
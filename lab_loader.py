@@ -1,114 +1,149 @@
-import h5py
 import torch
-from torch.utils import data
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as transforms
-import pathlib
-import matplotlib.pyplot as plt
-import cv2
 import os
 import numpy as np
+import precompute_targets
+import load_data
+from load_data import LazyH5Files, MultiTaskDataset, TargetProvider, MASK, BBOX, CLASSIFICATION
+from target_cache import CachedTarget
+
+# Fixed point precisions of opencv's 8 bit RGB to Lab conversion
+GAMMA_SHIFT, LAB_SHIFT, LAB_SHIFT2 = 3, 12, 15
+# sRGB to XYZ matrix, with the X and Z rows divided by the D65 white point
+RGB2XYZ_D65 = np.array([[0.412453, 0.357580, 0.180423],
+                        [0.212671, 0.715160, 0.072169],
+                        [0.019334, 0.119193, 0.950227]]) / np.array([[0.950456], [1.], [1.088754]])
 
 
 def rgb2lab(img_path,destination_path):
     """A function used to convert the rgb colour space images to the 
     lab colour space, where l is the lightness channel, a is the red green-channel and 
     b is the blue-yellow channel.
+    The images are converted in chunks by precompute_targets.py into a uint8 file. The colourisation
+    loaders no longer need it, they convert images.h5 a batch at a time with rgb_to_lab.
 
     Args:
         img_path (path): file path of the images to be converted.
         destination_path (path): file of the where converted images should be transfered.
     """
 
-    hf=h5py.File(os.path.join(destination_path,'Labimages.h5'), 'w')
-    
-    imgs = h5py.File(img_path, 'r')
+    precompute_targets.precompute_target('Labimages', img_path, os.path.join(destination_path, 'Labimages.h5'))
+
 
-    dataset_list = list(imgs.keys())[0]
+def lab_tables():
+    """A function for building the lookup tables and coefficients of opencv's 8 bit RGB to Lab conversion.
 
-    numpy_array=np.array(imgs[dataset_list]).astype(np.uint8)
+    The tables are rounded in the same precision as opencv's, so rgb_to_lab matches cv2.cvtColor exactly.
 
+    Returns:
+        gamma (tensor): Linear RGB of every 8 bit sRGB value, scaled by 2 ** GAMMA_SHIFT.
+        cbrt (tensor): The Lab f(t) function of every scaled X, Y or Z value, scaled by 2 ** LAB_SHIFT2.
+        coefficients (tensor): RGB2XYZ_D65 scaled by 2 ** LAB_SHIFT.
+    """
+    x = np.arange(256) / 255.
+    gamma = np.where(x <= 0.04045, x / 12.92, ((x + 0.055) / 1.055) ** 2.4)
+    gamma = np.rint(gamma * 255 * 2 ** GAMMA_SHIFT)
 
-    hf.create_dataset("Lab_img",
-                 shape=numpy_array.shape)
-               
-        
-    for idx,img in enumerate(numpy_array):
+    x = np.arange(255 * 3 // 2 * 2 ** GAMMA_SHIFT) / (255. * 2 ** GAMMA_SHIFT)
+    cbrt = np.where(x < 0.008856, x * 7.787 + 16. / 116., np.cbrt(x)).astype(np.float32)
+    cbrt = np.rint(cbrt * np.float32(2 ** LAB_SHIFT2))
 
-        hf['Lab_img'][idx,...] = cv2.cvtColor(img,cv2.COLOR_RGB2LAB)
+    coefficients = np.rint(RGB2XYZ_D65 * 2 ** LAB_SHIFT)
+    return (torch.from_numpy(gamma.astype(np.int64)), torch.from_numpy(cbrt.astype(np.int64)),
+            torch.from_numpy(coefficients.astype(np.int64)))
 
 
-    hf.close()
+GAMMA_TABLE, CBRT_TABLE, XYZ_COEFFICIENTS = lab_tables()
 
-class H5LabImageLoader(Dataset):
-    """
-    Dataloader containing __len__ & __getitem__ as per
-    Pytorch dataloader specifications
+
+def descale(value, shift):
+    """Divides a fixed point tensor by 2 ** shift, rounding half up."""
+    return (value + (1 << (shift - 1))) >> shift
+
+
+def rgb_to_lab(images):
+    """A function for converting a batch of RGB images to the 8 bit Lab colour space of opencv.
+
+    Same result as cv2.cvtColor(image, cv2.COLOR_RGB2LAB) on every image, computed for the
+    whole batch at once with integer lookups on the device of the images.
+
+    Args:
+        images (tensor): uint8 images of shape (..., 3), channels last.
+
+    Returns:
+        lab_images (tensor): uint8 images of the same shape, L scaled to 0-255 and a, b offset by 128.
     """
+    device = images.device
+    linear = GAMMA_TABLE.to(device)[images.long()]
+    xyz = descale((linear.unsqueeze(-2) * XYZ_COEFFICIENTS.to(device)).sum(-1), LAB_SHIFT)
+    f_x, f_y, f_z = CBRT_TABLE.to(device)[xyz].unbind(-1)
 
-    def __init__(self, img_path_lab,mask_file, bbox_file, classification_file, transform):
-        """
-        @params:
-    
-        img_lab_path(string): Path for Lab images
-        mask_file(string): Path for corresponding masks
-        bbox_file(string): Path for bounding boxes
-        classification_file(string): Path for classes (0 or 1)
-        transform(callable): Transform to be applied to the images ## ONLY TRAINING IMAGES, MASKS? ( I DONT THINK SO)
-        """
-       
+    lightness = descale((116 * 255 + 50) // 100 * f_y - (16 * 255 * 2 ** LAB_SHIFT2 + 50) // 100, LAB_SHIFT2)
+    a = descale(500 * (f_x - f_y) + 128 * 2 ** LAB_SHIFT2, LAB_SHIFT2)
+    b = descale(200 * (f_y - f_z) + 128 * 2 ** LAB_SHIFT2, LAB_SHIFT2)
+    return torch.stack([lightness, a, b], dim=-1).clamp(0, 255).to(torch.uint8)
 
 
-        self.mask_h5 = h5py.File(mask_file, 'r')
-        self.bbox_h5 = h5py.File(bbox_file, 'r')
-        self.classifcation_h5 = h5py.File(classification_file, 'r')
+class LabTarget(TargetProvider):
+    """
+    Provides the L channel of the images as the input of the network and their ab channels as the
+    colourisation target. The RGB images are read from images.h5 and converted to Lab a batch at a time.
+    """
 
+    def __init__(self):
+        super().__init__('ab', 'images', image=True)
 
+    def read(self, dataset, indices):
+        lab_image = rgb_to_lab(torch.from_numpy(np.asarray(dataset.read_field(self.filenames[0], indices)))).numpy()
+        # Raw images keep their channels last, the batch is normalised on the device
+        return {'image': lab_image[..., 0:1], 'ab': lab_image[..., 1:3]}
 
-        self.mask_list = list(self.mask_h5.keys())[0]
-        self.bbox_list = list(self.bbox_h5.keys())[0]
-        self.classification_list = list(self.classifcation_h5.keys())[0]
 
-        self.lab = h5py.File(img_path_lab, 'r')
-        self.lab_list=list(self.lab.keys())[0]
-        
+LAB = LabTarget()
 
-        self.transform = transform
 
-    def __len__(self):
-       return self.lab[list(self.lab.keys())[0]].shape[0]
-       #return 10
+class CachedLabTarget(CachedTarget):
+    """
+    Provides the L input and ab target like LabTarget, with the Lab images memoised in a TargetCache
+    instead of being converted on every read.
+    """
 
-    def __getitem__(self, idx):
+    def __init__(self, cache):
+        super().__init__('ab', 'Labimages', cache, image=True)
 
-    
-        mask = self.mask_h5[self.mask_list][idx]
-        bbox = self.bbox_h5[self.bbox_list][idx]
-        classification = self.classifcation_h5[self.classification_list][idx]
+    def labels(self, images, lab_images):
+        return {'image': lab_images[..., 0:1], 'ab': lab_images[..., 1:3]}
 
-        lab_image=self.lab[self.lab_list][idx]
 
+def lab_providers(cache=None):
+    """Returns the providers of the colourisation loaders, memoising the Lab images in cache when given."""
+    return [CachedLabTarget(cache) if cache is not None else LAB, MASK, BBOX, CLASSIFICATION]
 
-      
-        if self.transform:
-        #    # mask_transform = transforms.Compose(
-        #      [transforms.ToTensor(),
-        #       transforms.Resize((64,64))]) 
-            lab_image = self.transform(lab_image).to(
-                torch.float32)  # float32 for pytorch compatibility (weights initialized to the same)
-            
-        L=lab_image[0,:,:]
-        L=L[None,:]
-        ab=lab_image[1:3,:,:]
-        
 
-            #mask= mask_transform(mask)
+class H5LabImageLoader(MultiTaskDataset):
+    """
+    MultiTaskDataset reading the L input and ab target of the Lab images, with the masks,
+    bounding boxes and classes
+    """
 
-        
+    def __init__(self, img_file, mask_file, bbox_file, classification_file, transform, preload=False):
+        """
+        @params:
+    
+        img_file(string): Path for the RGB images, converted to Lab when read
+        mask_file(string): Path for corresponding masks
+        bbox_file(string): Path for bounding boxes
+        classification_file(string): Path for classes (0 or 1)
+        transform(callable): Transform to be applied to the L and ab channels, which are returned raw and channels
+        last without one
+        preload(bool): Keep the raw arrays in shared memory instead of reading the h5 files every epoch
+        """
+        # Files are opened lazily so that every DataLoader worker gets its own handles
+        files = LazyH5Files(images=img_file, masks=mask_file, bboxes=bbox_file, binary=classification_file)
+        super().__init__(files, providers=[LAB, MASK, BBOX, CLASSIFICATION], transform=transform, preload=preload)
 
-        return L, {'mask': mask, 'bbox': bbox, 'classification': classification,'ab':ab}
 
-def create_data_loaders(train_path, validation_path, test_path, batch_size=16):
+def create_data_loaders(train_path, validation_path, test_path, batch_size=16, num_workers=0, prefetch_factor=2,
+                        preload=False, mmap=False, cache=None):
     """A function for creating pytorch training, validation and testing dataloader objects.
 
     Args:
@@ -116,57 +151,42 @@ def create_data_loaders(train_path, validation_path, test_path, batch_size=16):
         validation_path (path): The path for the validation data.
         test_path (path): The path for the testing data.
         batch_size (int, optional): Size of the batch. Defaults to 16.
-        noisy (bool, optional): Boolean for addition of noise. Defaults to False.
+        num_workers (int, optional): Number of DataLoader worker processes. Defaults to 0.
+        prefetch_factor (int, optional): Batches loaded in advance by each worker. Defaults to 2.
+        preload (bool, optional): Load every split into shared memory once instead of reading the
+        h5 files every epoch. Defaults to False.
+        mmap (bool, optional): Read the memory mapped copy of every split written by mmap_cache.py.
+        Defaults to False.
+        cache (TargetCache, optional): Memoise the Lab images in this cache. Defaults to None.
 
     Returns:
         train_loader, val_loader, test_loader are the torch.DataLoader() objects for their respective datasets;
         training, validation and testing sets.
     """
-    # Train data
-    train_transform = transforms.Compose(
-        [transforms.ToTensor(),
-         transforms.Normalize((127.5, 127.5, 127.5), (127.5, 127.5, 127.5)),
-        ])
-    train_loader = build_data_loader(data_path=train_path, pt_transforms=train_transform, batch_size=batch_size)
-    # Validation data
-    validation_transform = train_transform
-    validation_loader = build_data_loader(data_path=validation_path, pt_transforms=validation_transform,
-                                          batch_size=batch_size)
-    # Test data
-    test_transform = transforms.Compose(
-        [transforms.ToTensor(),
-         transforms.Normalize((127.5, 127.5, 127.5), (127.5, 127.5, 127.5)),
-         ])
-    test_loader = build_data_loader(data_path=test_path, pt_transforms=test_transform, batch_size=batch_size)
-
-    return train_loader, validation_loader, test_loader
-
-
-def build_data_loader(data_path, pt_transforms, batch_size=16):
+    return load_data.create_data_loaders(train_path, validation_path, test_path, batch_size=batch_size,
+                                         num_workers=num_workers, prefetch_factor=prefetch_factor, preload=preload,
+                                         mmap=mmap, providers=lab_providers(cache))
+
+
+def build_data_loader(data_path, pt_transforms=None, batch_size=16, num_workers=0, prefetch_factor=2, preload=False,
+                      mmap=False, cache=None):
     """A function used for creating a single data loader.
 
     Args:
         data_path (path): Path used to access the data.
-        pt_transforms (pytorch object): Pytorch transforms to be applied onto the dataset, contained
-        as a list inside a pytorch transforms object. 
+        pt_transforms (pytorch object, optional): Pytorch transforms to be applied onto the dataset, contained
+        as a list inside a pytorch transforms object. Defaults to None, which keeps the raw (height, width,
+        channels) Lab images.
         batch_size (int, optional): Size of the batch. Defaults to 16.
-        noisy (bool, optional): Boolean for addition of noise. Defaults to False.
+        num_workers (int, optional): Number of DataLoader worker processes. Defaults to 0.
+        prefetch_factor (int, optional): Batches loaded in advance by each worker. Defaults to 2.
+        preload (bool, optional): Load the split into shared memory once. Defaults to False.
+        mmap (bool, optional): Read the memory mapped copy in the 'mmap' folder of data_path. Defaults to False.
+        cache (TargetCache, optional): Memoise the Lab images in this cache. Defaults to None.
 
     Returns:
         data_loader (pytorch object): DataLoader object for a specific dataset.
     """
-    # Define paths
-    images_filepath = pathlib.Path(data_path + '/Labimages.h5')
-    masks_filepath = pathlib.Path(data_path + '/masks.h5')
-    bboxes_filepath = pathlib.Path(data_path + '/bboxes.h5')
-    labels_filepath = pathlib.Path(data_path + '/binary.h5')
-
-    # Create loader
-    image_loader = H5LabImageLoader(img_path_lab=images_filepath, mask_file=masks_filepath, bbox_file=bboxes_filepath,
-                                 classification_file=labels_filepath, transform=pt_transforms)  # All data paths
-    # Create pytorch loader
-    data_loader = DataLoader(image_loader, batch_size=batch_size, shuffle=True)
-
-    return data_loader
-
-
+    return load_data.build_data_loader(data_path, pt_transforms=pt_transforms, batch_size=batch_size,
+                                       num_workers=num_workers, prefetch_factor=prefetch_factor, preload=preload,
+                                       mmap=mmap, providers=lab_providers(cache))
@@ -0,0 +1,142 @@
+import torch
+import torch.nn.functional as F
+from augment import resample, cast
+
+# How images of any size are fitted to the square input of the networks: 'letterbox' scales them to fit and
+# pads the rest, keeping their aspect ratio, 'resize' stretches them to the input size
+RESIZE_MODES = ['letterbox', 'resize']
+
+
+def reduction_factor(height, width, size=256, mode='letterbox'):
+    """Returns the integer factor an image can be shrunk by and still be at least as large as its fitted copy."""
+    if mode not in RESIZE_MODES:
+        raise ValueError(f'mode must be one of {RESIZE_MODES}, got {mode}')
+    if mode == 'letterbox':
+        return max(1, max(height, width) // size)
+    return max(1, min(height, width) // size)
+
+
+def letterbox_transforms(sizes, size=256, mode='letterbox'):
+    """A function for computing how a mini-batch of images of any size is fitted to the input of the networks.
+
+    Pixel edges x, y of an image become x * scale_x + offset_x, y * scale_y + offset_y in the network input.
+
+    Args:
+        sizes (tensor): Original (height, width) of every image, of shape (batch, 2).
+        size (int, optional): Height and width of the network input. Defaults to 256.
+        mode (string, optional): One of RESIZE_MODES. Defaults to 'letterbox'.
+
+    Returns:
+        transforms (tensor): float32 (scale_x, scale_y, offset_x, offset_y) of every image, of shape (batch, 4).
+    """
+    if mode not in RESIZE_MODES:
+        raise ValueError(f'mode must be one of {RESIZE_MODES}, got {mode}')
+    heights, widths = sizes.float().unbind(dim=1)
+    if mode == 'letterbox':
+        scale = size / torch.maximum(heights, widths)
+        return torch.stack([scale, scale, (size - widths * scale) / 2, (size - heights * scale) / 2], dim=1)
+    return torch.stack([size / widths, size / heights, torch.zeros_like(widths), torch.zeros_like(heights)], dim=1)
+
+
+def letterbox(images, extents, sizes, size=256, mode='letterbox', fill=0):
+    """A function for fitting a mini-batch of images of any size to the input of the networks, in one resampling.
+
+    The images are stored top left in a padded canvas, possibly shrunk by an integer factor when they
+    were decoded (see reduction_factor). A sampling grid is built for every image from its transform,
+    and the whole mini-batch is resampled with a single grid_sample call, as in augment.BatchAugment.
+
+    Args:
+        images (tensor): Canvas of shape (batch, canvas height, canvas width, channels), values 0-255.
+        extents (tensor): (height, width) of every image in the canvas, of shape (batch, 2).
+        sizes (tensor): Original (height, width) of every image, the transforms are computed from, of shape (batch, 2).
+        size (int, optional): Height and width of the network input. Defaults to 256.
+        mode (string, optional): One of RESIZE_MODES. Defaults to 'letterbox'.
+        fill (int, optional): Value of the padding around the letterboxed images. Defaults to 0.
+
+    Returns:
+        images (tensor): Images of shape (batch, size, size, channels), of the dtype of the canvas.
+        transforms (tensor): Transform of every image, see letterbox_transforms.
+    """
+    n_samples, canvas_height, canvas_width, _ = images.shape
+    transforms = letterbox_transforms(sizes, size, mode).to(images.device)
+    scale_x, scale_y, offset_x, offset_y = transforms.unbind(dim=1)
+    heights, widths = sizes.to(images.device).float().unbind(dim=1)
+    extent_heights, extent_widths = extents.to(images.device).float().unbind(dim=1)
+
+    # Centres of the output pixels, back to the original image and to the canvas, clamped to the image pixels
+    centres = torch.arange(size, device=images.device, dtype=torch.float32) + 0.5
+    xs = (centres[None] - offset_x[:, None]) / scale_x[:, None]
+    ys = (centres[None] - offset_y[:, None]) / scale_y[:, None]
+    inside = (((xs >= 0) & (xs <= widths[:, None]))[:, None, :] & ((ys >= 0) & (ys <= heights[:, None]))[:, :, None])
+    xs = (xs * (extent_widths / widths)[:, None]).clamp(min=0.5).minimum(extent_widths[:, None] - 0.5)
+    ys = (ys * (extent_heights / heights)[:, None]).clamp(min=0.5).minimum(extent_heights[:, None] - 0.5)
+    grid = torch.stack([(xs / canvas_width * 2 - 1)[:, None, :].expand(n_samples, size, size),
+                        (ys / canvas_height * 2 - 1)[:, :, None].expand(n_samples, size, size)], dim=-1)
+
+    fitted = resample(images, grid, 'bilinear')
+    fitted = torch.where(inside[..., None], fitted, torch.full_like(fitted, fill))
+    return cast(fitted, images.dtype), transforms
+
+
+def project_boxes(boxes, transforms, sizes, box_format='xyxy'):
+    """A function for moving the bounding boxes predicted on the network input back to the original images.
+
+    Args:
+        boxes (tensor): Boxes of shape (batch, 4), in pixels of the network input.
+        transforms (tensor): Transform of every image, see letterbox_transforms.
+        sizes (tensor): Original (height, width) of every image, of shape (batch, 2).
+        box_format (string, optional): 'xyxy' for (x_min, y_min, x_max, y_max) or 'xywh' for
+        (x_min, y_min, width, height). Defaults to 'xyxy'.
+
+    Returns:
+        boxes (tensor): float32 boxes in pixels of the original images, clipped to them.
+    """
+    transforms = transforms.to(boxes.device)
+    heights, widths = sizes.to(boxes.device).float().unbind(dim=1)
+    x_min, y_min, x_max, y_max = boxes.float().unbind(dim=1)
+    if box_format == 'xywh':
+        x_max, y_max = x_min + x_max, y_min + y_max
+
+    xs = (torch.stack([x_min, x_max], dim=1) - transforms[:, 2:3]) / transforms[:, 0:1]
+    ys = (torch.stack([y_min, y_max], dim=1) - transforms[:, 3:4]) / transforms[:, 1:2]
+    xs = xs.clamp(min=0).minimum(widths[:, None])
+    ys = ys.clamp(min=0).minimum(heights[:, None])
+    x_min, x_max = xs.unbind(dim=1)
+    y_min, y_max = ys.unbind(dim=1)
+
+    if box_format == 'xywh':
+        x_max, y_max = x_max - x_min, y_max - y_min
+    return torch.stack([x_min, y_min, x_max, y_max], dim=1)
+
+
+def project_masks(segmask, transforms, sizes):
+    """A function for resampling the predicted segmentations back to the original images, in one grid_sample call.
+
+    The logits are interpolated bilinearly at the centre of every pixel of the original images and
+    the class of every pixel is the largest one, so the masks are not blocky when upscaled.
+
+    Args:
+        segmask (tensor): Segmentation logits of shape (batch, classes, size, size).
+        transforms (tensor): Transform of every image, see letterbox_transforms.
+        sizes (tensor): Original (height, width) of every image, of shape (batch, 2).
+
+    Returns:
+        masks (tensor): uint8 classes of shape (batch, largest height, largest width). The mask of
+        image i is masks[i, :height, :width], the pixels past it are 0.
+    """
+    n_samples, _, height, width = segmask.shape
+    transforms = transforms.to(segmask.device)
+    sizes = sizes.to(segmask.device)
+    max_height, max_width = int(sizes[:, 0].max()), int(sizes[:, 1].max())
+
+    xs = torch.arange(max_width, device=segmask.device, dtype=torch.float32) + 0.5
+    ys = torch.arange(max_height, device=segmask.device, dtype=torch.float32) + 0.5
+    us = (xs[None] * transforms[:, 0:1] + transforms[:, 2:3]) / width * 2 - 1
+    vs = (ys[None] * transforms[:, 1:2] + transforms[:, 3:4]) / height * 2 - 1
+    grid = torch.stack([us[:, None, :].expand(n_samples, max_height, max_width),
+                        vs[:, :, None].expand(n_samples, max_height, max_width)], dim=-1)
+
+    logits = F.grid_sample(segmask.float(), grid, mode='bilinear', padding_mode='border', align_corners=False)
+    masks = torch.argmax(logits, 1).to(torch.uint8)
+    inside = (xs[None, None, :] < sizes[:, 1, None, None]) & (ys[None, :, None] < sizes[:, 0, None, None])
+    return masks * inside
@@ -1,11 +1,21 @@
+import os
+import json
 import h5py
+import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as transforms
+from torch.utils.data import Dataset, DataLoader, Sampler, get_worker_info
 import pathlib
+from mmap_cache import MemmapFiles
+from shm_server import SharedMemoryFiles
+import repack_h5
 
+# Samples of a split the loaders skip, written by dedup.py
+EXCLUDE_FILE = 'exclude.json'
 
-def create_data_loaders(train_path, validation_path, test_path, batch_size=16):
+
+def create_data_loaders(train_path, validation_path, test_path, batch_size=16, num_workers=0, prefetch_factor=2,
+                        preload=False, mmap=False, providers=None, seed=0, block_shuffle=False, block_window=4,
+                        shm=False, swmr=False, exclude=True):
     """A function for creating pytorch training, validation and testing dataloader objects.
 
     Args:
@@ -13,60 +23,604 @@ def create_data_loaders(train_path, validation_path, test_path, batch_size=16):
         validation_path (path): The path for the validation data.
         test_path (path): The path for the testing data.
         batch_size (int, optional): Size of the batch. Defaults to 16.
-        noisy (bool, optional): Boolean for addition of noise. Defaults to False.
+        num_workers (int, optional): Number of DataLoader worker processes. Defaults to 0.
+        prefetch_factor (int, optional): Batches loaded in advance by each worker. Defaults to 2.
+        preload (bool, optional): Load every split into shared memory once instead of reading the
+        h5 files every epoch. Defaults to False.
+        mmap (bool, optional): Read the memory mapped copy of every split written by mmap_cache.py.
+        Defaults to False.
+        providers (list, optional): TargetProvider objects for the input and the targets to read.
+        Defaults to the images, masks, bounding boxes and classes.
+        seed (int, optional): Seed of the training shuffle, combined with the epoch. Defaults to 0.
+        block_shuffle (bool, optional): Shuffle the training data by h5 chunks (see BlockShuffleSampler).
+        Defaults to False.
+        block_window (int, optional): Chunks whose samples are mixed together by the block shuffle. Defaults to 4.
+        shm (bool, optional): Read every split from the shared memory of shm_server.py. Defaults to False.
+        swmr (bool, optional): Open the h5 files as SWMR readers, so that the training split picks up the samples
+        appended by ingest.py at the start of every epoch. Defaults to False.
+        exclude (bool, optional): Skip the near-duplicates dedup.py listed in every split. Defaults to True.
 
     Returns:
         train_loader, val_loader, test_loader are the torch.DataLoader() objects for their respective datasets;
         training, validation and testing sets.
     """
+    # The loaders emit raw (e.g. uint8) batches, which the training loops normalise on the device (see normalise_batch)
     # Train data
-    train_transform = transforms.Compose(
-        [transforms.ToTensor(),
-         transforms.Normalize((127.5, 127.5, 127.5), (127.5, 127.5, 127.5)),
-         ])
-    train_loader = build_data_loader(data_path=train_path, pt_transforms=train_transform, batch_size=batch_size)
+    train_loader = build_data_loader(data_path=train_path, batch_size=batch_size, num_workers=num_workers,
+                                     prefetch_factor=prefetch_factor, preload=preload, mmap=mmap,
+                                     providers=providers, seed=seed, block_shuffle=block_shuffle,
+                                     block_window=block_window, shm=shm, swmr=swmr, exclude=exclude)
     # Validation data
-    validation_transform = train_transform
-    validation_loader = build_data_loader(data_path=validation_path, pt_transforms=validation_transform,
-                                          batch_size=batch_size)
+    validation_loader = build_data_loader(data_path=validation_path, batch_size=batch_size, shuffle=False,
+                                          num_workers=num_workers, prefetch_factor=prefetch_factor, preload=preload,
+                                          mmap=mmap, providers=providers, shm=shm, swmr=swmr, exclude=exclude)
     # Test data
-    test_transform = transforms.Compose(
-        [transforms.ToTensor(),
-         transforms.Normalize((127.5, 127.5, 127.5), (127.5, 127.5, 127.5)),
-         ])
-    test_loader = build_data_loader(data_path=test_path, pt_transforms=test_transform, batch_size=batch_size)
+    test_loader = build_data_loader(data_path=test_path, batch_size=batch_size, shuffle=False,
+                                    num_workers=num_workers, prefetch_factor=prefetch_factor, preload=preload,
+                                    mmap=mmap, providers=providers, shm=shm, swmr=swmr, exclude=exclude)
 
     return train_loader, validation_loader, test_loader
 
 
-def build_data_loader(data_path, pt_transforms, batch_size=16):
+def build_data_loader(data_path, pt_transforms=None, batch_size=16, shuffle=True, num_workers=0, prefetch_factor=2,
+                      preload=False, mmap=False, providers=None, seed=0, block_shuffle=False, block_window=4,
+                      shm=False, swmr=False, exclude=True):
     """A function used for creating a single data loader.
 
+    Whole mini-batches are read from the h5 files at once (see H5BatchSampler), so the
+    DataLoader is built without automatic batching.
+
     Args:
         data_path (path): Path used to access the data.
-        pt_transforms (pytorch object): Pytorch transforms to be applied onto the dataset, contained
-        as a list inside a pytorch transforms object. 
+        pt_transforms (pytorch object, optional): Pytorch transforms to be applied onto the dataset, contained
+        as a list inside a pytorch transforms object. Defaults to None, which keeps the raw images so the
+        batch can be normalised on the device with normalise_batch.
         batch_size (int, optional): Size of the batch. Defaults to 16.
-        noisy (bool, optional): Boolean for addition of noise. Defaults to False.
+        shuffle (bool, optional): Shuffle the samples every epoch, otherwise the data is read in order.
+        Defaults to True.
+        num_workers (int, optional): Number of DataLoader worker processes. Defaults to 0.
+        prefetch_factor (int, optional): Batches loaded in advance by each worker. Defaults to 2.
+        preload (bool, optional): Load the split into shared memory once. Defaults to False.
+        mmap (bool, optional): Read the memory mapped copy in the 'mmap' folder of data_path. Defaults to False.
+        providers (list, optional): TargetProvider objects for the input and the targets to read, only their
+        files are opened. Defaults to the images, masks, bounding boxes and classes.
+        seed (int, optional): Seed of the shuffle, combined with the epoch. Defaults to 0.
+        block_shuffle (bool, optional): Shuffle whole h5 chunks and then the samples within a window of chunks,
+        instead of every sample, so a mini-batch only reads a few chunks (see BlockShuffleSampler).
+        Defaults to False.
+        block_window (int, optional): Chunks whose samples are mixed together by the block shuffle. Defaults to 4.
+        shm (bool, optional): Read the split from the shared memory of shm_server.py, shared by every run on the
+        host. Defaults to False.
+        swmr (bool, optional): Open the h5 files as SWMR readers, which see the samples appended by ingest.py
+        once the dataset is refreshed (see set_epoch). Defaults to False.
+        exclude (bool, optional): Skip the samples listed in the EXCLUDE_FILE of data_path by dedup.py, if any.
+        Defaults to True.
 
     Returns:
         data_loader (pytorch object): DataLoader object for a specific dataset.
     """
-    # Define paths
-    images_filepath = pathlib.Path(data_path + '/images.h5')
-    masks_filepath = pathlib.Path(data_path + '/masks.h5')
-    bboxes_filepath = pathlib.Path(data_path + '/bboxes.h5')
-    labels_filepath = pathlib.Path(data_path + '/binary.h5')
+    providers = providers or DEFAULT_PROVIDERS
+    if sum([preload, mmap, shm]) > 1:
+        raise ValueError('preload, mmap and shm are alternatives, choose one of them')
+    if swmr and (preload or mmap or shm):
+        raise ValueError('swmr reads the h5 files as they grow, it cannot be combined with preload, mmap or shm')
 
     # Create loader
-    image_loader = H5ImageLoader(img_file=images_filepath, mask_file=masks_filepath, bbox_file=bboxes_filepath,
-                                 classification_file=labels_filepath, transform=pt_transforms)  # All data paths
-    # Create pytorch loader
-    data_loader = DataLoader(image_loader, batch_size=batch_size, shuffle=True)
+    for provider in providers:
+        provider.prepare(data_path)
+    names = [name for provider in providers for name in provider.filenames]
+    files = open_split(data_path, names, mmap=mmap, shm=shm, swmr=swmr)
+    image_loader = MultiTaskDataset(files=files, providers=providers, transform=pt_transforms, preload=preload)
+    excluded = read_exclusions(data_path, len(image_loader)) if exclude else None
+    # Create pytorch loader, the sampler hands out a whole mini-batch of indices at a time
+    if shuffle and block_shuffle:
+        layout = image_loader.chunk_layout()
+        # Blocks follow the chunks of the input file, unchunked files are read in blocks of a mini-batch
+        block_size = layout[names[0]][0] if layout[names[0]][0] > 1 else batch_size
+        batch_sampler = BlockShuffleSampler(num_samples=len(image_loader), batch_size=batch_size,
+                                            block_size=block_size, window_blocks=block_window, seed=seed,
+                                            exclude=excluded)
+        random_sampler = H5BatchSampler(num_samples=len(image_loader), batch_size=batch_size, seed=seed,
+                                        exclude=excluded)
+        print(f"{data_path}: block shuffle of {block_size} samples, windows of {block_window} blocks, "
+              f"{batch_sampler.bytes_per_sample(layout) / 2 ** 20:.3f} MB read per sample against "
+              f"{random_sampler.bytes_per_sample(layout) / 2 ** 20:.3f} MB for a full shuffle")
+    else:
+        batch_sampler = H5BatchSampler(num_samples=len(image_loader), batch_size=batch_size, shuffle=shuffle,
+                                       seed=seed, exclude=excluded)
+    data_loader = DataLoader(image_loader, sampler=batch_sampler, batch_size=None,
+                             **worker_options(num_workers, prefetch_factor))
 
     return data_loader
 
 
+def read_exclusions(data_path, num_samples=None):
+    """A function for reading the indices of the samples of a split that the loaders skip.
+
+    Args:
+        data_path (path): Folder holding the h5 files of the split (ie: 'data/train/').
+        num_samples (int, optional): Number of samples of the split, to report those that dedup.py has not
+        seen yet. Defaults to None.
+
+    Returns:
+        excluded (list): Indices of the excluded samples, empty when the split has no EXCLUDE_FILE.
+    """
+    exclude_filepath = os.path.join(data_path, EXCLUDE_FILE)
+    if not os.path.isfile(exclude_filepath):
+        return []
+    with open(exclude_filepath) as file:
+        exclusions = json.load(file)
+    print(f"{data_path}: skipping {len(exclusions['excluded'])} near-duplicates of {exclusions['num_samples']} "
+          f"samples")
+    if num_samples is not None and num_samples != exclusions['num_samples']:
+        print(f"{data_path}: holds {num_samples} samples, run dedup.py again to deduplicate them all")
+    return exclusions['excluded']
+
+
+def open_split(data_path, names, mmap=False, shm=False, swmr=False):
+    """A function for opening the files of a split that are needed, keyed by file name (ie: 'masks').
+
+    Args:
+        data_path (path): Folder holding the h5 files of the split (ie: 'data/train/').
+        names (list): Names of the h5 files to open, without extension.
+        mmap (bool, optional): Open the memory mapped copy written by mmap_cache.py. Defaults to False.
+        shm (bool, optional): Attach to the shared memory of shm_server.py. Defaults to False.
+        swmr (bool, optional): Open the h5 files as SWMR readers without file locking, so that ingest.py can
+        append to them meanwhile. Defaults to False.
+
+    Returns:
+        files (LazyH5Files, MemmapFiles or SharedMemoryFiles): The files, opened on first access.
+    """
+    if shm:
+        return SharedMemoryFiles(data_path, **{name: name for name in names})
+    if mmap:
+        return MemmapFiles(pathlib.Path(data_path + '/mmap'), **{name: name for name in names})
+
+    paths = {name: pathlib.Path(data_path + '/' + name + '.h5') for name in names}
+    h5_options = None
+
+    # A split consolidated by repack_h5.py is read from its single file, as long as it matches the files of the
+    # split. SWMR readers follow the files ingest.py appends to, which packed.h5 does not
+    packed_filepath = pathlib.Path(data_path + '/' + repack_h5.PACKED_FILE)
+    if packed_filepath.is_file() and not swmr:
+        current, stale = repack_h5.current_datasets(packed_filepath, data_path)
+        packed_names = [name for name in names if name in current]
+        stale_names = [name for name in names if name in stale]
+        if stale_names:
+            print(f'{data_path}: {stale_names} changed since {repack_h5.PACKED_FILE} was written, reading the h5 '
+                  f'files instead (run repack_h5.py again)')
+        if packed_names:
+            print(f'{data_path}: reading {packed_names} from {repack_h5.PACKED_FILE}')
+            paths.update({name: (packed_filepath, name) for name in packed_names})
+            h5_options = repack_h5.cache_options(packed_filepath)
+    if swmr:
+        # A reader holding the default HDF5 file lock would keep the ingest writer out
+        h5_options = dict(h5_options or {}, swmr=True, locking=False)
+
+    return LazyH5Files(h5_options=h5_options, **paths)
+
+
+def worker_options(num_workers=0, prefetch_factor=2):
+    """A function for building the DataLoader arguments that control the worker processes.
+
+    Workers are kept alive between epochs so that each one only opens its h5 files once.
+
+    Args:
+        num_workers (int, optional): Number of worker processes, 0 loads in the main process. Defaults to 0.
+        prefetch_factor (int, optional): Batches loaded in advance by each worker. Defaults to 2.
+
+    Returns:
+        options (dict): Keyword arguments for torch.utils.data.DataLoader.
+    """
+    if num_workers == 0:
+        return {'num_workers': 0}
+    return {'num_workers': num_workers, 'prefetch_factor': prefetch_factor, 'persistent_workers': True,
+            'worker_init_fn': worker_init_fn}
+
+
+def worker_init_fn(worker_id):
+    """A function run at the start of every DataLoader worker.
+
+    Drops any h5 handles the dataset inherited from the parent process, so the worker
+    opens its own on first access.
+
+    Args:
+        worker_id (int): Id of the worker, supplied by the DataLoader.
+    """
+    dataset = get_worker_info().dataset
+    if hasattr(dataset, 'close'):
+        dataset.close()
+
+
+class LazyH5Files:
+    """
+    Collection of h5 files that are only opened on first access, once per process.
+    h5py handles must not be shared across fork(), so a handle opened in the parent
+    is never reused by a DataLoader worker and pickling drops the open handles.
+
+    The files can also be preloaded into shared memory tensors, which every worker
+    then reads from without copying.
+
+    Several names may point into the same file (ie: a file written by repack_h5.py),
+    in which case the file is opened once.
+    """
+
+    def __init__(self, h5_options=None, **paths):
+        """
+        @params:
+        h5_options(dict): Extra arguments for h5py.File, such as the rdcc chunk cache settings
+        paths(dict): Name of each file mapped to its path, or to a (path, dataset name) pair
+        when the file holds more than one dataset. None entries are skipped
+        """
+        paths = {name: path if isinstance(path, tuple) else (path, None)
+                 for name, path in paths.items() if path is not None}
+        self.paths = {name: path for name, (path, key) in paths.items()}
+        self.keys = {name: key for name, (path, key) in paths.items() if key is not None}
+        self.h5_options = h5_options or {}
+        self.handles = {}
+        self.pid = None
+        self.preloaded = {}
+
+    def __getitem__(self, name):
+        if self.pid != os.getpid():
+            self.handles = {}
+            self.pid = os.getpid()
+        path = str(self.paths[name])
+        if path not in self.handles:
+            self.handles[path] = h5py.File(path, 'r', **self.h5_options)
+        return self.handles[path]
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    @property
+    def swmr(self):
+        """True when the files are opened as SWMR readers, whose datasets can grow."""
+        return bool(self.h5_options.get('swmr'))
+
+    def path(self, name):
+        """Returns the path of the file holding name."""
+        return str(self.paths[name])
+
+    def source(self, name):
+        """Returns the path of the h5 file of the split name comes from, even when it is read from packed.h5."""
+        source = os.path.join(os.path.dirname(self.path(name)), name + '.h5')
+        return source if os.path.isfile(source) else self.path(name)
+
+    def first_key(self, name):
+        """Returns the name of the dataset given for the file, otherwise of its first dataset."""
+        if name in self.keys:
+            return self.keys[name]
+        return list(self[name].keys())[0]
+
+    def dataset(self, name, key):
+        """Returns dataset key of file name, as a numpy view of the shared tensor if it was preloaded."""
+        if name in self.preloaded:
+            return self.preloaded[name].numpy()
+        return self[name][key]
+
+    def preload(self):
+        """Loads the first dataset of every file into a shared memory tensor, keeping its dtype."""
+        for name in self.paths:
+            dataset = self[name][self.first_key(name)]
+            dtype = torch.from_numpy(np.empty(0, dtype=dataset.dtype)).dtype
+            tensor = torch.empty(dataset.shape, dtype=dtype).share_memory_()
+            dataset.read_direct(tensor.numpy())
+            self.preloaded[name] = tensor
+
+    def close(self):
+        """Closes the handles opened by this process and forgets any inherited ones."""
+        if self.pid == os.getpid():
+            for handle in self.handles.values():
+                handle.close()
+        self.handles = {}
+        self.pid = None
+
+    def __getstate__(self):
+        return {'paths': self.paths, 'keys': self.keys, 'h5_options': self.h5_options, 'handles': {}, 'pid': None,
+                'preloaded': self.preloaded}
+
+
+def normalise_batch(images, rescale=None):
+    """A function for turning a batch of HWC images into normalised network inputs in one step.
+
+    Gives the same result as applying transforms.ToTensor() followed by
+    transforms.Normalize((127.5, 127.5, 127.5), (127.5, 127.5, 127.5)) to every image.
+
+    Args:
+        images (tensor): Batch of images of shape (batch, height, width, channels).
+        rescale (bool, optional): Divide by 255 before normalising. Defaults to None, which
+        follows ToTensor and only rescales uint8 images.
+
+    Returns:
+        images (tensor): float32 batch of shape (batch, channels, height, width).
+    """
+    if rescale is None:
+        rescale = images.dtype == torch.uint8
+    images = images.permute(0, 3, 1, 2).to(torch.float32, memory_format=torch.contiguous_format)
+    if rescale:
+        images = images / 255
+    return (images - 127.5) / 127.5
+
+
+# dtype and number of dimensions (batch axis included) the labels are collated to, the ones used by the losses
+FIELD_TYPES = {'mask': (torch.long, 3), 'canny': (torch.long, 3), 'bbox': (torch.float32, 2),
+               'classification': (torch.long, 1), 'index': (torch.long, 1)}
+
+
+class Batch:
+    """
+    Mini-batch of a multi-task dataset, one tensor per field with a leading batch axis and None for
+    the fields that are not read. Built by collate_batch, so the masks, canny edge maps, classes and
+    sample indices are long and the bounding boxes float32, ready for the losses.
+
+    The input images keep the dtype of their file (normalised on the device by normalise_batch), and
+    labels without a field of their own (ie: the 'lab' and 'noisy' shard fields) are kept in extras.
+    """
+
+    __slots__ = ('image', 'mask', 'bbox', 'classification', 'canny', 'ab', 'denoised', 'index', 'extras')
+
+    def __init__(self, **fields):
+        """
+        @params:
+        fields(tensor): Fields of the mini-batch keyed by label (ie: image=images, mask=masks)
+        """
+        for label in self.__slots__[:-1]:
+            setattr(self, label, fields.pop(label, None))
+        self.extras = fields
+
+    def __len__(self):
+        return len(self.image)
+
+    def fields(self):
+        """Returns the fields that are set, extras included, keyed by label."""
+        fields = {label: getattr(self, label) for label in self.__slots__[:-1] if getattr(self, label) is not None}
+        fields.update(self.extras)
+        return fields
+
+    def to(self, device, non_blocking=False):
+        """Returns a Batch with every field moved to device."""
+        return Batch(**{label: field.to(device, non_blocking=non_blocking) for label, field in self.fields().items()})
+
+
+def collate_batch(fields):
+    """A function for collating the fields of a mini-batch into a Batch.
+
+    Every label of FIELD_TYPES is copied once into a preallocated tensor of its dtype, dropping the
+    trailing axes of size one (ie: masks of shape (batch, height, width, 1)) but never the batch axis.
+    The other fields are wrapped without copying.
+
+    Args:
+        fields (dict): numpy arrays or tensors of the mini-batch keyed by label, 'image' included.
+
+    Returns:
+        batch (Batch): The typed mini-batch.
+    """
+    batch = {}
+    for label, field in fields.items():
+        array = field.numpy() if isinstance(field, torch.Tensor) else np.asarray(field)
+        if label in FIELD_TYPES:
+            dtype, dims = FIELD_TYPES[label]
+            typed = torch.empty(array.shape[:dims], dtype=dtype)
+            typed.numpy()[...] = array.reshape(typed.shape)
+            batch[label] = typed
+        else:
+            batch[label] = field if isinstance(field, torch.Tensor) else torch.from_numpy(array)
+    return Batch(**batch)
+
+
+def read_rows(dataset, indices):
+    """A function for reading a set of rows from a h5py dataset with a single selection.
+
+    Contiguous indices are read as one slice. Any other set of indices is read as one sorted,
+    de-duplicated selection (as h5py requires) and then put back into the requested order.
+
+    Args:
+        dataset (h5py dataset): Dataset to read from, indexed along the first axis. Preloaded numpy
+        arrays are indexed directly.
+        indices (list): Row indices to read.
+
+    Returns:
+        rows (numpy array): The requested rows, stacked along the first axis.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    start = int(indices[0])
+    if np.array_equal(indices, np.arange(start, start + len(indices))):
+        return dataset[start:start + len(indices)]
+    if isinstance(dataset, np.ndarray):
+        return dataset[indices]
+
+    unique, inverse = np.unique(indices, return_inverse=True)
+    rows = dataset[unique]
+    if len(unique) == len(indices) and np.array_equal(unique, indices):
+        return rows
+    return rows[inverse]
+
+
+class H5BatchSampler(Sampler):
+    """
+    Sampler yielding a whole mini-batch of indices at a time, sorted so that
+    H5ImageLoader can fetch the batch with one h5py read per file.
+    Without shuffling the batches are contiguous blocks, which are read as plain slices.
+
+    The permutation of an epoch is drawn from (seed, epoch), so an interrupted run can be resumed
+    at the first batch it did not train on with set_epoch(epoch, start_batch). Each pass otherwise
+    advances the epoch by one.
+
+    Excluded samples (ie: the near-duplicates found by dedup.py) are never visited.
+    """
+
+    def __init__(self, num_samples, batch_size, shuffle=True, drop_last=False, seed=0, exclude=None):
+        """
+        @params:
+        num_samples(int): Number of samples in the dataset
+        batch_size(int): Size of the mini-batches
+        shuffle(bool): Draw a new random permutation every epoch
+        drop_last(bool): Drop the last incomplete mini-batch
+        seed(int): Seed of the permutations, combined with the epoch
+        exclude(list): Indices of the samples that are skipped, see read_exclusions
+        """
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.exclude = np.asarray(exclude if exclude is not None else [], dtype=np.int64)
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch, start_batch=0):
+        """Sets the epoch of the next pass, which starts at batch start_batch of that epoch."""
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def samples(self):
+        """Returns the indices visited every epoch, in increasing order."""
+        samples = np.arange(self.num_samples)
+        if len(self.exclude):
+            samples = samples[~np.isin(samples, self.exclude)]
+        return samples
+
+    def order(self, epoch):
+        """Returns the order the samples are visited in during epoch."""
+        if self.shuffle:
+            return np.random.default_rng([self.seed, epoch]).permutation(self.samples()).tolist()
+        return self.samples().tolist()
+
+    def batches(self, epoch):
+        """Returns every mini-batch of epoch, in order."""
+        order = self.order(epoch)
+        starts = range(0, len(order), self.batch_size)
+        batches = [sorted(order[start:start + self.batch_size]) for start in starts]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+    def __iter__(self):
+        epoch, start_batch = self.epoch, self.start_batch
+        self.set_epoch(epoch + 1)
+        yield from self.batches(epoch)[start_batch:]
+
+    def __len__(self):
+        num_samples = len(self.samples())
+        if self.drop_last:
+            return num_samples // self.batch_size - self.start_batch
+        return (num_samples + self.batch_size - 1) // self.batch_size - self.start_batch
+
+    def bytes_per_sample(self, layout, epoch=0):
+        """A function for estimating how many bytes are read per sample during an epoch.
+
+        Every mini-batch is assumed to read each chunk it touches once, and nothing is kept between
+        mini-batches, which is what happens when h5py's chunk cache is smaller than a mini-batch.
+
+        Args:
+            layout (dict): (rows per chunk, bytes per row) of every file read, see MultiTaskDataset.chunk_layout.
+            epoch (int, optional): Epoch whose mini-batches are measured. Defaults to 0.
+
+        Returns:
+            bytes_per_sample (float): Bytes read from the files per sample trained on.
+        """
+        batches = self.batches(epoch)
+        n_bytes = 0
+        for batch in batches:
+            for chunk_rows, row_bytes in layout.values():
+                n_bytes += len({index // chunk_rows for index in batch}) * chunk_rows * row_bytes
+        return n_bytes / max(1, sum(len(batch) for batch in batches))
+
+
+class BlockShuffleSampler(H5BatchSampler):
+    """
+    H5BatchSampler shuffling blocks of consecutive samples instead of single samples, so that a
+    mini-batch reads a few whole h5 chunks rather than one sample out of many chunks.
+
+    The order of the blocks is shuffled first, then the samples are shuffled within windows of
+    window_blocks consecutive blocks of that order. A mini-batch therefore mixes samples of
+    window_blocks random parts of the split, and the order changes every epoch.
+    """
+
+    def __init__(self, num_samples, batch_size, block_size=16, window_blocks=4, drop_last=False, seed=0,
+                 exclude=None):
+        """
+        @params:
+        num_samples(int): Number of samples in the dataset
+        batch_size(int): Size of the mini-batches
+        block_size(int): Samples per block, ideally the rows per chunk of the h5 files
+        window_blocks(int): Number of blocks whose samples are shuffled together
+        drop_last(bool): Drop the last incomplete mini-batch
+        seed(int): Seed of the shuffle, combined with the epoch
+        exclude(list): Indices of the samples that are skipped, see read_exclusions
+        """
+        super().__init__(num_samples, batch_size, shuffle=True, drop_last=drop_last, seed=seed, exclude=exclude)
+        self.block_size = max(1, block_size)
+        self.window_blocks = max(1, window_blocks)
+
+    def order(self, epoch):
+        rng = np.random.default_rng([self.seed, epoch])
+        samples = self.samples()
+        # Blocks follow the chunks, so a block holding excluded samples is shorter
+        blocks = np.split(samples, np.flatnonzero(np.diff(samples // self.block_size)) + 1) if len(samples) else []
+        order = [int(index) for block in rng.permutation(len(blocks)) for index in blocks[block]]
+
+        window = self.block_size * self.window_blocks
+        for start in range(0, len(order), window):
+            order[start:start + window] = rng.permutation(order[start:start + window]).tolist()
+        return order
+
+
+def set_epoch(data_loader, epoch, start_batch=0):
+    """A function for choosing the epoch, and the batch within it, of the next pass over a data loader.
+
+    Args:
+        data_loader (pytorch object): Data loader built by build_data_loader or shard_loader.
+        epoch (int): Epoch of the next pass, which seeds its shuffle.
+        start_batch (int, optional): Batches of the epoch skipped, the ones already trained on. Defaults to 0.
+        Streamed shards cannot skip batches and restart the epoch from its beginning.
+
+    A dataset opened with swmr is refreshed first, so the epoch also visits the samples appended since the last one.
+    """
+    if hasattr(data_loader.dataset, 'refresh') and hasattr(data_loader.sampler, 'num_samples'):
+        data_loader.sampler.num_samples = data_loader.dataset.refresh()
+    if hasattr(data_loader.sampler, 'set_epoch'):
+        data_loader.sampler.set_epoch(epoch, start_batch)
+    elif hasattr(data_loader.dataset, 'set_epoch'):
+        data_loader.dataset.set_epoch(epoch)
+
+
+class TargetProvider:
+    """
+    One field of a multi-task sample: the h5 file it is read from and the label it is returned under.
+    The input of the network is provided the same way, under the label 'image'.
+
+    Providers deriving their labels differently (ie: the L and ab channels of a Lab image) subclass
+    this and override read, see lab_loader.LabTarget, denoising_loader.NoisyTarget and data_loader_canny.
+    """
+
+    def __init__(self, label, filename, image=False):
+        """
+        @params:
+        label(string): Name the field is returned under (ie: 'mask')
+        filename(string): Name of the h5 file without extension (ie: 'masks')
+        image(bool): The field is an image, so the transforms of the dataset apply to it
+        """
+        self.label = label
+        self.filenames = [filename]
+        self.image = image
+
+    def prepare(self, data_path):
+        """Called once for every split before its files are opened, to create any missing file."""
+
+    def read(self, dataset, indices):
+        """Returns the labels of the samples at indices (a single index or a mini-batch), as numpy arrays."""
+        return {self.label: dataset.read_field(self.filenames[0], indices)}
+
+
+IMAGE = TargetProvider('image', 'images', image=True)
+MASK = TargetProvider('mask', 'masks')
+BBOX = TargetProvider('bbox', 'bboxes')
+CLASSIFICATION = TargetProvider('classification', 'binary')
+DEFAULT_PROVIDERS = [IMAGE, MASK, BBOX, CLASSIFICATION]
+
+
 def take_random_samples(data_loader, n_samples):
     images = 1
     labels = 2
@@ -75,52 +629,184 @@ def take_random_samples(data_loader, n_samples):
     return images, labels, segmentations, bboxes
 
 
-class H5ImageLoader(Dataset):
+class MultiTaskDataset(Dataset):
     """
     Dataloader containing __len__ & __getitem__ as per
     Pytorch dataloader specifications
 
+    The fields of every sample are read by a list of TargetProvider objects, so only the files
+    the chosen model needs are ever opened (ie: Segnet-1task never reads the bounding boxes). A file
+    read by several providers (ie: the images and the canny edge maps cached from them) is read once
+    per sample or mini-batch.
     """
 
-    def __init__(self, img_file, mask_file, bbox_file, classification_file, transform):
-        """
+    # Rows of the files already read for the sample or mini-batch being read, keyed by file name
+    rows = None
 
+    def __init__(self, files, providers=None, transform=None, batch_transform=None, preload=False):
+        """
         @params:
-        img_file(string): Path for images
-        mask_file(string): Path for corresponding masks
-        bbox_file(string): Path for bounding boxes
-        classification_file(string): Path for classes (0 or 1)
-
-        transform(callable): Transform to be applied to the images ## ONLY TRAINING IMAGES, MASKS? ( I DONT THINK SO)
+        files(LazyH5Files, MemmapFiles or SharedMemoryFiles): Files of the split keyed by file name, see open_split
+        providers(list): TargetProvider objects, one of them provides the 'image' input
+        transform(callable): Transform to be applied to the image fields of a single sample
+        batch_transform(callable): Transform applied to the whole (batch, height, width, channels) image
+        fields when a mini-batch is requested, used instead of transform (see normalise_batch)
+        preload(bool): Keep the raw (e.g. uint8) arrays in shared memory, only converting to float per batch
         """
-
-        self.img_h5 = h5py.File(img_file, 'r')
-        self.mask_h5 = h5py.File(mask_file, 'r')
-        self.bbox_h5 = h5py.File(bbox_file, 'r')
-        self.classifcation_h5 = h5py.File(classification_file, 'r')
-
-        self.dataset_list = list(self.img_h5.keys())[0]
-        self.mask_list = list(self.mask_h5.keys())[0]
-        self.bbox_list = list(self.bbox_h5.keys())[0]
-        self.classification_list = list(self.classifcation_h5.keys())[0]
+        self.h5 = files
+        self.providers = providers or DEFAULT_PROVIDERS
+        self.keys = {name: self.h5.first_key(name) for provider in self.providers for name in provider.filenames}
+        first_file = self.providers[0].filenames[0]
+        self.num_samples = self.h5.dataset(first_file, self.keys[first_file]).shape[0]
+        self.refresh()
+        if preload:
+            self.h5.preload()
+        self.h5.close()
 
         self.transform = transform
+        self.batch_transform = batch_transform
 
     def __len__(self):
-      return self.img_h5[list(self.img_h5.keys())[0]].shape[0]
+        return self.num_samples
 
-        #return 10
+    def close(self):
+        """Closes the h5 files, they are reopened on the next access."""
+        self.h5.close()
+
+    def refresh(self):
+        """A function for picking up the samples appended to SWMR files since they were opened (see ingest.py).
+
+        A sample only counts once every file read holds it, so a sample ingest.py is still appending is never
+        read. Files that are not opened as SWMR readers are taken not to grow.
+
+        Returns:
+            num_samples (int): Number of samples of the dataset.
+        """
+        if getattr(self.h5, 'swmr', False):
+            lengths = []
+            for name, key in self.keys.items():
+                dataset = self.h5.dataset(name, key)
+                dataset.refresh()
+                lengths.append(dataset.shape[0])
+            self.num_samples = min(lengths)
+            # The handles of the main process must not be inherited by the DataLoader workers
+            self.h5.close()
+        return self.num_samples
+
+    def chunk_layout(self):
+        """Returns the (rows per chunk, bytes per row) of every file read, with 1 row per chunk when unchunked."""
+        layout = {}
+        for name, key in self.keys.items():
+            dataset = self.h5.dataset(name, key)
+            chunks = getattr(dataset, 'chunks', None)
+            layout[name] = (chunks[0] if chunks else 1, dataset.dtype.itemsize * int(np.prod(dataset.shape[1:])))
+        self.h5.close()
+        return layout
+
+    def read_field(self, name, indices):
+        """Reads file name at a single index, or at a whole mini-batch of indices with one selection."""
+        if self.rows is not None and name in self.rows:
+            return self.rows[name]
+        dataset = self.h5.dataset(name, self.keys[name])
+        if getattr(self.h5, 'swmr', False) and np.max(indices) >= dataset.shape[0]:
+            # Samples appended after this process opened the file, only its metadata is read again
+            dataset.refresh()
+        if isinstance(indices, (list, tuple, range, np.ndarray)):
+            rows = read_rows(dataset, indices)
+        else:
+            rows = dataset[indices]
+        if self.rows is not None:
+            self.rows[name] = rows
+        return rows
+
+    def read_providers(self, indices):
+        """Returns the fields every provider reads at indices, reading each file once."""
+        self.rows = {}
+        try:
+            return [(provider, provider.read(self, indices)) for provider in self.providers]
+        finally:
+            self.rows = None
 
     def __getitem__(self, idx):
-        image = self.img_h5[self.dataset_list][idx]
-        mask = self.mask_h5[self.mask_list][idx]
-        bbox = self.bbox_h5[self.bbox_list][idx]
-        classification = self.classifcation_h5[self.classification_list][idx]
+        if isinstance(idx, (list, tuple, range, np.ndarray)):
+            return self.get_batch(idx)
+
+        labels = {}
+        for provider, fields in self.read_providers(idx):
+            if provider.image and self.transform:
+                fields = {label: self.transform(field).to(torch.float32)  # float32 for pytorch compatibility
+                          for label, field in fields.items()}
+            labels.update(fields)
+
+        image = labels.pop('image')
+        return image, labels
 
-        if self.transform:
-            image = self.transform(image).to(
-                torch.float32)  # float32 for pytorch compatibility (weights initialized to the same)
+    def get_batch(self, indices):
+        """Reads a whole mini-batch with one h5py read per file.
+
+        Args:
+            indices (list): Indices of the samples in the mini-batch, ideally sorted.
+
+        Returns:
+            batch (Batch): The fields of __getitem__ stacked with a leading batch dimension, see collate_batch.
+        """
+        labels = {}
+        for provider, fields in self.read_providers(indices):
+            for label, field in fields.items():
+                if provider.image and self.batch_transform:
+                    field = self.batch_transform(torch.from_numpy(field))
+                elif provider.image and self.transform:
+                    field = torch.stack([self.transform(sample) for sample in field]).to(torch.float32)
+                labels[label] = field
 
-        # mask= mask_transform(mask)
+        return collate_batch(labels)
 
-        return image, {'mask': mask, 'bbox': bbox, 'classification': classification}
+
+class H5ImageLoader(MultiTaskDataset):
+    """
+    MultiTaskDataset reading the images, masks, bounding boxes and classes from the given files.
+    """
+
+    def __init__(self, img_file, mask_file, bbox_file, classification_file, transform, batch_transform=None,
+                 preload=False, h5_options=None):
+        """
+
+        @params:
+        img_file(string): Path for images
+        mask_file(string): Path for corresponding masks
+        bbox_file(string): Path for bounding boxes
+        classification_file(string): Path for classes (0 or 1)
+
+        transform(callable): Transform to be applied to the images ## ONLY TRAINING IMAGES, MASKS? ( I DONT THINK SO)
+        batch_transform(callable): Transform applied to a whole (batch, height, width, channels) image
+        tensor when a mini-batch is requested, used instead of transform (see normalise_batch)
+        preload(bool): Keep the raw (e.g. uint8) arrays in shared memory, only converting to float per batch
+        h5_options(dict): Extra arguments for h5py.File, such as the rdcc chunk cache settings
+
+        Each path may also be a (path, dataset name) pair, to read from a single file written by repack_h5.py.
+        """
+        # Files are opened lazily so that every DataLoader worker gets its own handles
+        files = LazyH5Files(h5_options=h5_options, images=img_file, masks=mask_file, bboxes=bbox_file,
+                            binary=classification_file)
+        super().__init__(files, providers=DEFAULT_PROVIDERS, transform=transform, batch_transform=batch_transform,
+                         preload=preload)
+
+
+class MemmapImageLoader(MultiTaskDataset):
+    """
+    MultiTaskDataset serving the uncompressed arrays written by mmap_cache.py through np.memmap.
+    Samples and contiguous mini-batches are views of the mapped files, wrapped by
+    torch.from_numpy without copying, and the page cache is shared by every run on the host.
+    """
+
+    def __init__(self, cache_path, transform, batch_transform=None, providers=None):
+        """
+        @params:
+        cache_path(string): Folder holding the converted split and its manifest
+        transform(callable): Transform to be applied to the images
+        batch_transform(callable): Transform applied to a whole mini-batch of images (see normalise_batch)
+        providers(list): TargetProvider objects, defaults to the images, masks, bounding boxes and classes
+        """
+        providers = providers or DEFAULT_PROVIDERS
+        files = MemmapFiles(cache_path, **{name: name for provider in providers for name in provider.filenames})
+        super().__init__(files, providers=providers, transform=transform, batch_transform=batch_transform)
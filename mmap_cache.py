@@ -0,0 +1,152 @@
+import os
+import json
+import argparse
+import h5py
+import numpy as np
+
+# h5 files of a split that are converted when present, the derived ones are optional.
+H5_FILES = ['images', 'masks', 'bboxes', 'binary', 'canny_filter', 'Labimages', 'noisy_data']
+MANIFEST = 'manifest.json'
+
+
+def convert_split(data_path, cache_path=None, chunk_bytes=64 * 2 ** 20):
+    """A function for converting the h5 files of a split into uncompressed .npy files plus a JSON manifest.
+
+    Each file's first dataset is copied in chunks, so the split never has to fit in memory.
+    Files whose source h5 has not changed since the last conversion are skipped.
+
+    Args:
+        data_path (path): Folder holding the h5 files of the split (ie: 'data/train/').
+        cache_path (path, optional): Folder the .npy files and manifest are written to.
+        Defaults to the 'mmap' folder inside data_path.
+        chunk_bytes (int, optional): Approximate number of bytes copied at a time. Defaults to 64MB.
+
+    Returns:
+        manifest (dict): The manifest that was written.
+    """
+    cache_path = cache_path or os.path.join(data_path, 'mmap')
+    os.makedirs(cache_path, exist_ok=True)
+    manifest = read_manifest(cache_path) if os.path.isfile(os.path.join(cache_path, MANIFEST)) else {}
+
+    for name in H5_FILES:
+        source = os.path.join(data_path, name + '.h5')
+        if not os.path.isfile(source):
+            continue
+        stat = os.stat(source)
+        entry = manifest.get(name)
+        target = os.path.join(cache_path, name + '.npy')
+        if entry and entry['source_size'] == stat.st_size and entry['source_mtime'] == stat.st_mtime \
+                and os.path.isfile(target):
+            print(f'{source} is up to date')
+            continue
+
+        with h5py.File(source, 'r') as h5_file:
+            key = list(h5_file.keys())[0]
+            dataset = h5_file[key]
+            row_bytes = max(1, dataset.dtype.itemsize * int(np.prod(dataset.shape[1:])))
+            rows = max(1, chunk_bytes // row_bytes)
+
+            # Write to a temporary file first so a half written array is never picked up
+            partial = target + '.partial'
+            array = np.lib.format.open_memmap(partial, mode='w+', dtype=dataset.dtype, shape=dataset.shape)
+            for start in range(0, dataset.shape[0], rows):
+                array[start:start + rows] = dataset[start:start + rows]
+            array.flush()
+            del array
+            os.replace(partial, target)
+
+            manifest[name] = {'file': name + '.npy', 'dataset': key, 'dtype': dataset.dtype.str,
+                              'shape': list(dataset.shape), 'source_size': stat.st_size,
+                              'source_mtime': stat.st_mtime}
+        print(f'{source} -> {target}')
+
+    with open(os.path.join(cache_path, MANIFEST + '.partial'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(os.path.join(cache_path, MANIFEST + '.partial'), os.path.join(cache_path, MANIFEST))
+    return manifest
+
+
+def read_manifest(cache_path):
+    """A function for reading the manifest of a converted split.
+
+    Args:
+        cache_path (path): Folder written by convert_split.
+
+    Returns:
+        manifest (dict): h5 file name (without extension) mapped to the array it was converted into.
+    """
+    with open(os.path.join(cache_path, MANIFEST)) as file:
+        return json.load(file)
+
+
+class MemmapFiles:
+    """
+    Read-only view of a split converted by convert_split, with the same interface as
+    load_data.LazyH5Files. Arrays are memory mapped copy-on-write, so the pages live in the
+    shared page cache of the host and torch.from_numpy can wrap them without copying.
+    """
+
+    def __init__(self, cache_path, **names):
+        """
+        @params:
+        cache_path(string): Folder written by convert_split
+        names(dict): Field name mapped to the h5 file name it was converted from (ie: img='images')
+        """
+        self.cache_path = cache_path
+        self.manifest = read_manifest(cache_path)
+        missing = [source for source in names.values() if source not in self.manifest]
+        if missing:
+            raise FileNotFoundError(f'{missing} not converted in {cache_path}, run mmap_cache.py first')
+        self.names = names
+        self.arrays = {}
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            entry = self.manifest[self.names[name]]
+            self.arrays[name] = np.load(os.path.join(self.cache_path, entry['file']), mmap_mode='c')
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def path(self, name):
+        """Returns the path of the .npy file of field name."""
+        return os.path.join(self.cache_path, self.manifest[self.names[name]]['file'])
+
+    def source(self, name):
+        """Returns the path of the h5 file field name was converted from, the .npy file once it is removed."""
+        source = os.path.join(os.path.dirname(self.cache_path), self.names[name] + '.h5')
+        return source if os.path.isfile(source) else self.path(name)
+
+    def first_key(self, name):
+        """Returns the name of the h5 dataset the array was converted from."""
+        return self.manifest[self.names[name]]['dataset']
+
+    def dataset(self, name, key):
+        """Returns the memory mapped array of field name."""
+        return self[name]
+
+    def close(self):
+        """Drops the memory maps, they are remapped on the next access."""
+        self.arrays = {}
+
+    def __getstate__(self):
+        return {'cache_path': self.cache_path, 'manifest': self.manifest, 'names': self.names, 'arrays': {}}
+
+
+def process_args():
+    """A function used to customise the conversion from the terminal.
+
+    Returns:
+        Interprets the arguments added to the argument parser object during the running of the script.
+    """
+    ap = argparse.ArgumentParser(description="Convert h5 dataset splits into memory mappable .npy files")
+    ap.add_argument('splits', nargs='*', help='split folders to convert',
+                    default=['data/train/', 'data/val/', 'data/test/'])
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_args()
+    for split in args.splits:
+        convert_split(split)
@@ -1,3 +1,4 @@
+import os
 import sys
 import torch
 import torch.optim as optim
@@ -126,3 +127,47 @@ def load_model(model, model_path, device='cuda'):
     model.load_state_dict(torch.load(model_path, map_location=torch.device(device)))
     return model
 
+
+def save_checkpoint(checkpoint_path, model, optimizer, epoch, batch, **extra):
+    """A function for saving everything needed to resume training at the next unseen mini-batch.
+
+    The checkpoint is written to a temporary file and renamed, so a run killed while saving
+    keeps its previous checkpoint.
+
+    Args:
+        checkpoint_path (path): File the checkpoint is written to.
+        model (pytorch object): network being trained.
+        optimizer (pytorch object): its optimizer.
+        epoch (int): Epoch the next mini-batch belongs to.
+        batch (int): Number of mini-batches of that epoch already trained on.
+        extra (dict): Other state dicts to restore (ie: scheduler=scheduler.state_dict()).
+    """
+    checkpoint = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': epoch, 'batch': batch,
+                  'rng_state': torch.get_rng_state(), **extra}
+    if torch.cuda.is_available():
+        checkpoint['cuda_rng_state'] = torch.cuda.get_rng_state_all()
+    torch.save(checkpoint, f'{checkpoint_path}.partial')
+    os.replace(f'{checkpoint_path}.partial', checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path, model, optimizer, device='cuda'):
+    """A function for restoring a checkpoint written by save_checkpoint.
+
+    Args:
+        checkpoint_path (path): File written by save_checkpoint.
+        model (pytorch object): network the weights are loaded into.
+        optimizer (pytorch object): optimizer the state is loaded into.
+        device (string, optional): the device used for training of the model (cpu or cuda). Defaults to 'cuda'.
+
+    Returns:
+        checkpoint (dict): The checkpoint, holding the epoch and batch to resume from and any extra state.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location=torch.device(device), weights_only=False)
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    torch.set_rng_state(checkpoint['rng_state'].cpu())
+    if 'cuda_rng_state' in checkpoint and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in checkpoint['cuda_rng_state']])
+    print(f"Resuming from {checkpoint_path}: epoch {checkpoint['epoch'] + 1}, batch {checkpoint['batch'] + 1}")
+    return checkpoint
+
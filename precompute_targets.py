@@ -0,0 +1,221 @@
+import os
+import json
+import hashlib
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+import cv2
+
+# Derived target file mapped to the dataset it is stored under, all of them are computed from images.h5
+TARGET_DATASETS = {'canny_filter': 'canny', 'Labimages': 'Lab_img', 'noisy_data': 'noisy_data'}
+DEFAULT_PARAMS = {
+    'canny_filter': {'blur_size': 5, 'low_threshold': 100, 'high_threshold': 200},
+    'Labimages': {},
+    'noisy_data': {'mean': 5, 'std': 2, 'seed': 0},
+}
+
+
+def canny_chunk(images, start, params):
+    """A function for computing the canny edge maps of a chunk of RGB images.
+
+    Args:
+        images (numpy array): uint8 images of shape (rows, height, width, 3).
+        start (int): Index of the first image of the chunk in the split.
+        params (dict): blur_size, low_threshold and high_threshold.
+
+    Returns:
+        edges (numpy array): uint8 edge maps of shape (rows, height, width), 1 on the edges and 0 elsewhere.
+    """
+    edges = np.empty(images.shape[:3], dtype=np.uint8)
+    for i, image in enumerate(images):
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        gray = cv2.GaussianBlur(gray, (params['blur_size'], params['blur_size']), 0)
+        edges[i] = cv2.Canny(gray, params['low_threshold'], params['high_threshold']) // 255
+    return edges
+
+
+def lab_chunk(images, start, params):
+    """A function for converting a chunk of RGB images into the 8 bit Lab colour space of opencv.
+
+    Args:
+        images (numpy array): uint8 images of shape (rows, height, width, 3).
+        start (int): Index of the first image of the chunk in the split.
+        params (dict): Unused.
+
+    Returns:
+        lab_images (numpy array): uint8 images of the same shape, L scaled to 0-255 and a, b offset by 128.
+    """
+    # opencv converts the chunk as a single (rows * height, width) image
+    rows, height, width, channels = images.shape
+    lab_images = cv2.cvtColor(np.ascontiguousarray(images).reshape(rows * height, width, channels),
+                              cv2.COLOR_RGB2LAB)
+    return lab_images.reshape(images.shape)
+
+
+def noisy_chunk(images, start, params):
+    """A function for adding gaussian noise to a chunk of RGB images.
+
+    The noise of every chunk is drawn from (seed, start), so the result does not depend on
+    the chunk size being processed in parallel or not.
+
+    Args:
+        images (numpy array): uint8 images of shape (rows, height, width, 3).
+        start (int): Index of the first image of the chunk in the split.
+        params (dict): mean, std and seed of the noise.
+
+    Returns:
+        noisy_images (numpy array): uint8 images of the same shape, clipped to 0-255.
+    """
+    noisy_images = np.empty(images.shape, dtype=np.uint8)
+    for i, image in enumerate(images):
+        rng = np.random.default_rng([params['seed'], start + i])
+        noise = rng.standard_normal(image.shape, dtype=np.float32) * params['std'] + params['mean']
+        noisy_images[i] = np.clip(np.rint(image + noise), 0, 255)
+    return noisy_images
+
+
+TARGET_FUNCTIONS = {'canny_filter': canny_chunk, 'Labimages': lab_chunk, 'noisy_data': noisy_chunk}
+
+
+def file_hash(filepath, block_size=2 ** 20):
+    """Returns the sha256 digest of a file, read block_size bytes at a time."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def next_result(pending):
+    """Waits for the oldest chunk in flight and returns its start index and result."""
+    start, future = pending.popleft()
+    return start, future.result()
+
+
+def is_up_to_date(target_filepath, source_hash, params):
+    """Returns True if target_filepath was computed from a source with source_hash using params."""
+    if not os.path.isfile(target_filepath):
+        return False
+    try:
+        with h5py.File(target_filepath, 'r') as target:
+            return target.attrs.get('source_sha256') == source_hash and target.attrs.get('params') == params
+    except OSError:
+        return False
+
+
+def precompute_target(name, images_filepath, target_filepath, workers=None, chunk_rows=256, params=None,
+                      force=False, source_hash=None):
+    """A function for computing one derived target file from the images of a split.
+
+    The images are streamed chunk_rows at a time through a pool of worker processes, with at most
+    two chunks per worker in flight, and the uint8 results are written in order. The target is
+    skipped when it was already computed from the same images with the same parameters.
+
+    Args:
+        name (str): 'canny_filter', 'Labimages' or 'noisy_data'.
+        images_filepath (path): The images.h5 file of the split.
+        target_filepath (path): The file written.
+        workers (int, optional): Number of worker processes, 0 computes in this process. Defaults to the
+        number of cores.
+        chunk_rows (int, optional): Images per chunk. Defaults to 256.
+        params (dict, optional): Parameters of the target. Defaults to DEFAULT_PARAMS[name].
+        force (bool, optional): Recompute even if the target is up to date. Defaults to False.
+        source_hash (str, optional): sha256 of images_filepath, computed when not given.
+
+    Returns:
+        computed (bool): False if the target was up to date and skipped.
+    """
+    params = json.dumps(dict(DEFAULT_PARAMS[name], **(params or {})), sort_keys=True)
+    source_hash = source_hash or file_hash(images_filepath)
+    if not force and is_up_to_date(target_filepath, source_hash, params):
+        print(f'{target_filepath} is up to date')
+        return False
+
+    workers = os.cpu_count() if workers is None else workers
+    function = TARGET_FUNCTIONS[name]
+    partial_filepath = str(target_filepath) + '.partial'
+
+    with h5py.File(images_filepath, 'r') as source, h5py.File(partial_filepath, 'w') as target:
+        images = source[list(source.keys())[0]]
+        n_samples = images.shape[0]
+        shape = images.shape[:3] if name == 'canny_filter' else images.shape
+        # An empty split cannot hold a chunk, its dataset is contiguous
+        dataset = target.create_dataset(TARGET_DATASETS[name], shape=shape, dtype=np.uint8,
+                                        chunks=(min(16, n_samples),) + shape[1:] if n_samples else None)
+
+        def write(start, result):
+            dataset[start:start + len(result)] = result
+
+        if workers == 0:
+            for start in range(0, n_samples, chunk_rows):
+                write(start, function(images[start:start + chunk_rows].astype(np.uint8), start, json.loads(params)))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = collections.deque()
+                for start in range(0, n_samples, chunk_rows):
+                    chunk = images[start:start + chunk_rows].astype(np.uint8)
+                    pending.append((start, pool.submit(function, chunk, start, json.loads(params))))
+                    if len(pending) >= 2 * workers:
+                        write(*next_result(pending))
+                while pending:
+                    write(*next_result(pending))
+
+        target.attrs['source_sha256'] = source_hash
+        target.attrs['params'] = params
+
+    os.replace(partial_filepath, target_filepath)
+    print(f'{images_filepath} -> {target_filepath}')
+    return True
+
+
+def precompute_split(data_path, targets=None, workers=None, chunk_rows=256, force=False, **params):
+    """A function for computing the derived target files of a split from its images.h5.
+
+    Args:
+        data_path (path): Folder holding the h5 files of the split (ie: 'data/train/').
+        targets (list, optional): Target files to compute. Defaults to all of TARGET_FUNCTIONS.
+        workers (int, optional): Number of worker processes. Defaults to the number of cores.
+        chunk_rows (int, optional): Images per chunk. Defaults to 256.
+        force (bool, optional): Recompute targets that are up to date. Defaults to False.
+        params (dict): Parameters of each target, keyed by target name (ie: noisy_data={'seed': 1}).
+
+    Returns:
+        computed (list): Names of the targets that were computed.
+    """
+    images_filepath = os.path.join(data_path, 'images.h5')
+    source_hash = file_hash(images_filepath)
+    computed = []
+    for name in targets or list(TARGET_FUNCTIONS):
+        if precompute_target(name, images_filepath, os.path.join(data_path, name + '.h5'), workers=workers,
+                             chunk_rows=chunk_rows, params=params.get(name), force=force,
+                             source_hash=source_hash):
+            computed.append(name)
+    return computed
+
+
+def process_args():
+    """A function used to customise the precomputation from the terminal.
+
+    Returns:
+        Interprets the arguments added to the argument parser object during the running of the script.
+    """
+    ap = argparse.ArgumentParser(description="Compute the canny, Lab and noisy targets of dataset splits")
+    ap.add_argument('splits', nargs='*', help='split folders to process',
+                    default=['data/train/', 'data/val/', 'data/test/'])
+    ap.add_argument("-t", '--targets', nargs='+', help='targets to compute (canny_filter/Labimages/noisy_data)',
+                    default=list(TARGET_FUNCTIONS))
+    ap.add_argument("-w", '--workers', help='number of worker processes (0 runs in this process)', default=None)
+    ap.add_argument("-c", '--chunk_rows', help='images processed per chunk', default=256)
+    ap.add_argument("-s", '--seed', help='seed of the noise', default=0)
+    ap.add_argument("-f", '--force', help='recompute targets that are up to date (y/n)', default='n')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_args()
+    workers = None if args.workers is None else int(args.workers)
+    for split in args.splits:
+        precompute_split(split, targets=args.targets, workers=workers, chunk_rows=int(args.chunk_rows),
+                         force=args.force == 'y', noisy_data={'seed': int(args.seed)})
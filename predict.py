@@ -0,0 +1,104 @@
+import os
+import csv
+import argparse
+import functools
+import cv2
+import torch
+import model_utils
+import test_model
+from image_folder import ImageFolderLoader, prepare_images
+from letterbox import project_boxes, project_masks
+from cw2_main import COLORIZATION_MODELS, DENOISING_MODELS
+
+PREDICTIONS_FILE = 'predictions.csv'
+
+
+def predict_folder(source, model_type, model_path, output_path, batch_size=16, num_threads=None, device='cuda',
+                   save_masks=True, prefetch_depth=2, mode='letterbox'):
+    """A function for predicting the class, bounding box and segmentation of every image of a folder.
+
+    The images of any size are decoded by the threads of an ImageFolderLoader while the model runs on
+    the previous mini-batches, and fitted to the network on the device (see letterbox.letterbox). The
+    bounding boxes and segmentations are moved back to the original images a mini-batch at a time. A
+    row per image is written to PREDICTIONS_FILE in output_path, and the segmentation masks to masks/
+    as PNG files (255 on the pet) of the size of the images.
+
+    Args:
+        source (path): Folder of images or file listing them, see image_folder.list_images.
+        model_type (string): The model type.
+        model_path (path): Weights of the model, as saved by the training.
+        output_path (path): Folder the predictions are written to.
+        batch_size (int, optional): Size of the mini-batches. Defaults to 16.
+        num_threads (int, optional): Threads decoding the images. Defaults to the number of cores.
+        device (string, optional): The device the model runs on (cpu or cuda). Defaults to 'cuda'.
+        save_masks (bool, optional): Write the segmentation masks. Defaults to True.
+        prefetch_depth (int, optional): Mini-batches moved to the device ahead of the model. Defaults to 2.
+        mode (string, optional): How the images are fitted to the network, one of letterbox.RESIZE_MODES.
+        Defaults to 'letterbox'.
+
+    Returns:
+        n_images (int): Number of images predicted.
+    """
+    image_loader = ImageFolderLoader(source, batch_size=batch_size, num_threads=num_threads,
+                                     prefetch=prefetch_depth, mode=mode)
+    if not image_loader.paths:
+        raise FileNotFoundError(f'{source} holds no images')
+    model, _, _ = model_utils.get_model(model_type=model_type, device=device)
+    model = model_utils.load_model(model=model, model_path=model_path, device=device)
+    prepare = functools.partial(prepare_images, lab=model_type in COLORIZATION_MODELS,
+                                rescale=False if model_type in DENOISING_MODELS else None, mode=mode)
+
+    mask_path = os.path.join(output_path, 'masks')
+    os.makedirs(mask_path if save_masks else output_path, exist_ok=True)
+    predictions_filepath = os.path.join(output_path, PREDICTIONS_FILE)
+    with open(predictions_filepath + '.partial', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['path', 'height', 'width', 'class', 'probability', 'x_min', 'y_min', 'x_max', 'y_max'])
+        for batch, classes, boxes, segmask in test_model.predict_images(image_loader, model, device, prepare,
+                                                                        prefetch_depth=prefetch_depth):
+            probabilities, labels = torch.softmax(classes.float(), dim=1).max(dim=1)
+            sizes, transforms = batch.extras['size'], batch.extras['transform']
+            boxes = project_boxes(boxes, transforms, sizes).cpu().numpy()
+            masks = (project_masks(segmask, transforms, sizes) * 255).cpu().numpy() if save_masks else None
+            for i, (index, (height, width)) in enumerate(zip(batch.index.tolist(), sizes.tolist())):
+                path = image_loader.paths[index]
+                writer.writerow([path, height, width, labels[i].item(), round(probabilities[i].item(), 4),
+                                 *[round(float(value), 2) for value in boxes[i]]])
+                if save_masks:
+                    name = os.path.splitext(os.path.basename(path))[0]
+                    cv2.imwrite(os.path.join(mask_path, f'{index:06d}_{name}.png'), masks[i, :height, :width])
+    os.replace(predictions_filepath + '.partial', predictions_filepath)
+    print(f'{len(image_loader.paths)} images predicted by {model_path}, written to {predictions_filepath}')
+    return len(image_loader.paths)
+
+
+def process_args():
+    """A function used to predict on a folder of images from the terminal.
+
+    Returns:
+        Interprets the arguments added to the argument parser object during the running of the script.
+    """
+    ap = argparse.ArgumentParser(description="Predict the class, bounding box and mask of a folder of images")
+    ap.add_argument('source', help='folder of images (jpg, png, ...) or text file listing one image path per line')
+    ap.add_argument("-m", '--model_type', help='type of model to build (model name)', default='MTL-Attention')
+    ap.add_argument("-mp", '--model_path', help='weights of the model (default: models/<model type>.pt)',
+                    default=None)
+    ap.add_argument("-o", '--output_path', help='folder the predictions are written to', default='predictions/')
+    ap.add_argument("-d", '--device', help='which device to run on (cuda/cpu)', default='cuda')
+    ap.add_argument("-b", '--batch_size', help='mini-batch size', default=16)
+    ap.add_argument("-t", '--threads', help='threads decoding the images (default: number of cores)', default=None)
+    ap.add_argument("-rm", '--resize_mode', default='letterbox',
+                    help='fit the images to the network keeping their aspect ratio, or stretch them (letterbox/resize)')
+    ap.add_argument("-sm", '--save_masks', help='write the segmentation masks as PNG files (y/n)', default='y')
+    ap.add_argument("-pd", '--prefetch_depth', help='mini-batches decoded and moved to the device ahead of the model',
+                    default=2)
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_args()
+    model_path = args.model_path or f'models/{args.model_type}.pt'
+    predict_folder(args.source, args.model_type, model_path, args.output_path, batch_size=int(args.batch_size),
+                   num_threads=None if args.threads is None else int(args.threads), device=args.device,
+                   save_masks=args.save_masks == 'y', prefetch_depth=int(args.prefetch_depth),
+                   mode=args.resize_mode)
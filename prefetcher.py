@@ -0,0 +1,130 @@
+import time
+import queue
+import threading
+import torch
+from load_data import Batch
+
+# Put on the queue once the data loader is exhausted
+_END = object()
+
+
+class BatchPrefetcher:
+    """
+    Iterator preparing the next mini-batches of a data loader on a background thread while
+    the current step runs. Preparing a batch (device transfer, augmentation, normalisation) is
+    done by the prepare function of the training or evaluation loop.
+
+    On a cuda device the batches are prepared on a separate cuda stream, and the loop waits on
+    an event recorded after each batch, so the copies overlap with the forward and backward pass.
+
+    The time the loop spends waiting for a batch is accumulated in wait_time, reset every pass.
+    """
+
+    def __init__(self, data_loader, prepare, device, depth=2):
+        """
+        @params:
+        data_loader(iterable): Data loader yielding the raw batches
+        prepare(callable): Function called as prepare(batch_data, device), returning the prepared batch
+        device(string): Device the batches are moved to (cpu or cuda)
+        depth(int): Number of prepared batches held ahead of the loop
+        """
+        self.data_loader = data_loader
+        self.prepare = prepare
+        self.device = torch.device(device)
+        self.depth = max(1, depth)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.worker, args=(batches, stop), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                time_start = time.time()
+                item = batches.get()
+                self.wait_time += time.time() - time_start
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+
+                batch, event = item
+                if event is not None:
+                    # The tensors were made on the side stream, and are now used on the current one
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    record_stream(batch, current_stream)
+                yield batch
+        finally:
+            # The loop stopped early or failed, release the thread
+            stop.set()
+            thread.join()
+
+    def worker(self, batches, stop):
+        """Prepares the batches of the data loader in order and puts them on the queue."""
+        try:
+            for batch_data in self.data_loader:
+                if self.stream is None:
+                    item = (self.prepare(batch_data, self.device), None)
+                else:
+                    with torch.cuda.stream(self.stream):
+                        batch = self.prepare(batch_data, self.device)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                    item = (batch, event)
+                if not put(batches, item, stop):
+                    return
+        except Exception as error:
+            put(batches, error, stop)
+            return
+        put(batches, _END, stop)
+
+
+def put(batches, item, stop, timeout=0.1):
+    """A function for putting an item on a bounded queue, giving up once stop is set.
+
+    Args:
+        batches (queue.Queue): Queue to put the item on.
+        item (object): Item to put.
+        stop (threading.Event): Event set by the consumer when it no longer reads the queue.
+        timeout (float, optional): Seconds between checks of stop. Defaults to 0.1.
+
+    Returns:
+        put (bool): True if the item was put on the queue.
+    """
+    while not stop.is_set():
+        try:
+            batches.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def record_stream(batch, stream):
+    """A function for marking every tensor of a prepared batch as used by stream.
+
+    Stops the caching allocator from reusing their memory before stream is done with them.
+
+    Args:
+        batch (tensor, Batch, tuple, list or dict): The prepared batch, possibly nested.
+        stream (torch.cuda.Stream): Stream the batch is used on.
+    """
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, (tuple, list)):
+        for item in batch:
+            record_stream(item, stream)
+    elif isinstance(batch, Batch):
+        record_stream(batch.fields(), stream)
+    elif isinstance(batch, dict):
+        for item in batch.values():
+            record_stream(item, stream)
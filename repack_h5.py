@@ -0,0 +1,227 @@
+import os
+import time
+import argparse
+import h5py
+import numpy as np
+from mmap_cache import H5_FILES
+
+# Name of the consolidated file inside a split folder, load_data reads it instead of the separate files.
+PACKED_FILE = 'packed.h5'
+
+
+def repack_split(data_path, chunk_rows=16, compression=None, compression_level=4, alignment=4096,
+                 chunk_bytes=64 * 2 ** 20):
+    """A function for merging the per-sample h5 files of a split into one consolidated file.
+
+    Every file becomes one dataset of packed.h5, named after the file (ie: 'images', 'masks').
+    All datasets share the same chunking along the sample axis, so a mini-batch read touches
+    the same few chunks in every dataset, and chunks are aligned to the file system block size.
+    Every dataset records the size and modification time of its file, see current_datasets.
+
+    Args:
+        data_path (path): Folder holding the h5 files of the split (ie: 'data/train/').
+        chunk_rows (int, optional): Samples per chunk, ideally the mini-batch size. Defaults to 16.
+        compression (str, optional): None, 'lzf' or 'gzip'. Defaults to None.
+        compression_level (int, optional): gzip level between 0 and 9. Defaults to 4.
+        alignment (int, optional): Byte alignment of the chunks in the file. Defaults to 4096.
+        chunk_bytes (int, optional): Approximate number of bytes copied at a time. Defaults to 64MB.
+
+    Returns:
+        packed_filepath (path): Path of the consolidated file.
+    """
+    packed_filepath = os.path.join(data_path, PACKED_FILE)
+    partial_filepath = packed_filepath + '.partial'
+    sources = [name for name in H5_FILES if os.path.isfile(os.path.join(data_path, name + '.h5'))]
+
+    with h5py.File(partial_filepath, 'w', alignment_threshold=alignment, alignment_interval=alignment) as packed:
+        for name in sources:
+            stat = os.stat(os.path.join(data_path, name + '.h5'))
+            with h5py.File(os.path.join(data_path, name + '.h5'), 'r') as source:
+                dataset = source[list(source.keys())[0]]
+                # An empty split cannot hold a chunk, its datasets are contiguous
+                options = {'chunks': (min(chunk_rows, dataset.shape[0]),) + dataset.shape[1:]
+                           if dataset.shape[0] else None}
+                if compression == 'gzip':
+                    options.update(compression='gzip', compression_opts=compression_level, shuffle=True)
+                elif compression == 'lzf':
+                    options.update(compression='lzf', shuffle=True)
+                target = packed.create_dataset(name, shape=dataset.shape, dtype=dataset.dtype, **options)
+                target.attrs['source_size'] = stat.st_size
+                target.attrs['source_mtime'] = stat.st_mtime
+
+                row_bytes = max(1, dataset.dtype.itemsize * int(np.prod(dataset.shape[1:])))
+                rows = max(chunk_rows, chunk_bytes // row_bytes // chunk_rows * chunk_rows)
+                for start in range(0, dataset.shape[0], rows):
+                    target[start:start + rows] = dataset[start:start + rows]
+            print(f'{name}: {dataset.shape} {dataset.dtype} chunks {options["chunks"]}')
+        packed.attrs['chunk_rows'] = chunk_rows
+        packed.attrs['compression'] = compression or 'none'
+
+    os.replace(partial_filepath, packed_filepath)
+    return packed_filepath
+
+
+def current_datasets(packed_filepath, data_path):
+    """A function for finding the datasets of a consolidated file that still match the files they were copied from.
+
+    A file of the split rewritten since repack_split (ie: appended to by ingest.py or recomputed by
+    precompute_targets.py) has a different size or modification time, and its dataset is stale.
+
+    Args:
+        packed_filepath (path): File written by repack_split.
+        data_path (path): Folder holding the h5 files of the split.
+
+    Returns:
+        current (list), stale (list): Names of the datasets that are up to date, and of the others.
+    """
+    current, stale = [], []
+    with h5py.File(packed_filepath, 'r') as packed:
+        for name in packed:
+            source_filepath = os.path.join(data_path, name + '.h5')
+            attrs = packed[name].attrs
+            if not os.path.isfile(source_filepath):
+                current.append(name)
+                continue
+            stat = os.stat(source_filepath)
+            if attrs.get('source_size') == stat.st_size and attrs.get('source_mtime') == stat.st_mtime:
+                current.append(name)
+            else:
+                stale.append(name)
+    return current, stale
+
+
+def cache_options(packed_filepath, chunks_per_dataset=4):
+    """A function for sizing h5py's chunk cache (rdcc) to a consolidated file.
+
+    h5py's default 1MB cache cannot hold a single chunk of 16 images, which forces a chunk to be
+    read and decompressed again for every sample taken from it.
+
+    Args:
+        packed_filepath (path): File written by repack_split.
+        chunks_per_dataset (int, optional): Chunks of every dataset the cache should hold. Defaults to 4.
+
+    Returns:
+        options (dict): rdcc_nbytes, rdcc_nslots and rdcc_w0 arguments for h5py.File.
+    """
+    with h5py.File(packed_filepath, 'r') as packed:
+        chunk_sizes = [packed[name].dtype.itemsize * int(np.prod(packed[name].chunks)) for name in packed
+                       if packed[name].chunks is not None]
+    nbytes = max(2 ** 20, chunks_per_dataset * sum(chunk_sizes))
+    # h5py recommends a prime number of slots, about 100 times the number of chunks in the cache
+    nslots = next_prime(100 * chunks_per_dataset * max(1, len(chunk_sizes)))
+    return {'rdcc_nbytes': nbytes, 'rdcc_nslots': nslots, 'rdcc_w0': 1.0}
+
+
+def next_prime(number):
+    """Returns the smallest prime number greater or equal to number."""
+    candidate = max(2, number)
+    while any(candidate % divisor == 0 for divisor in range(2, int(candidate ** 0.5) + 1)):
+        candidate += 1
+    return candidate
+
+
+def evict_page_cache(filepath):
+    """A function for dropping the pages of a file from the page cache of the host, so it is next read from disk.
+
+    Args:
+        filepath (path): The file evicted.
+
+    Returns:
+        evicted (bool): False where posix_fadvise is not available (ie: Windows, macOS).
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        # Dirty pages are not dropped, the file just written is flushed first
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def benchmark(packed_filepath, batch_size=16, n_batches=50, shuffle=True, cold=True, **h5_options):
+    """A function for measuring how fast mini-batches can be read from a consolidated file.
+
+    Batches are read the way load_data reads them: one sorted selection per dataset. The file is
+    evicted from the page cache first (see evict_page_cache), otherwise the file just written by
+    repack_split is read from memory and the throughput is not the one of a first epoch.
+
+    Args:
+        packed_filepath (path): File written by repack_split.
+        batch_size (int, optional): Size of the mini-batches. Defaults to 16.
+        n_batches (int, optional): Number of mini-batches read. Defaults to 50.
+        shuffle (bool, optional): Random batches as in training, otherwise contiguous blocks. Defaults to True.
+        cold (bool, optional): Evict the file from the page cache before reading it. Defaults to True.
+        h5_options (dict): Extra arguments for h5py.File, such as the rdcc settings.
+
+    Returns:
+        samples_per_second (float), megabytes_per_second (float): The measured read throughput.
+        cold (bool): Whether the file was evicted, the throughput is a warm cache one otherwise.
+    """
+    cold = cold and evict_page_cache(packed_filepath)
+    with h5py.File(packed_filepath, 'r', **h5_options) as packed:
+        datasets = [packed[name] for name in packed]
+        n_samples = datasets[0].shape[0]
+        order = np.random.permutation(n_samples) if shuffle else np.arange(n_samples)
+        n_bytes = 0
+        n_read = 0
+
+        time_start = time.time()
+        for batch in range(min(n_batches, (n_samples + batch_size - 1) // batch_size)):
+            indices = np.sort(order[batch * batch_size:(batch + 1) * batch_size])
+            for dataset in datasets:
+                if shuffle:
+                    rows = dataset[indices]
+                else:
+                    rows = dataset[indices[0]:indices[-1] + 1]
+                n_bytes += rows.nbytes
+            n_read += len(indices)
+        time_taken = max(time.time() - time_start, 1e-9)
+
+    return n_read / time_taken, n_bytes / time_taken / 2 ** 20, cold
+
+
+def process_args():
+    """A function used to customise the repacking from the terminal.
+
+    Returns:
+        Interprets the arguments added to the argument parser object during the running of the script.
+    """
+    ap = argparse.ArgumentParser(description="Merge the h5 files of dataset splits into one chunked file per split")
+    ap.add_argument('splits', nargs='*', help='split folders to repack',
+                    default=['data/train/', 'data/val/', 'data/test/'])
+    ap.add_argument("-c", '--chunk_rows', help='samples per chunk, ideally the mini-batch size', default=16)
+    ap.add_argument("-z", '--compression', help='compression codec (none/lzf/gzip)', default='none')
+    ap.add_argument("-l", '--level', help='gzip compression level (0-9)', default=4)
+    ap.add_argument("-rn", '--rdcc_nbytes', help='chunk cache size in bytes used for the benchmark', default=None)
+    ap.add_argument("-rs", '--rdcc_nslots', help='chunk cache hash slots used for the benchmark', default=None)
+    ap.add_argument("-rw", '--rdcc_w0', help='chunk cache eviction policy (0-1) used for the benchmark', default=None)
+    ap.add_argument("-b", '--batch_size', help='mini-batch size used for the benchmark', default=16)
+    ap.add_argument("-w", '--warm', help='benchmark from the page cache instead of evicting the file first (y/n)',
+                    default='n')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_args()
+    compression = None if args.compression == 'none' else args.compression
+
+    for split in args.splits:
+        packed_filepath = repack_split(split, chunk_rows=int(args.chunk_rows), compression=compression,
+                                       compression_level=int(args.level))
+        h5_options = cache_options(packed_filepath)
+        if args.rdcc_nbytes is not None:
+            h5_options['rdcc_nbytes'] = int(args.rdcc_nbytes)
+        if args.rdcc_nslots is not None:
+            h5_options['rdcc_nslots'] = int(args.rdcc_nslots)
+        if args.rdcc_w0 is not None:
+            h5_options['rdcc_w0'] = float(args.rdcc_w0)
+
+        print(f"{packed_filepath}: {os.path.getsize(packed_filepath) / 2 ** 20:.1f} MB, cache {h5_options}")
+        for shuffle in (False, True):
+            samples_per_second, megabytes_per_second, cold = benchmark(
+                packed_filepath, batch_size=int(args.batch_size), shuffle=shuffle, cold=args.warm != 'y', **h5_options)
+            print(f"{'random' if shuffle else 'sequential'} batches: {samples_per_second:.1f} samples/s, "
+                  f"{megabytes_per_second:.1f} MB/s ({'cold' if cold else 'warm'} page cache)")
@@ -0,0 +1,263 @@
+import os
+import json
+import argparse
+import h5py
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+from load_data import worker_options, collate_batch, read_exclusions, TargetProvider
+
+# h5 file of a split mapped to the label it is stored under in the shards. Missing derived files are skipped.
+SHARD_FIELDS = {'images': 'image', 'masks': 'mask', 'bboxes': 'bbox', 'binary': 'classification',
+                'canny_filter': 'canny', 'Labimages': 'lab', 'noisy_data': 'noisy'}
+INDEX_FILE = 'shards.json'
+
+
+def write_shards(data_path, shard_path=None, shard_size=1000):
+    """A function for splitting the h5 files of a split into shards of shard_size samples.
+
+    Each shard is an uncompressed .npz file holding every field for its samples, so a shard is
+    read with one sequential pass. Only shard_size samples are held in memory at a time.
+
+    Args:
+        data_path (path): Folder holding the h5 files of the split (ie: 'data/train/').
+        shard_path (path, optional): Folder the shards are written to. Defaults to the 'shards'
+        folder inside data_path.
+        shard_size (int, optional): Number of samples per shard. Defaults to 1000.
+
+    Returns:
+        index (dict): The shard index that was written next to the shards.
+    """
+    shard_path = shard_path or os.path.join(data_path, 'shards')
+    os.makedirs(shard_path, exist_ok=True)
+
+    files = {field: h5py.File(os.path.join(data_path, name + '.h5'), 'r') for name, field in SHARD_FIELDS.items()
+             if os.path.isfile(os.path.join(data_path, name + '.h5'))}
+    datasets = {field: h5_file[list(h5_file.keys())[0]] for field, h5_file in files.items()}
+    n_samples = datasets['image'].shape[0]
+
+    shards = []
+    for shard, start in enumerate(range(0, n_samples, shard_size)):
+        arrays = {field: dataset[start:start + shard_size] for field, dataset in datasets.items()}
+        name = f'shard-{shard:05d}.npz'
+        np.savez(os.path.join(shard_path, name), **arrays)
+        shards.append({'file': name, 'start': start, 'samples': len(arrays['image'])})
+        print(f'{name}: samples {start} to {start + len(arrays["image"]) - 1}')
+
+    for h5_file in files.values():
+        h5_file.close()
+
+    index = {'samples': n_samples, 'fields': list(datasets), 'shards': shards}
+    with open(os.path.join(shard_path, INDEX_FILE), 'w') as file:
+        json.dump(index, file, indent=2)
+    return index
+
+
+def shard_fields(providers):
+    """A function for mapping the providers of a model type to the shard fields they read.
+
+    The shards hold the fields of the h5 files as they are, so only plain TargetProviders can be
+    streamed from them, not the ones deriving their labels (ie: the Lab channels or noisy images).
+
+    Args:
+        providers (list): load_data.TargetProvider objects for the input and the targets.
+
+    Returns:
+        fields (list): Shard fields read, the labels of the providers.
+    """
+    fields = []
+    for provider in providers:
+        if type(provider) is not TargetProvider or SHARD_FIELDS.get(provider.filenames[0]) != provider.label:
+            raise ValueError(f"{type(provider).__name__} provides '{provider.label}', which the shards cannot stream: "
+                             f"they only hold the fields of the h5 files as they are")
+        fields.append(provider.label)
+    return fields
+
+
+class ShardedIterableDataset(IterableDataset):
+    """
+    Streams the shards written by write_shards one after the other and yields ready-made
+    mini-batches, so a split never has to fit in memory and is only read sequentially.
+
+    The shard order is drawn from (seed, epoch) and the shards are dealt out to every
+    distributed rank and then to every DataLoader worker of that rank, so no two workers
+    read the same shard. Samples are shuffled through a bounded buffer. Only the fields the model
+    reads are loaded from the shards, and the samples dedup.py excluded are skipped as they are read.
+    """
+
+    def __init__(self, shard_path, batch_size=16, shuffle=True, shuffle_buffer=1000, seed=0, rank=None,
+                 world_size=None, batch_transform=None, fields=None, exclude=None):
+        """
+        @params:
+        shard_path(string): Folder written by write_shards
+        batch_size(int): Size of the mini-batches
+        shuffle(bool): Shuffle the shard order and the samples, otherwise stream in order
+        shuffle_buffer(int): Number of samples held in the shuffle buffer
+        seed(int): Seed of the shuffling, combined with the epoch
+        rank(int): Distributed rank, defaults to the torch.distributed rank when initialised
+        world_size(int): Number of distributed ranks, defaults to the torch.distributed world size
+        batch_transform(callable): Transform applied to every mini-batch of images, by default the raw images
+        are emitted and normalised on the device (see load_data.normalise_batch)
+        fields(list): Shard fields loaded (ie: ['image', 'mask']), defaults to every field of the shards
+        exclude(list): Indices in the split of the samples skipped (see load_data.read_exclusions)
+        """
+        with open(os.path.join(shard_path, INDEX_FILE)) as file:
+            self.index = json.load(file)
+        self.fields = list(fields) if fields is not None else self.index['fields']
+        missing = [field for field in self.fields if field not in self.index['fields']]
+        if missing:
+            raise ValueError(f'{shard_path} holds no {missing} fields, write the shards again with their h5 files')
+        distributed = dist.is_available() and dist.is_initialized()
+        self.shard_path = shard_path
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.rank = rank if rank is not None else (dist.get_rank() if distributed else 0)
+        self.world_size = world_size if world_size is not None else (dist.get_world_size() if distributed else 1)
+        self.batch_transform = batch_transform
+        self.exclude = frozenset(exclude or [])
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Sets the epoch used for the next pass. Each pass otherwise advances the epoch by one."""
+        self.epoch = epoch
+
+    def worker_shards(self, epoch):
+        """Returns the shards read by the calling worker of this rank during epoch."""
+        shards = list(self.index['shards'])
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, epoch]).permutation(len(shards))
+            shards = [shards[i] for i in order]
+        shards = shards[self.rank::self.world_size]
+
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+        return shards
+
+    def samples(self, shards):
+        """Yields the samples of the given shards in order, one dict of fields per sample."""
+        for shard in shards:
+            with np.load(os.path.join(self.shard_path, shard['file'])) as arrays:
+                fields = {field: arrays[field] for field in self.fields}
+            for i in range(shard['samples']):
+                if shard['start'] + i not in self.exclude:
+                    yield {field: array[i] for field, array in fields.items()}
+
+    def __iter__(self):
+        # Persistent workers hold their own copy of the dataset, so the epoch advances in every worker
+        epoch = self.epoch
+        self.epoch += 1
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        rng = np.random.default_rng([self.seed, epoch, self.rank, worker_id])
+
+        samples = self.samples(self.worker_shards(epoch))
+        if self.shuffle and self.shuffle_buffer > 1:
+            samples = buffer_shuffle(samples, self.shuffle_buffer, rng)
+
+        batch = []
+        for sample in samples:
+            batch.append(sample)
+            if len(batch) == self.batch_size:
+                yield self.collate(batch)
+                batch = []
+        if batch:
+            yield self.collate(batch)
+
+    def collate(self, batch):
+        """Stacks a list of samples into a load_data.Batch."""
+        fields = {field: np.stack([sample[field] for sample in batch]) for field in self.fields}
+        if self.batch_transform:
+            fields['image'] = self.batch_transform(torch.from_numpy(fields['image']))
+        return collate_batch(fields)
+
+
+def buffer_shuffle(samples, buffer_size, rng):
+    """A function for shuffling a stream with a bounded buffer.
+
+    The buffer is filled first, then every incoming sample replaces a randomly chosen one,
+    which is yielded. The remaining samples are yielded in random order at the end.
+
+    Args:
+        samples (iterator): Stream of samples.
+        buffer_size (int): Maximum number of samples held.
+        rng (numpy Generator): Random number generator.
+    """
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        i = rng.integers(buffer_size)
+        yield buffer[i]
+        buffer[i] = sample
+    for i in rng.permutation(len(buffer)):
+        yield buffer[i]
+
+
+def create_data_loaders(train_path, validation_path, test_path, batch_size=16, num_workers=0, prefetch_factor=2,
+                        shuffle_buffer=1000, seed=0, providers=None, exclude=True):
+    """A function for creating pytorch training, validation and testing dataloader objects from sharded splits.
+
+    Args:
+        train_path (path): The path for the training data, containing a 'shards' folder.
+        validation_path (path): The path for the validation data, containing a 'shards' folder.
+        test_path (path): The path for the testing data, containing a 'shards' folder.
+        batch_size (int, optional): Size of the batch. Defaults to 16.
+        num_workers (int, optional): Number of DataLoader worker processes. Defaults to 0.
+        prefetch_factor (int, optional): Batches loaded in advance by each worker. Defaults to 2.
+        shuffle_buffer (int, optional): Samples held in the training shuffle buffer. Defaults to 1000.
+        seed (int, optional): Seed of the shard and sample shuffling. Defaults to 0.
+        providers (list, optional): TargetProvider objects of the fields read, see shard_fields. Defaults to every
+        field of the shards.
+        exclude (bool, optional): Skip the near-duplicates dedup.py listed in every split. Defaults to True.
+
+    Returns:
+        train_loader, val_loader, test_loader are the torch.DataLoader() objects for their respective datasets;
+        training, validation and testing sets.
+    """
+    fields = shard_fields(providers) if providers is not None else None
+
+    def excluded(data_path):
+        # Indices of the split, which the shards keep (see write_shards)
+        if not exclude:
+            return None
+        with open(os.path.join(data_path, 'shards', INDEX_FILE)) as file:
+            return read_exclusions(data_path, json.load(file)['samples'])
+
+    train_set = ShardedIterableDataset(os.path.join(train_path, 'shards'), batch_size=batch_size,
+                                       shuffle_buffer=shuffle_buffer, seed=seed, fields=fields,
+                                       exclude=excluded(train_path))
+    validation_set = ShardedIterableDataset(os.path.join(validation_path, 'shards'), batch_size=batch_size,
+                                            shuffle=False, fields=fields, exclude=excluded(validation_path))
+    test_set = ShardedIterableDataset(os.path.join(test_path, 'shards'), batch_size=batch_size, shuffle=False,
+                                      fields=fields, exclude=excluded(test_path))
+
+    # The datasets yield whole mini-batches
+    train_loader = DataLoader(train_set, batch_size=None, **worker_options(num_workers, prefetch_factor))
+    validation_loader = DataLoader(validation_set, batch_size=None, **worker_options(num_workers, prefetch_factor))
+    test_loader = DataLoader(test_set, batch_size=None, **worker_options(num_workers, prefetch_factor))
+
+    return train_loader, validation_loader, test_loader
+
+
+def process_args():
+    """A function used to customise the sharding from the terminal.
+
+    Returns:
+        Interprets the arguments added to the argument parser object during the running of the script.
+    """
+    ap = argparse.ArgumentParser(description="Split h5 dataset splits into .npz shards for streaming")
+    ap.add_argument('splits', nargs='*', help='split folders to shard',
+                    default=['data/train/', 'data/val/', 'data/test/'])
+    ap.add_argument("-s", '--shard_size', help='number of samples per shard', default=1000)
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_args()
+    for split in args.splits:
+        write_shards(split, shard_size=int(args.shard_size))
@@ -0,0 +1,365 @@
+import os
+import time
+import json
+import fcntl
+import signal
+import atexit
+import hashlib
+import tempfile
+import argparse
+from multiprocessing import shared_memory, resource_tracker
+import h5py
+import numpy as np
+from mmap_cache import H5_FILES
+
+# Client pid slots at the start of the manifest segment, followed by the length of the JSON manifest and the manifest
+MAX_CLIENTS = 256
+HEADER_BYTES = 8 * (MAX_CLIENTS + 1)
+
+
+def split_id(data_path):
+    """Returns the prefix of the shared memory segments of a split, derived from its real path."""
+    digest = hashlib.sha1(os.path.realpath(data_path).encode()).hexdigest()[:16]
+    return f'cw2_{digest}'
+
+
+def lock_path(data_path):
+    """Returns the lock file serialising the updates of the client table of a split."""
+    return os.path.join(tempfile.gettempdir(), split_id(data_path) + '.lock')
+
+
+def attach(name):
+    """A function for attaching to an existing shared memory segment without taking ownership of it.
+
+    Before python 3.13 every attaching process registers the segment with its resource tracker,
+    which unlinks it when the process exits, so the registration is undone.
+
+    Args:
+        name (str): Name of the segment.
+
+    Returns:
+        segment (SharedMemory): The attached segment.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+def client_table(segment):
+    """Returns the client pid slots of a manifest segment as an int64 array."""
+    return np.ndarray((MAX_CLIENTS,), dtype=np.int64, buffer=segment.buf)
+
+
+def live_clients(segment):
+    """Returns the pids of the registered clients that are still running, freeing the slots of the others."""
+    table = client_table(segment)
+    clients = []
+    for slot, pid in enumerate(table):
+        if pid == 0:
+            continue
+        try:
+            os.kill(int(pid), 0)
+            clients.append(int(pid))
+        except ProcessLookupError:
+            # The client died without detaching
+            table[slot] = 0
+        except PermissionError:
+            clients.append(int(pid))
+    return clients
+
+
+class SplitServer:
+    """
+    Holds the h5 files of one split in POSIX shared memory, one segment per file plus a manifest
+    segment describing them. Any process on the host attaches to the segments through
+    SharedMemoryFiles and reads zero copy views, so the split is held in RAM once however many
+    runs use it.
+
+    Clients register their pid in the manifest segment while attached. On shutdown the manifest is
+    unlinked first, so no new client attaches, and the file segments are unlinked once every
+    registered client has detached or exited.
+    """
+
+    def __init__(self, data_path, names=None):
+        """
+        @params:
+        data_path(string): Folder holding the h5 files of the split (ie: 'data/train/')
+        names(list): h5 files to serve, without extension, defaults to those of mmap_cache.H5_FILES present
+        """
+        self.data_path = data_path
+        self.prefix = split_id(data_path)
+        self.names = [name for name in names or H5_FILES if os.path.isfile(os.path.join(data_path, name + '.h5'))]
+        self.segments = {}
+        self.manifest_segment = None
+
+    def load(self):
+        """A function for copying the first dataset of every file into its own segment and publishing the manifest.
+
+        Returns:
+            n_bytes (int): Bytes held in shared memory.
+        """
+        try:
+            attach(f'{self.prefix}_manifest').close()
+        except FileNotFoundError:
+            pass
+        else:
+            raise RuntimeError(f'{self.data_path} is already served, or was left behind by a killed server '
+                               f'(remove it with python shm_server.py -u y {self.data_path})')
+        manifest = {}
+        for name in self.names:
+            source = os.path.join(self.data_path, name + '.h5')
+            stat = os.stat(source)
+            with h5py.File(source, 'r') as h5_file:
+                key = list(h5_file.keys())[0]
+                dataset = h5_file[key]
+                segment = shared_memory.SharedMemory(name=f'{self.prefix}_{name}', create=True,
+                                                     size=max(1, dataset.dtype.itemsize * int(np.prod(dataset.shape))))
+                self.segments[name] = segment
+                if dataset.size:
+                    dataset.read_direct(np.ndarray(dataset.shape, dtype=dataset.dtype, buffer=segment.buf))
+            manifest[name] = {'segment': segment.name, 'dataset': key, 'dtype': dataset.dtype.str,
+                              'shape': list(dataset.shape), 'source': os.path.realpath(source),
+                              'source_size': stat.st_size, 'source_mtime': stat.st_mtime}
+            print(f'{source} -> /dev/shm/{segment.name} ({segment.size / 2 ** 20:.1f} MB)')
+
+        encoded = json.dumps(manifest).encode()
+        self.manifest_segment = shared_memory.SharedMemory(name=f'{self.prefix}_manifest', create=True,
+                                                           size=HEADER_BYTES + len(encoded))
+        client_table(self.manifest_segment)[:] = 0
+        self.manifest_segment.buf[HEADER_BYTES - 8:HEADER_BYTES] = len(encoded).to_bytes(8, 'little')
+        self.manifest_segment.buf[HEADER_BYTES:HEADER_BYTES + len(encoded)] = encoded
+        return sum(segment.size for segment in self.segments.values())
+
+    def clients(self):
+        """Returns the pids of the attached clients."""
+        with open(lock_path(self.data_path), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return live_clients(self.manifest_segment)
+
+    def withdraw(self):
+        """Unlinks the manifest, so that no new client can attach. Attached clients keep their views."""
+        if self.manifest_segment is not None:
+            try:
+                self.manifest_segment.unlink()
+            except FileNotFoundError:
+                pass
+
+    def unlink(self):
+        """Unlinks every segment of the split. The memory is released once the last mapping is closed."""
+        self.withdraw()
+        for segment in self.segments.values():
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+            segment.close()
+        self.segments = {}
+        if self.manifest_segment is not None:
+            self.manifest_segment.close()
+            self.manifest_segment = None
+
+
+class SharedMemoryFiles:
+    """
+    Read-only view of a split served by shm_server.py, with the same interface as
+    load_data.LazyH5Files. Arrays are numpy views of the shared memory segments, so
+    torch.from_numpy wraps them without copying and every process on the host reads the same pages.
+
+    The process creating the view registers with the server until close_all is called or it exits.
+    DataLoader workers attach to the segments on first access without registering.
+    """
+
+    def __init__(self, data_path, **names):
+        """
+        @params:
+        data_path(string): Folder of the split given to shm_server.py
+        names(dict): Field name mapped to the h5 file name it was loaded from (ie: img='images')
+        """
+        self.data_path = data_path
+        prefix = split_id(data_path)
+        try:
+            manifest_segment = attach(f'{prefix}_manifest')
+        except FileNotFoundError:
+            raise FileNotFoundError(f'{data_path} is not served, start python shm_server.py {data_path}') from None
+        length = int.from_bytes(manifest_segment.buf[HEADER_BYTES - 8:HEADER_BYTES], 'little')
+        self.manifest = json.loads(bytes(manifest_segment.buf[HEADER_BYTES:HEADER_BYTES + length]))
+
+        missing = [source for source in names.values() if source not in self.manifest]
+        if missing:
+            manifest_segment.close()
+            raise FileNotFoundError(f'{missing} not served for {data_path}, restart shm_server.py')
+        for source in names.values():
+            entry = self.manifest[source]
+            stat = os.stat(entry['source'])
+            if (stat.st_size, stat.st_mtime) != (entry['source_size'], entry['source_mtime']):
+                manifest_segment.close()
+                raise RuntimeError(f"{entry['source']} changed since it was served, restart shm_server.py")
+
+        self.names = names
+        self.segments = {}
+        self.arrays = {}
+        self.register(manifest_segment)
+
+    def register(self, manifest_segment):
+        """Takes a free client slot of the manifest segment, released at exit."""
+        with open(lock_path(self.data_path), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            live_clients(manifest_segment)
+            table = client_table(manifest_segment)
+            free = np.flatnonzero(table == 0)
+            if len(free) == 0:
+                manifest_segment.close()
+                raise RuntimeError(f'{self.data_path} already has {MAX_CLIENTS} clients')
+            table[free[0]] = os.getpid()
+            self.slot = int(free[0])
+        self.manifest_segment = manifest_segment
+        self.owner = os.getpid()
+        atexit.register(self.close_all)
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            entry = self.manifest[self.names[name]]
+            if name not in self.segments:
+                self.segments[name] = attach(entry['segment'])
+            self.arrays[name] = np.ndarray(entry['shape'], dtype=np.dtype(entry['dtype']),
+                                           buffer=self.segments[name].buf)
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def path(self, name):
+        """Returns the path of the h5 file field name was loaded from."""
+        return self.manifest[self.names[name]]['source']
+
+    def source(self, name):
+        """Returns the path of the h5 file field name was loaded from."""
+        return self.path(name)
+
+    def first_key(self, name):
+        """Returns the name of the h5 dataset the segment was loaded from."""
+        return self.manifest[self.names[name]]['dataset']
+
+    def dataset(self, name, key):
+        """Returns the shared array of field name."""
+        return self[name]
+
+    def close(self):
+        """Drops the array views, the segments stay attached until close_all."""
+        self.arrays = {}
+
+    def close_all(self):
+        """Detaches from the segments and, in the registering process, frees its client slot."""
+        self.arrays = {}
+        for segment in self.segments.values():
+            try:
+                segment.close()
+            except BufferError:
+                # Tensors still view the segment, the mapping is released with them
+                pass
+        self.segments = {}
+        if self.manifest_segment is not None and os.getpid() == self.owner:
+            with open(lock_path(self.data_path), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                client_table(self.manifest_segment)[self.slot] = 0
+            self.manifest_segment.close()
+            self.manifest_segment = None
+            atexit.unregister(self.close_all)
+
+    def __getstate__(self):
+        return {'data_path': self.data_path, 'manifest': self.manifest, 'names': self.names, 'segments': {},
+                'arrays': {}, 'manifest_segment': None, 'slot': None, 'owner': None}
+
+
+def serve(splits, names=None, poll_seconds=1.0):
+    """A function for serving dataset splits from shared memory until interrupted.
+
+    The first interrupt (Ctrl-C or SIGTERM) stops new clients from attaching and waits for the attached
+    ones to detach, a second one unlinks the segments straight away.
+
+    Args:
+        splits (list): Split folders to serve (ie: ['data/train/', 'data/val/', 'data/test/']).
+        names (list, optional): h5 files to serve, without extension. Defaults to those of mmap_cache.H5_FILES.
+        poll_seconds (float, optional): Seconds between checks of the attached clients. Defaults to 1.
+    """
+    servers = [SplitServer(split, names) for split in splits]
+    interrupts = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: interrupts.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: interrupts.append(signum))
+    try:
+        n_bytes = sum(server.load() for server in servers)
+        print(f'Serving {len(servers)} splits, {n_bytes / 2 ** 20:.1f} MB of shared memory, Ctrl-C to stop')
+        while not interrupts:
+            time.sleep(poll_seconds)
+
+        for server in servers:
+            server.withdraw()
+        while len(interrupts) < 2:
+            clients = sorted({pid for server in servers for pid in server.clients()})
+            if not clients:
+                break
+            print(f'Waiting for clients {clients} to detach, interrupt again to stop now')
+            time.sleep(poll_seconds)
+    finally:
+        for server in servers:
+            server.unlink()
+    print('Shared memory released')
+
+
+def status(splits):
+    """Prints the files served for every split and the pids of their clients."""
+    for split in splits:
+        try:
+            segment = attach(f'{split_id(split)}_manifest')
+        except FileNotFoundError:
+            print(f'{split}: not served')
+            continue
+        length = int.from_bytes(segment.buf[HEADER_BYTES - 8:HEADER_BYTES], 'little')
+        manifest = json.loads(bytes(segment.buf[HEADER_BYTES:HEADER_BYTES + length]))
+        with open(lock_path(split), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            clients = live_clients(segment)
+        segment.close()
+        print(f"{split}: {', '.join(manifest)} served to clients {clients}")
+
+
+def unlink_leftovers(splits, names=None):
+    """Unlinks the segments left behind by a server that was killed before it could release them."""
+    for split in splits:
+        prefix = split_id(split)
+        for name in (names or H5_FILES) + ['manifest']:
+            try:
+                # Attached with the resource tracker, which unlink then releases
+                segment = shared_memory.SharedMemory(name=f'{prefix}_{name}')
+            except FileNotFoundError:
+                continue
+            segment.close()
+            segment.unlink()
+            print(f'Unlinked /dev/shm/{prefix}_{name}')
+
+
+def process_args():
+    """A function used to customise the dataset server from the terminal.
+
+    Returns:
+        Interprets the arguments added to the argument parser object during the running of the script.
+    """
+    ap = argparse.ArgumentParser(description="Serve h5 dataset splits from shared memory to every run on the host")
+    ap.add_argument('splits', nargs='*', help='split folders to serve',
+                    default=['data/train/', 'data/val/', 'data/test/'])
+    ap.add_argument("-s", '--status', help='print the served files and their clients instead (y/n)', default='n')
+    ap.add_argument("-u", '--unlink', help='remove the segments of a server that was killed (y/n)', default='n')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_args()
+    if args.status == 'y':
+        status(args.splits)
+    elif args.unlink == 'y':
+        unlink_leftovers(args.splits)
+    else:
+        serve(args.splits)
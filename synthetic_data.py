@@ -0,0 +1,219 @@
+import os
+import json
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+import cv2
+import precompute_targets
+from precompute_targets import DEFAULT_PARAMS, TARGET_DATASETS, TARGET_FUNCTIONS
+
+# Files of a split mapped to the dataset they are stored under, as in the Oxford-IIIT pet splits
+SAMPLE_DATASETS = {'images': 'ims', 'masks': 'masks', 'bboxes': 'bboxes', 'binary': 'binary'}
+SPLITS = ['train', 'val', 'test']
+# Harmonics of the outline of a blob, and the hue ranges (opencv 0-180) of the two classes
+HARMONICS = 5
+CLASS_HUES = {0: (90, 130), 1: (5, 30)}
+
+
+def blob_masks(rng, n_samples, size):
+    """A function for drawing random star shaped blobs, whose radius is a short Fourier series of the angle.
+
+    Args:
+        rng (numpy Generator): Random generator of the chunk.
+        n_samples (int): Number of masks.
+        size (int): Height and width of the masks.
+
+    Returns:
+        masks (numpy array): uint8 masks of shape (n_samples, size, size), 1 inside the blob.
+        distance (numpy array): float32 distance to the centre relative to the outline, 0 at the centre and 1 on it.
+    """
+    centres = rng.uniform(0.3, 0.7, (n_samples, 2, 1, 1)) * size
+    radii = rng.uniform(0.15, 0.35, (n_samples, 1, 1)) * size
+    amplitudes = rng.uniform(0, 0.25, (n_samples, HARMONICS, 1, 1)) / np.arange(1, HARMONICS + 1)[:, None, None]
+    phases = rng.uniform(0, 2 * np.pi, (n_samples, HARMONICS, 1, 1))
+
+    rows, columns = np.mgrid[0:size, 0:size].astype(np.float32) + 0.5
+    dy, dx = rows - centres[:, 0], columns - centres[:, 1]
+    angles = np.arctan2(dy, dx)
+    harmonics = np.arange(1, HARMONICS + 1)[:, None, None]
+    outline = radii * (1 + (amplitudes * np.cos(harmonics * angles[:, None] + phases)).sum(axis=1))
+    distance = (np.sqrt(dx ** 2 + dy ** 2) / outline).astype(np.float32)
+    return (distance < 1).astype(np.uint8), distance
+
+
+def mask_boxes(masks, box_format='xyxy'):
+    """A function for computing the bounding boxes of a batch of masks, as pixel edges.
+
+    Args:
+        masks (numpy array): uint8 masks of shape (batch, height, width).
+        box_format (string, optional): 'xyxy' for (x_min, y_min, x_max, y_max) or 'xywh' for
+        (x_min, y_min, width, height), as read by augment.BatchAugment. Defaults to 'xyxy'.
+
+    Returns:
+        boxes (numpy array): float32 boxes of shape (batch, 4), zeros for an empty mask.
+    """
+    boxes = np.zeros((len(masks), 4), dtype=np.float32)
+    for i, mask in enumerate(masks):
+        rows, columns = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        if len(rows):
+            boxes[i] = columns[0], rows[0], columns[-1] + 1, rows[-1] + 1
+    if box_format == 'xywh':
+        boxes[:, 2:] -= boxes[:, :2]
+    return boxes
+
+
+def smooth_noise(rng, n_samples, size, cells, channels, low, high):
+    """Returns float32 noise of shape (n_samples, size, size, channels), a random cells x cells grid resized up."""
+    grids = rng.uniform(low, high, (n_samples, cells, cells, channels)).astype(np.float32)
+    return np.stack([cv2.resize(grid, (size, size), interpolation=cv2.INTER_CUBIC).reshape(size, size, channels)
+                     for grid in grids])
+
+
+def synthetic_chunk(start, n_samples, size, seed, targets, box_format='xyxy'):
+    """A function for generating a chunk of samples of a synthetic split.
+
+    Every sample is a star shaped blob in front of a smooth textured background. The blob is
+    shaded towards its outline and its hue depends on the class, so the segmentation and
+    classification can be learnt. The chunk is drawn from (seed, start), so the split does not
+    depend on the chunk size or on the number of worker processes.
+
+    Args:
+        start (int): Index of the first sample of the chunk in the split.
+        n_samples (int): Number of samples of the chunk.
+        size (int): Height and width of the images.
+        seed (list): Seed of the split.
+        targets (list): Derived target files computed too (ie: ['canny_filter', 'Labimages', 'noisy_data']).
+        box_format (string, optional): 'xyxy' or 'xywh', see mask_boxes. Defaults to 'xyxy'.
+
+    Returns:
+        chunk (dict): Arrays of the chunk keyed by file name, ie: 'images' of shape (n_samples, size, size, 3).
+    """
+    rng = np.random.default_rng(list(seed) + [start])
+    masks, distance = blob_masks(rng, n_samples, size)
+    binary = rng.integers(0, 2, (n_samples, 1))
+
+    background = smooth_noise(rng, n_samples, size, 4, 3, 30, 220)
+    background += rng.normal(0, 10, background.shape).astype(np.float32)
+    hues = np.array([rng.uniform(*CLASS_HUES[int(label)]) for label in binary[:, 0]], dtype=np.float32)
+    hsv = np.stack([np.full((size, size), hue) for hue in hues])[..., None]
+    hsv = np.concatenate([hsv, np.full_like(hsv, 150), np.full_like(hsv, 255)], axis=-1).astype(np.uint8)
+    colours = np.stack([cv2.cvtColor(image, cv2.COLOR_HSV2RGB) for image in hsv]).astype(np.float32)
+    shading = 1 - 0.5 * np.clip(distance, 0, 1)[..., None]
+    foreground = colours * shading * smooth_noise(rng, n_samples, size, 8, 1, 0.7, 1.0)
+    foreground += rng.normal(0, 6, foreground.shape).astype(np.float32)
+    images = np.where(masks[..., None] == 1, foreground, background)
+    images = np.clip(np.rint(images), 0, 255).astype(np.uint8)
+
+    chunk = {'images': images, 'masks': masks[..., None], 'bboxes': mask_boxes(masks, box_format), 'binary': binary}
+    for name in targets:
+        chunk[name] = TARGET_FUNCTIONS[name](images, start, DEFAULT_PARAMS[name])
+    return chunk
+
+
+def generate_split(data_path, n_samples, size=256, seed=0, targets=None, workers=None, chunk_rows=64,
+                   box_format='xyxy'):
+    """A function for writing a synthetic split with the files and datasets of a real one.
+
+    The samples are generated chunk_rows at a time by a pool of worker processes, with at most two
+    chunks per worker in flight, and written in order, so a split of any size is written with
+    bounded memory. The files are written next to their final name and renamed once complete.
+    The derived targets are stamped like precompute_targets.py stamps them, which then skips them.
+
+    Args:
+        data_path (path): Folder the h5 files are written to (ie: 'data/train/').
+        n_samples (int): Number of samples.
+        size (int, optional): Height and width of the images. Defaults to 256.
+        seed (int or list, optional): Seed of the split. Defaults to 0.
+        targets (list, optional): Derived target files written too, from TARGET_FUNCTIONS. Defaults to all of them.
+        workers (int, optional): Number of worker processes, 0 generates in this process. Defaults to the
+        number of cores.
+        chunk_rows (int, optional): Samples per chunk. Defaults to 64.
+        box_format (string, optional): 'xyxy' or 'xywh', see mask_boxes. Defaults to 'xyxy'.
+
+    Returns:
+        filepaths (list): The h5 files written.
+    """
+    targets = list(TARGET_FUNCTIONS) if targets is None else targets
+    seed = list(np.atleast_1d(seed))
+    workers = os.cpu_count() if workers is None else workers
+    os.makedirs(data_path, exist_ok=True)
+
+    shapes = {'images': (size, size, 3), 'masks': (size, size, 1), 'bboxes': (4,), 'binary': (1,),
+              'canny_filter': (size, size), 'Labimages': (size, size, 3), 'noisy_data': (size, size, 3)}
+    dtypes = {'bboxes': np.float32, 'binary': np.int64}
+    datasets = dict(SAMPLE_DATASETS, **{name: TARGET_DATASETS[name] for name in targets})
+    filepaths = {name: os.path.join(data_path, name + '.h5') for name in datasets}
+    files = {name: h5py.File(filepath + '.partial', 'w') for name, filepath in filepaths.items()}
+    try:
+        # An empty split cannot hold a chunk, its datasets are contiguous
+        outputs = {name: files[name].create_dataset(key, shape=(n_samples,) + shapes[name],
+                                                    dtype=dtypes.get(name, np.uint8),
+                                                    chunks=(min(16, n_samples),) + shapes[name] if n_samples else None)
+                   for name, key in datasets.items()}
+
+        def write(start, chunk):
+            for name, values in chunk.items():
+                outputs[name][start:start + len(values)] = values
+
+        starts = range(0, n_samples, chunk_rows)
+        if workers == 0:
+            for start in starts:
+                write(start, synthetic_chunk(start, min(chunk_rows, n_samples - start), size, seed, targets,
+                                             box_format))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = collections.deque()
+                for start in starts:
+                    pending.append((start, pool.submit(synthetic_chunk, start, min(chunk_rows, n_samples - start),
+                                                       size, seed, targets, box_format)))
+                    if len(pending) >= 2 * workers:
+                        write(*precompute_targets.next_result(pending))
+                while pending:
+                    write(*precompute_targets.next_result(pending))
+    finally:
+        for h5_file in files.values():
+            h5_file.close()
+
+    if targets:
+        source_hash = precompute_targets.file_hash(filepaths['images'] + '.partial')
+        for name in targets:
+            with h5py.File(filepaths[name] + '.partial', 'a') as h5_file:
+                h5_file.attrs['source_sha256'] = source_hash
+                h5_file.attrs['params'] = json.dumps(DEFAULT_PARAMS[name], sort_keys=True)
+    for filepath in filepaths.values():
+        os.replace(filepath + '.partial', filepath)
+    print(f'{data_path}: {n_samples} synthetic samples of {size}x{size}, {", ".join(filepaths)}')
+    return list(filepaths.values())
+
+
+def process_args():
+    """A function used to customise the synthetic dataset from the terminal.
+
+    Returns:
+        Interprets the arguments added to the argument parser object during the running of the script.
+    """
+    ap = argparse.ArgumentParser(description="Write synthetic train/val/test splits with the h5 files of the dataset")
+    ap.add_argument('data_path', nargs='?', help='folder the train, val and test splits are written to',
+                    default='data/')
+    ap.add_argument("-n", '--n_samples', help='comma separated samples of the train, val and test splits',
+                    default='1000,200,200')
+    ap.add_argument("-s", '--size', help='height and width of the images', default=256)
+    ap.add_argument("-t", '--targets', help="comma separated derived targets written too, or 'none'",
+                    default=','.join(TARGET_FUNCTIONS))
+    ap.add_argument("-sd", '--seed', help='seed of the dataset', default=0)
+    ap.add_argument("-w", '--workers', help='number of worker processes (default: number of cores)', default=None)
+    ap.add_argument("-c", '--chunk_rows', help='samples generated at a time per worker', default=64)
+    ap.add_argument("-bf", '--box_format', help='layout of the bounding boxes (xyxy/xywh)', default='xyxy')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_args()
+    targets = [] if args.targets == 'none' else args.targets.split(',')
+    workers = None if args.workers is None else int(args.workers)
+    for index, (split, n_samples) in enumerate(zip(SPLITS, args.n_samples.split(','))):
+        generate_split(os.path.join(args.data_path, split), int(n_samples), size=int(args.size),
+                       seed=[int(args.seed), index], targets=targets, workers=workers,
+                       chunk_rows=int(args.chunk_rows), box_format=args.box_format)
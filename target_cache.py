@@ -0,0 +1,233 @@
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+import precompute_targets
+from load_data import TargetProvider
+
+# Source file path mapped to its size, modification time and sha256, kept next to the cached entries
+SOURCES_FILE = 'sources.json'
+
+
+class TargetCache:
+    """
+    Memoises derived targets one sample at a time in a local folder, so a target is computed once
+    and then read back until it is evicted.
+
+    Every entry is keyed by (target name, sha256 of the source file, target parameters, sample index)
+    and stored as a .npy file. Reading an entry refreshes its modification time, and once the entries
+    take more than max_bytes the least recently used ones are deleted until they fit in 90% of it.
+
+    Entries are written to a temporary file and renamed, so DataLoader workers can share the folder.
+    The hit and miss counters are kept in shared memory and updated under its lock, so they count
+    the reads of every worker.
+    """
+
+    def __init__(self, cache_path, max_bytes=2 ** 30):
+        """
+        @params:
+        cache_path(string): Folder the entries are stored in, created if missing
+        max_bytes(int): Byte budget of the entries
+        """
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        os.makedirs(cache_path, exist_ok=True)
+        self.counters = multiprocessing.Array('q', 2)
+        self.sources = {}
+        self.size = None
+
+    @property
+    def hits(self):
+        return int(self.counters[0])
+
+    @property
+    def misses(self):
+        return int(self.counters[1])
+
+    def report(self):
+        """Returns a one line summary of the hits, misses and size of the cache."""
+        entries = self.entries()
+        size = sum(size for path, size, mtime in entries)
+        total = max(1, self.hits + self.misses)
+        return (f"target cache {self.cache_path}: {self.hits} hits, {self.misses} misses "
+                f"({100 * self.hits / total:.1f}% hit rate), {len(entries)} entries, "
+                f"{size / 2 ** 20:.1f} of {self.max_bytes / 2 ** 20:.1f} MB")
+
+    def source_hash(self, source_path):
+        """A function for identifying the contents of a source file by their sha256.
+
+        The digest is remembered in SOURCES_FILE with the size and modification time of the file,
+        and only computed again once either of them changes.
+
+        Args:
+            source_path (path): File the targets are derived from (ie: 'data/train/images.h5').
+
+        Returns:
+            source_hash (str): sha256 of the file.
+        """
+        source_path = os.path.realpath(source_path)
+        stat = os.stat(source_path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        if source_path in self.sources and self.sources[source_path]['stamp'] == stamp:
+            return self.sources[source_path]['sha256']
+
+        sources_filepath = os.path.join(self.cache_path, SOURCES_FILE)
+        try:
+            with open(sources_filepath) as file:
+                self.sources.update(json.load(file))
+        except (OSError, ValueError):
+            pass
+        if source_path not in self.sources or self.sources[source_path]['stamp'] != stamp:
+            self.sources[source_path] = {'stamp': stamp, 'sha256': precompute_targets.file_hash(source_path)}
+            partial_filepath = f'{sources_filepath}.{os.getpid()}.partial'
+            with open(partial_filepath, 'w') as file:
+                json.dump(self.sources, file, indent=2)
+            os.replace(partial_filepath, sources_filepath)
+        return self.sources[source_path]['sha256']
+
+    def entry_path(self, name, source_hash, params, index):
+        """Returns the file of the entry of sample index, for a target computed from source_hash with params."""
+        key = hashlib.sha1(f'{name}:{source_hash}:{params}:{index}'.encode()).hexdigest()
+        return os.path.join(self.cache_path, key[:2], key + '.npy')
+
+    def get(self, path):
+        """Returns the array stored in entry path and marks it as recently used, or None on a miss."""
+        try:
+            array = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            # Missing, evicted by another worker in the meantime or half written by a killed process
+            self.count(miss=True)
+            return None
+        self.count(miss=False)
+        return array
+
+    def count(self, miss):
+        """Adds a hit or a miss to the counters shared by the workers."""
+        with self.counters.get_lock():
+            self.counters[int(miss)] += 1
+
+    def put(self, path, array):
+        """Stores array as entry path, evicting the least recently used entries when over budget."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = f'{path[:-4]}.{os.getpid()}.partial.npy'
+        np.save(partial_path, array)
+        os.replace(partial_path, path)
+
+        if self.size is None:
+            self.size = sum(size for entry, size, mtime in self.entries())
+        else:
+            self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """Returns the (path, size, modification time) of every entry in the cache."""
+        entries = []
+        for folder in os.scandir(self.cache_path):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith('.npy') and '.partial' not in entry.name:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_mtime_ns))
+        return entries
+
+    def evict(self, low_water=0.9):
+        """A function for deleting the least recently used entries until they fit in low_water * max_bytes.
+
+        Args:
+            low_water (float, optional): Fraction of max_bytes left in use, so that eviction does not
+            run again on the next entry. Defaults to 0.9.
+        """
+        # Other workers write to the same folder, so the size is measured again
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.size = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if self.size <= low_water * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+    def clear(self):
+        """Deletes every entry and resets the counters."""
+        for path, size, mtime in self.entries():
+            os.remove(path)
+        self.size = 0
+        with self.counters.get_lock():
+            self.counters[:] = [0, 0]
+
+
+class CachedTarget(TargetProvider):
+    """
+    Derived target computed from the images of a split by one of the chunk functions of
+    precompute_targets.py on the first read of every sample, and read back from a TargetCache after
+    that. Replaces writing a whole target file per split (ie: canny_filter.h5) with a bounded cache.
+
+    Subclasses returning more than one label from the target override labels, see
+    lab_loader.CachedLabTarget and denoising_loader.CachedNoisyTarget.
+    """
+
+    def __init__(self, label, name, cache, params=None, image=False):
+        """
+        @params:
+        label(string): Name the target is returned under (ie: 'canny')
+        name(string): Target of precompute_targets.TARGET_FUNCTIONS computed (ie: 'canny_filter')
+        cache(TargetCache): Cache the computed targets are stored in
+        params(dict): Parameters of the target, defaults to precompute_targets.DEFAULT_PARAMS[name]
+        image(bool): The labels are images, so the transforms of the dataset apply to them
+        """
+        super().__init__(label, 'images', image=image)
+        self.name = name
+        self.cache = cache
+        self.params = dict(precompute_targets.DEFAULT_PARAMS[name], **(params or {}))
+        self.function = precompute_targets.TARGET_FUNCTIONS[name]
+
+    def prepare(self, data_path):
+        # Hash the images once before the workers start, they read the digest from the cache folder. The
+        # entries are keyed by images.h5 whether it is read from mmap/, packed.h5 or shared memory, see compute
+        images_filepath = os.path.join(data_path, 'images.h5')
+        if os.path.isfile(images_filepath):
+            self.cache.source_hash(images_filepath)
+
+    def read(self, dataset, indices):
+        images = dataset.read_field('images', indices)
+        batch = isinstance(indices, (list, tuple, range, np.ndarray))
+        targets = self.compute(dataset, np.asarray(images) if batch else np.asarray(images)[None],
+                               list(indices) if batch else [indices])
+        return self.labels(images, targets if batch else targets[0])
+
+    def compute(self, dataset, images, indices):
+        """A function for looking up the targets of a mini-batch, computing and storing the missing ones.
+
+        Args:
+            dataset (MultiTaskDataset): Dataset the images were read from.
+            images (numpy array): uint8 images of the mini-batch, shape (batch, height, width, 3).
+            indices (list): Index of every image in its split.
+
+        Returns:
+            targets (numpy array): Targets of the mini-batch, stacked.
+        """
+        source_hash = self.cache.source_hash(dataset.h5.source('images'))
+        params = json.dumps(self.params, sort_keys=True)
+        targets = []
+        for image, index in zip(images, indices):
+            path = self.cache.entry_path(self.name, source_hash, params, int(index))
+            target = self.cache.get(path)
+            if target is None:
+                # start is the sample index, which seeds the noise of noisy_chunk
+                target = self.function(image[None].astype(np.uint8), int(index), self.params)[0]
+                self.cache.put(path, target)
+            targets.append(target)
+        return np.stack(targets)
+
+    def labels(self, images, targets):
+        """Returns the labels of the samples from their images and targets."""
+        return {self.label: targets}
@@ -1,9 +1,14 @@
 from sklearn.metrics import jaccard_score, f1_score
 import torch
 import numpy as np
+from prefetcher import BatchPrefetcher
+import train_model
+import train_canny
+import train_color
+import train_denoising
 
 
-def evaluate_model_on_data(test_loader, model, device, loss_criterion, model_name=""):
+def evaluate_model_on_data(test_loader, model, device, loss_criterion, model_name="", prefetch_depth=2):
     """A function for the testing the model on the specified testing data.
 
     Args:
@@ -12,6 +17,7 @@ def evaluate_model_on_data(test_loader, model, device, loss_criterion, model_nam
         device (string): the device used for training of the model (cpu or cuda).
         loss_criterion (pytorch object): a loss function for the respective model type.
         model_name (str, optional): Name assigned to the model. Defaults to "".
+        prefetch_depth (int, optional): Number of mini-batches prepared ahead on a background thread. Defaults to 2.
     """
     test_loss = []
     test_accuracy = []
@@ -24,17 +30,9 @@ def evaluate_model_on_data(test_loader, model, device, loss_criterion, model_nam
 
     # Evaluate model
     # Compute Testing metrics
-    for i, batch_data in enumerate(test_loader, 1):
+    test_batches = BatchPrefetcher(test_loader, train_model.prepare_batch, device, depth=prefetch_depth)
+    for i, (inputs, mask, binary, bbox) in enumerate(test_batches, 1):
         with torch.no_grad():
-            inputs, labels = batch_data
-            inputs = inputs.to(device)
-            mask = torch.squeeze(labels['mask'].to(device))
-            mask = mask.to(torch.long)
-            binary = torch.squeeze(labels['classification'].to(device))
-            binary = binary.to(torch.long)
-            bbox = labels['bbox'].to(device)
-            bbox = bbox.float()
-
             classes, boxes, segmask = model(inputs)
 
             loss, labels_loss, segmentation_loss, bboxes_loss = loss_criterion(input_labels=classes,
@@ -43,8 +41,9 @@ def evaluate_model_on_data(test_loader, model, device, loss_criterion, model_nam
                                                                                target_segmentations=mask,
                                                                                target_bboxes=bbox)
 
-            pred_ax = np.argmax(classes.detach().cpu().numpy(), axis=1)
-            test_accuracy.append(np.sum((binary.detach().cpu().numpy() == pred_ax).astype(int)) / len(binary))
+            if binary is not None:
+                pred_ax = np.argmax(classes.detach().cpu().numpy(), axis=1)
+                test_accuracy.append(np.sum((binary.detach().cpu().numpy() == pred_ax).astype(int)) / len(binary))
             test_loss.append(loss.item())
 
             test_label_loss.append(labels_loss.data.item())
@@ -62,9 +61,14 @@ def evaluate_model_on_data(test_loader, model, device, loss_criterion, model_nam
             test_bbox_loss.append(bboxes_loss.data.item())
 
     print("-----------------------Testing Metrics-------------------------------------------")
+    print(f"Data wait: {round(test_batches.wait_time, 3)} seconds")
     file = open("output.txt", "a")
     print("Model Name: " + str(model_name), file=file)
-    print("Loss: ", round(np.mean(test_loss), 3), "Test Accu: ", round(np.mean(test_accuracy), 3), file=file)
+    # Models without the classification task have no accuracy
+    if test_accuracy:
+        print("Loss: ", round(np.mean(test_loss), 3), "Test Accu: ", round(np.mean(test_accuracy), 3), file=file)
+    else:
+        print("Loss: ", round(np.mean(test_loss), 3), file=file)
     print("IOU: ", round(np.mean(test_iou), 3), file=file)
     print("BBOX-loss: ", round(np.mean(test_bbox_loss), 3), file=file)
     print("Segmnetaiton-loss", round(np.mean(test_segmentation_loss), 3), file=file)
@@ -74,7 +78,7 @@ def evaluate_model_on_data(test_loader, model, device, loss_criterion, model_nam
     file.close()
 
 
-def evaluate_color_on_data(test_loader, model, device, loss_criterion, model_name=""):
+def evaluate_color_on_data(test_loader, model, device, loss_criterion, model_name="", prefetch_depth=2):
     """A function for the testing colorisation on the specified testing data.
 
     Args:
@@ -83,6 +87,7 @@ def evaluate_color_on_data(test_loader, model, device, loss_criterion, model_nam
         device (string): the device used for training of the model (cpu or cuda).
         loss_criterion (pytorch object): a loss function for the respective model type.
         model_name (str, optional): Name assigned to the model. Defaults to "".
+        prefetch_depth (int, optional): Number of mini-batches prepared ahead on a background thread. Defaults to 2.
     """
     test_loss = []
     test_accuracy = []
@@ -96,18 +101,9 @@ def evaluate_color_on_data(test_loader, model, device, loss_criterion, model_nam
 
     # Evaluate model
     # Compute Testing metrics
-    for i, batch_data in enumerate(test_loader, 1):
+    test_batches = BatchPrefetcher(test_loader, train_color.prepare_batch, device, depth=prefetch_depth)
+    for i, (inputs, mask, binary, bbox, label_ab) in enumerate(test_batches, 1):
         with torch.no_grad():
-            inputs, labels = batch_data
-            inputs = inputs.to(device)
-            mask = torch.squeeze(labels['mask'].to(device))
-            mask = mask.to(torch.long)
-            binary = torch.squeeze(labels['classification'].to(device))
-            binary = binary.to(torch.long)
-            bbox = labels['bbox'].to(device)
-            label_ab = labels['ab'].to(device)
-
-            bbox = bbox.float()
             classes, boxes, segmask, ab = model(inputs)
 
             loss, labels_loss, segmentation_loss, bboxes_loss, ab_loss = loss_criterion(input_labels=classes,
@@ -140,6 +136,7 @@ def evaluate_color_on_data(test_loader, model, device, loss_criterion, model_nam
             test_bbox_loss.append(bboxes_loss.data.item())
 
     print("-----------------------Testing Metrics-------------------------------------------")
+    print(f"Data wait: {round(test_batches.wait_time, 3)} seconds")
     file = open("output.txt", "a")
     print("Model Name: " + str(model_name), file=file)
     print("Loss: ", round(np.mean(test_loss), 3), "Test Accu: ", round(np.mean(test_accuracy), 3), file=file)
@@ -153,7 +150,7 @@ def evaluate_color_on_data(test_loader, model, device, loss_criterion, model_nam
     file.close()
 
 
-def evaluate_denoising(test_loader, model, device, loss_criterion, model_name=""):
+def evaluate_denoising(test_loader, model, device, loss_criterion, model_name="", prefetch_depth=2):
     """A function for the testing denoising on the specified testing data.
 
     Args:
@@ -162,6 +159,7 @@ def evaluate_denoising(test_loader, model, device, loss_criterion, model_name=""
         device (string): the device used for training of the model (cpu or cuda).
         loss_criterion (pytorch object): a loss function for the respective model type.
         model_name (str, optional): Name assigned to the model. Defaults to "".
+        prefetch_depth (int, optional): Number of mini-batches prepared ahead on a background thread. Defaults to 2.
     """
     test_loss = []
     test_accuracy = []
@@ -177,22 +175,9 @@ def evaluate_denoising(test_loader, model, device, loss_criterion, model_name=""
 
     # Evaluate model
     # Compute Testing metrics
-    for i, batch_data in enumerate(test_loader, 1):
+    test_batches = BatchPrefetcher(test_loader, train_denoising.prepare_batch, device, depth=prefetch_depth)
+    for i, (inputs, mask, binary, bbox, denoised_target) in enumerate(test_batches, 1):
         with torch.no_grad():
-            inputs, labels = batch_data
-            inputs = inputs.to(device)
-            mask = torch.squeeze(labels['mask'].to(device))
-            mask = mask.to(torch.long)
-            binary = torch.squeeze(labels['classification'].to(device))
-            binary = binary.to(torch.long)
-            bbox = labels['bbox'].to(device)
-
-            try:
-                denoised_target = labels['denoised'].to(device)
-            except:
-                denoised_target = None
-
-            bbox = bbox.float()
             classes, boxes, segmask, denoised_pred = model(inputs)
             loss, labels_loss, segmentation_loss, bboxes_loss, denoise_loss = loss_criterion(input_labels=classes,
                                                                                              input_segmentations=segmask, \
@@ -236,6 +221,7 @@ def evaluate_denoising(test_loader, model, device, loss_criterion, model_name=""
             test_f1_arr.append(test_f1)
 
     print("-----------------------Testing Metrics-------------------------------------------")
+    print(f"Data wait: {round(test_batches.wait_time, 3)} seconds")
     file = open("output.txt", "a")
     print("Model Name: " + str(model_name), file=file)
     print("Loss: ", round(np.mean(test_loss), 3), "Test Accu: ", round(np.mean(test_accuracy), 3), file=file)
@@ -254,7 +240,7 @@ def evaluate_denoising(test_loader, model, device, loss_criterion, model_name=""
     # if its segnet,
 
 
-def evaluate_opencv_filters(test_loader, model, device, loss_criterion, model_name=""):
+def evaluate_opencv_filters(test_loader, model, device, loss_criterion, model_name="", prefetch_depth=2):
     """A function for the testing the canny filter on the specified testing data.
 
     Args:
@@ -263,6 +249,7 @@ def evaluate_opencv_filters(test_loader, model, device, loss_criterion, model_na
         device (string): the device used for training of the model (cpu or cuda).
         loss_criterion (pytorch object): a loss function for the respective model type.
         model_name (str, optional): Name assigned to the model. Defaults to "".
+        prefetch_depth (int, optional): Number of mini-batches prepared ahead on a background thread. Defaults to 2.
     """
     test_loss = []
     test_accuracy = []
@@ -278,21 +265,9 @@ def evaluate_opencv_filters(test_loader, model, device, loss_criterion, model_na
 
     # Evaluate model
     # Compute Testing metrics
-    for i, batch_data in enumerate(test_loader, 1):
+    test_batches = BatchPrefetcher(test_loader, train_canny.prepare_batch, device, depth=prefetch_depth)
+    for i, (inputs, mask, binary, bbox, opencv_filter) in enumerate(test_batches, 1):
         with torch.no_grad():
-            inputs, labels = batch_data
-            inputs = inputs.to(device)
-            mask = torch.squeeze(labels['mask'].to(device))
-            mask = mask.to(torch.long)
-            binary = torch.squeeze(labels['classification'].to(device))
-            binary = binary.to(torch.long)
-            bbox = labels['bbox'].to(device)
-            bbox = bbox.float()
-
-            # Add opencv filter data
-            opencv_filter = labels['canny'].to(device)
-            opencv_filter = opencv_filter.to(torch.long).unsqueeze(dim=1)
-
             # Forward pass
             classes, boxes, segmask, opencv_pred = model(inputs)
 
@@ -335,6 +310,7 @@ def evaluate_opencv_filters(test_loader, model, device, loss_criterion, model_na
             test_f1_arr.append(test_f1)
 
     print("-----------------------Testing Metrics-------------------------------------------")
+    print(f"Data wait: {round(test_batches.wait_time, 3)} seconds")
     file = open("output.txt", "a")
     print("Model Name: " + str(model_name), file=file)
     print("Loss: ", round(np.mean(test_loss), 3), "Test Accu: ", round(np.mean(test_accuracy), 3), file=file)
@@ -346,3 +322,27 @@ def evaluate_opencv_filters(test_loader, model, device, loss_criterion, model_na
     print("F1s", round(np.mean(test_f1_arr), 3), file=file)
     print("OpenCVFilter-loss", round(np.mean(test_filter_loss), 3), file=file)
     file.close()
+
+
+def predict_images(image_loader, model, device, prepare, prefetch_depth=2):
+    """A function for predicting on images without labels, ie: an image_folder.ImageFolderLoader.
+
+    Args:
+        image_loader (iterable): Loader returning the raw mini-batches of the images.
+        model (pytorch object): pytorch model for the network.
+        device (string): the device the model runs on (cpu or cuda).
+        prepare (function): Moves a raw mini-batch to the device and normalises its inputs, returning
+        (inputs, batch) (ie: image_folder.prepare_images).
+        prefetch_depth (int, optional): Number of mini-batches prepared ahead on a background thread. Defaults to 2.
+
+    Yields:
+        batch, classes, boxes, segmask: The raw mini-batch on the device and the class logits, bounding
+        boxes and segmentation logits predicted for it.
+    """
+    model.eval()
+    batches = BatchPrefetcher(image_loader, prepare, device, depth=prefetch_depth)
+    for inputs, batch in batches:
+        with torch.no_grad():
+            outputs = model(inputs)
+        classes, boxes, segmask = outputs[:3]
+        yield batch, classes, boxes, segmask
@@ -0,0 +1,21 @@
+import torch
+from denoising_loader import OnlineNoise, EVALUATION_NOISE
+
+
+def test_evaluation_noise_differs_from_training():
+    images = torch.full((4, 16, 16, 3), 128, dtype=torch.uint8)
+    indices = torch.arange(4)
+    train_noise = OnlineNoise()
+
+    for epoch in range(3):
+        train_noise.set_epoch(epoch)
+        training = train_noise(images, indices)
+        evaluation = EVALUATION_NOISE(images, indices)
+        for i in range(len(indices)):
+            assert not torch.equal(training[i], evaluation[i])
+
+
+def test_evaluation_noise_is_fixed():
+    images = torch.full((4, 16, 16, 3), 128, dtype=torch.uint8)
+    indices = torch.arange(4)
+    assert torch.equal(EVALUATION_NOISE(images, indices), EVALUATION_NOISE(images, indices))
@@ -0,0 +1,18 @@
+import os
+import h5py
+import numpy as np
+import pytest
+from precompute_targets import TARGET_DATASETS, precompute_target
+
+
+@pytest.mark.parametrize('name', list(TARGET_DATASETS))
+def test_precompute_empty_split(tmp_path, name):
+    images_filepath = os.path.join(tmp_path, 'images.h5')
+    with h5py.File(images_filepath, 'w') as images:
+        images.create_dataset('images', shape=(0, 8, 8, 3), dtype=np.uint8)
+    target_filepath = os.path.join(tmp_path, name + '.h5')
+
+    assert precompute_target(name, images_filepath, target_filepath, workers=0)
+    with h5py.File(target_filepath, 'r') as target:
+        assert target[TARGET_DATASETS[name]].shape[0] == 0
+    assert not precompute_target(name, images_filepath, target_filepath, workers=0)
@@ -1,4 +1,6 @@
+import os
 import sys
+import functools
 import torch
 import numpy as np
 import time
@@ -7,10 +9,43 @@ import pt_networks.segnet
 import torch.optim as optim
 from datetime import datetime
 from torch.utils.tensorboard import SummaryWriter
+import model_utils
+from load_data import normalise_batch, set_epoch
+from data_loader_canny import batch_canny
+from prefetcher import BatchPrefetcher
+
+
+def prepare_batch(batch_data, device, augment=None):
+    """A function used for moving a mini-batch to the device and normalising its inputs.
+
+    Args:
+        batch_data (Batch): Raw images and labels, as returned by the data loader. The canny edge maps are
+        computed from the raw images when the loader does not read them.
+        device (string): the device used for training of the model (cpu or cuda).
+        augment (BatchAugment, optional): flips, crops and colour jitter applied to the raw mini-batch and its labels
+        on the device, before they are normalised. Defaults to None.
+
+    Returns:
+        inputs, mask, binary, bbox, opencv_filter (tensors): Normalised images, segmentation masks, classes,
+        bounding boxes and canny edge maps.
+    """
+    batch = batch_data.to(device, non_blocking=True)
+    if augment is not None:
+        # Edge maps computed below come from the augmented images, the ones read from file are transformed alike
+        batch = augment(batch)
+    inputs = normalise_batch(batch.image)
+
+    # Add opencv filter data, read from canny_filter.h5 when the loader provides it, otherwise computed on the device
+    if batch.canny is not None:
+        opencv_filter = batch.canny
+    else:
+        opencv_filter = batch_canny(batch.image).to(torch.long)
+    return inputs, batch.mask, batch.classification, batch.bbox, opencv_filter.unsqueeze(dim=1)
 
 
 def train_model(model_type, train_loader, validation_loader, model, optimizer, loss_criterion, epochs, device,
-                soft_adapt=False, opencv_filters=False):
+                soft_adapt=False, opencv_filters=False, prefetch_depth=2, checkpoint_path=None, checkpoint_every=0,
+                augment=None):
     log_name = f'{model_type}/'
     date = datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
     writer = SummaryWriter('logs/{}{}'.format(log_name, date))
@@ -27,6 +62,13 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         loss_criterion (pytorch object): a loss function for the respective model type.
         epochs (int): the number of epochs/iteration used for training.
         device (string): the device used for training of the model (cpu or cuda).
+        prefetch_depth (int, optional): the number of mini-batches prepared ahead on a background thread. Defaults to 2.
+        checkpoint_path (path, optional): file the training state is saved to after every epoch, and resumed from
+        when it exists. Defaults to None.
+        checkpoint_every (int, optional): also save the training state every checkpoint_every mini-batches, so an
+        interrupted epoch resumes at its first unseen mini-batch. Defaults to 0 (end of the epochs only).
+        augment (BatchAugment, optional): random flips, crops and colour jitter applied to the training mini-batches
+        on the device, with new transforms every epoch. Defaults to None.
     """
 
     best_val_accuracy = 0
@@ -39,8 +81,22 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
 
     alpha = torch.ones(3)
 
+    # Batches are moved to the device while the previous step runs
+    train_batches = BatchPrefetcher(train_loader, functools.partial(prepare_batch, augment=augment), device,
+                                    depth=prefetch_depth)
+    validation_batches = BatchPrefetcher(validation_loader, prepare_batch, device, depth=prefetch_depth)
+
     # Iterate over whole dataset
-    for epoch in range(epochs):
+    # Resume at the first mini-batch the checkpoint was not trained on
+    start_epoch, start_batch = 0, 0
+    if checkpoint_path and os.path.isfile(checkpoint_path):
+        checkpoint = model_utils.load_checkpoint(checkpoint_path, model, optimizer, device)
+        start_epoch, start_batch = checkpoint['epoch'], checkpoint['batch']
+
+    for epoch in range(start_epoch, epochs):
+        set_epoch(train_loader, epoch, start_batch)
+        if augment is not None:
+            augment.set_epoch(epoch, start_batch)
 
         # Set list to monitor performance
         time_epoch = time.time()
@@ -66,21 +122,7 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         val_f1_arr = []
 
         # Iterate over mini-batches
-        for i, batch_data in enumerate(train_loader, 1):
-            # Format data
-            inputs, labels = batch_data
-            inputs = inputs.to(device)
-            mask = torch.squeeze(labels['mask'].to(device))
-            mask = mask.to(torch.long)
-            binary = torch.squeeze(labels['classification'].to(device))
-            binary = binary.to(torch.long)
-            bbox = labels['bbox'].to(device)
-            bbox = bbox.float()
-
-            # Add opencv filter data
-            opencv_filter = labels['canny'].to(device)
-            opencv_filter = opencv_filter.to(torch.long).unsqueeze(dim=1)
-
+        for i, (inputs, mask, binary, bbox, opencv_filter) in enumerate(train_batches, 1):
             # Forward pass
             optimizer.zero_grad()
             classes, boxes, segmask, opencv_pred = model(inputs)
@@ -128,24 +170,13 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
             # Backward propagations
             loss.backward()
             optimizer.step()
+            if checkpoint_path and checkpoint_every and (start_batch + i) % checkpoint_every == 0:
+                model_utils.save_checkpoint(checkpoint_path, model, optimizer, epoch, start_batch + i)
+        start_batch = 0
 
         # Compute validations metrics
-        for i, batch_data in enumerate(validation_loader, 1):
+        for i, (inputs, mask, binary, bbox, opencv_filter) in enumerate(validation_batches, 1):
             with torch.no_grad():
-                # Format data.
-                inputs, labels = batch_data
-                inputs = inputs.to(device)
-                mask = torch.squeeze(labels['mask'].to(device))
-                mask = mask.to(torch.long)
-                binary = torch.squeeze(labels['classification'].to(device))
-                binary = binary.to(torch.long)
-                bbox = labels['bbox'].to(device)
-                bbox = bbox.float()
-
-                # Add opencv filter data
-                opencv_filter = labels['canny'].to(device)
-                opencv_filter = opencv_filter.to(torch.long).unsqueeze(dim=1)
-
                 # Model Inference
                 classes, boxes, segmask, opencv_pred = model(inputs)
 
@@ -221,6 +252,8 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         print("Label-loss", round(np.mean(val_label_loss), 3))
         print("Jac", round(np.mean(val_jaca), 3))
         print("F1s", round(np.mean(val_f1_arr), 3))
+        print(f"Data wait: train {round(train_batches.wait_time, 3)} seconds, "
+              f"validation {round(validation_batches.wait_time, 3)} seconds")
 
         # Add values to tensorboard.
         writer.add_scalar('Train-Epoch-Accuracy', round(np.mean(train_accuracy), 3), epoch)
@@ -238,6 +271,8 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         writer.add_scalar('Val-Epoch-label-loss', round(np.mean(val_label_loss), 3), epoch)
         writer.add_scalar('val-Epoch-JAC', round(np.mean(val_jaca), 3), epoch)
         writer.add_scalar('va,-Epoch-f1', round(np.mean(val_f1_arr), 3), epoch)
+        writer.add_scalar('Train-Epoch-data-wait', train_batches.wait_time, epoch)
+        writer.add_scalar('Val-Epoch-data-wait', validation_batches.wait_time, epoch)
 
         # if round(np.mean(val_iou),3) > best_val_iou: #and round(np.mean(val_accuracy),3) > best_val_accuracy:
 
@@ -246,3 +281,5 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
 
         # Save model checkpoint
         torch.save(model.state_dict(), f'{model_type}_Epochs_{epochs}.pt')
+        if checkpoint_path:
+            model_utils.save_checkpoint(checkpoint_path, model, optimizer, epoch + 1, 0)
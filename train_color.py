@@ -1,14 +1,42 @@
+import os
 import sys
+import functools
 import torch
 import numpy as np
 import time
 import torch.optim as optim
 from datetime import datetime
 from torch.utils.tensorboard import SummaryWriter
+import model_utils
+from load_data import normalise_batch, set_epoch
+from prefetcher import BatchPrefetcher
 from sklearn.metrics import jaccard_score, f1_score
 
 
-def train_model(model_type, train_loader, validation_loader, model, optimizer, loss_criterion, epochs, device):
+def prepare_batch(batch_data, device, augment=None):
+    """A function used for moving a mini-batch to the device and normalising its inputs.
+
+    Args:
+        batch_data (Batch): Raw L channels and labels, as returned by the data loader.
+        device (string): the device used for training of the model (cpu or cuda).
+        augment (BatchAugment, optional): flips, crops and colour jitter applied to the raw mini-batch and its labels
+        on the device, before they are normalised. Defaults to None.
+
+    Returns:
+        inputs, mask, binary, bbox, label_ab (tensors): Normalised L channels, segmentation masks, classes,
+        bounding boxes and normalised ab channels.
+    """
+    batch = batch_data.to(device, non_blocking=True)
+    if augment is not None:
+        batch = augment(batch)
+    # Lab values are normalised from 0-255 (see lab_loader.rgb_to_lab)
+    inputs = normalise_batch(batch.image, rescale=False)
+    label_ab = normalise_batch(batch.ab, rescale=False)
+    return inputs, batch.mask, batch.classification, batch.bbox, label_ab
+
+
+def train_model(model_type, train_loader, validation_loader, model, optimizer, loss_criterion, epochs, device, prefetch_depth=2, checkpoint_path=None,
+                checkpoint_every=0, augment=None):
     
     model_name = 'Segnet-Colourisation-Pretrained'
     log_name=model_type
@@ -26,6 +54,13 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         loss_criterion (pytorch object): a loss function for the respective model type.
         epochs (int): the number of epochs/iteration used for training.
         device (string): the device used for training of the model (cpu or cuda).
+        prefetch_depth (int, optional): the number of mini-batches prepared ahead on a background thread. Defaults to 2.
+        checkpoint_path (path, optional): file the training state is saved to after every epoch, and resumed from
+        when it exists. Defaults to None.
+        checkpoint_every (int, optional): also save the training state every checkpoint_every mini-batches, so an
+        interrupted epoch resumes at its first unseen mini-batch. Defaults to 0 (end of the epochs only).
+        augment (BatchAugment, optional): random flips, crops and colour jitter applied to the training mini-batches
+        on the device, with new transforms every epoch. Defaults to None.
     """
     best_val_accuracy=0
     best_val_iou=0
@@ -36,8 +71,21 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
     train_segmentation_loss=np.zeros((epochs,))
     train_label_loss=np.zeros((epochs,))
 
+    # Batches are moved to the device while the previous step runs
+    train_batches = BatchPrefetcher(train_loader, functools.partial(prepare_batch, augment=augment), device,
+                                    depth=prefetch_depth)
+    validation_batches = BatchPrefetcher(validation_loader, prepare_batch, device, depth=prefetch_depth)
 
-    for epoch in range(epochs):
+    # Resume at the first mini-batch the checkpoint was not trained on
+    start_epoch, start_batch = 0, 0
+    if checkpoint_path and os.path.isfile(checkpoint_path):
+        checkpoint = model_utils.load_checkpoint(checkpoint_path, model, optimizer, device)
+        start_epoch, start_batch = checkpoint['epoch'], checkpoint['batch']
+
+    for epoch in range(start_epoch, epochs):
+        set_epoch(train_loader, epoch, start_batch)
+        if augment is not None:
+            augment.set_epoch(epoch, start_batch)
 
         time_epoch = time.time()
         train_loss = []
@@ -61,17 +109,8 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         val_f1_arr = []
         
         
-        for i, batch_data in enumerate(train_loader, 1):
+        for i, (inputs, mask, binary, bbox, label_ab) in enumerate(train_batches, 1):
      
-            inputs, labels = batch_data
-            inputs = inputs.to(device)
-            mask = torch.squeeze(labels['mask'].to(device))
-            mask = mask.to(torch.long)
-            binary = torch.squeeze(labels['classification'].to(device))
-            binary = binary.to(torch.long)
-            bbox = labels['bbox'].to(device)
-            label_ab=labels['ab'].to(device)
-            bbox=bbox.float()
             optimizer.zero_grad()
             classes, boxes, segmask,ab = model(inputs)
 
@@ -115,21 +154,12 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
 
             loss.backward()
             optimizer.step()
-        for i, batch_data in enumerate(validation_loader, 1):
+            if checkpoint_path and checkpoint_every and (start_batch + i) % checkpoint_every == 0:
+                model_utils.save_checkpoint(checkpoint_path, model, optimizer, epoch, start_batch + i)
+        start_batch = 0
+        for i, (inputs, mask, binary, bbox, label_ab) in enumerate(validation_batches, 1):
 
          with torch.no_grad():
-            inputs, labels = batch_data
-            inputs = inputs.to(device)
-            mask = torch.squeeze(labels['mask'].to(device))
-            mask = mask.to(torch.long)
-            binary = torch.squeeze(labels['classification'].to(device))
-            binary = binary.to(torch.long)
-            bbox = labels['bbox'].to(device)
-            bbox=bbox.float()            
-            label_ab=labels['ab'].to(device)
-
-            bbox=bbox.float()
-
             optimizer.zero_grad()
             classes, boxes, segmask,ab = model(inputs)
 
@@ -185,6 +215,8 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         print("AB-loss",round(np.mean(val_ab_loss),3))
         print("Jac",round(np.mean(val_jaca),3))
         print("F1s",round(np.mean(val_f1_arr),3))
+        print(f"Data wait: train {round(train_batches.wait_time, 3)} seconds, "
+              f"validation {round(validation_batches.wait_time, 3)} seconds")
 
         writer.add_scalar('Train-Epoch-Accuracy',round(np.mean(train_accuracy),3), epoch)
         writer.add_scalar('Train-Epoch-IOU',round(np.mean(train_iou),3), epoch)
@@ -201,9 +233,13 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         writer.add_scalar('Val-Epoch-Seg-loss',round(np.mean(val_segmentation_loss),3), epoch)
         writer.add_scalar('Val-Epoch-label-loss',round(np.mean(val_label_loss),3), epoch)
         writer.add_scalar('Val-Epoch-ab-loss',round(np.mean(val_ab_loss),3), epoch)
+        writer.add_scalar('Train-Epoch-data-wait', train_batches.wait_time, epoch)
+        writer.add_scalar('Val-Epoch-data-wait', validation_batches.wait_time, epoch)
     
         # if round(np.mean(val_iou),3) > best_val_iou and round(np.mean(val_accuracy),3) > best_val_accuracy:
 
         #  best_val_iou=round(np.mean(val_iou),3)
         #  best_val_accuracy=round(np.mean(val_accuracy),3)
         torch.save(model.state_dict(), model_type+'.pt')
+        if checkpoint_path:
+            model_utils.save_checkpoint(checkpoint_path, model, optimizer, epoch + 1, 0)
@@ -1,4 +1,6 @@
+import os
 import sys
+import functools
 import torch
 import numpy as np
 import time
@@ -6,10 +8,47 @@ from sklearn.metrics import jaccard_score, f1_score
 import torch.optim as optim
 from datetime import datetime
 from torch.utils.tensorboard import SummaryWriter
+import model_utils
+from load_data import normalise_batch, set_epoch
+from prefetcher import BatchPrefetcher
+from denoising_loader import OnlineNoise, EVALUATION_NOISE
+
+
+def prepare_batch(batch_data, device, noise=None, augment=None):
+    """A function used for moving a mini-batch to the device and normalising its inputs.
+
+    Args:
+        batch_data (Batch): Raw (noisy) images and labels, as returned by the data loader.
+        device (string): the device used for training of the model (cpu or cuda).
+        noise (OnlineNoise, optional): Noise added on the device when the loader returns the clean images with
+        their indices (denoising_loader.ONLINE_NOISE_PROVIDERS). Defaults to EVALUATION_NOISE.
+        augment (BatchAugment, optional): flips, crops and colour jitter applied to the raw mini-batch and its labels
+        on the device, before they are normalised. Defaults to None.
+
+    Returns:
+        inputs, mask, binary, bbox, denoised_target (tensors): Normalised images, segmentation masks, classes,
+        bounding boxes and normalised clean images (None when the loader has no denoising targets).
+    """
+    batch = batch_data.to(device, non_blocking=True)
+    if augment is not None:
+        # Before the online noise, so the noise is not stretched by the crops
+        batch = augment(batch)
+    inputs = batch.image
+    denoised_target = batch.denoised
+    if batch.index is not None:
+        # Clean images, the noisy inputs are generated from the sample indices
+        noise = noise or EVALUATION_NOISE
+        denoised_target = inputs
+        inputs = noise(inputs, batch.index)
+    # Noisy images are normalised from 0-255 whether the file is float64 or uint8 (precompute_targets.py)
+    inputs = normalise_batch(inputs, rescale=False if denoised_target is not None else None)
+    if denoised_target is not None:
+        denoised_target = normalise_batch(denoised_target)
+    return inputs, batch.mask, batch.classification, batch.bbox, denoised_target
 
 
 def train_model(model_type, train_loader, validation_loader, model, optimizer, loss_criterion, epochs, device,
-                soft_adapt=False):
+                soft_adapt=False, prefetch_depth=2, checkpoint_path=None, checkpoint_every=0, augment=None):
     log_name = 'model_type/'
     date = datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
     writer = SummaryWriter('logs/{}{}'.format(log_name, date))
@@ -26,6 +65,13 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         loss_criterion (pytorch object): a loss function for the respective model type.
         epochs (int): the number of epochs/iteration used for training.
         device (string): the device used for training of the model (cpu or cuda).
+        prefetch_depth (int, optional): the number of mini-batches prepared ahead on a background thread. Defaults to 2.
+        checkpoint_path (path, optional): file the training state is saved to after every epoch, and resumed from
+        when it exists. Defaults to None.
+        checkpoint_every (int, optional): also save the training state every checkpoint_every mini-batches, so an
+        interrupted epoch resumes at its first unseen mini-batch. Defaults to 0 (end of the epochs only).
+        augment (BatchAugment, optional): random flips, crops and colour jitter applied to the training mini-batches
+        on the device, with new transforms every epoch. Defaults to None.
     """
     best_val_accuracy = 0
     best_val_iou = 0
@@ -76,9 +122,26 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
     alpha = torch.ones(3)
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer)
 
-    for epoch in range(epochs):
+    # Batches are moved to the device while the previous step runs, with new noise every epoch
+    train_noise = OnlineNoise()
+    prepare_train_batch = functools.partial(prepare_batch, noise=train_noise, augment=augment)
+    train_batches = BatchPrefetcher(train_loader, prepare_train_batch, device, depth=prefetch_depth)
+    validation_batches = BatchPrefetcher(validation_loader, prepare_batch, device, depth=prefetch_depth)
+
+    # Resume at the first mini-batch the checkpoint was not trained on
+    start_epoch, start_batch = 0, 0
+    if checkpoint_path and os.path.isfile(checkpoint_path):
+        checkpoint = model_utils.load_checkpoint(checkpoint_path, model, optimizer, device)
+        start_epoch, start_batch = checkpoint['epoch'], checkpoint['batch']
+        scheduler.load_state_dict(checkpoint['scheduler'])
+
+    for epoch in range(start_epoch, epochs):
+        set_epoch(train_loader, epoch, start_batch)
+        if augment is not None:
+            augment.set_epoch(epoch, start_batch)
 
         time_epoch = time.time()
+        train_noise.set_epoch(epoch)
         train_loss = []
         train_accuracy = []
         train_iou = []
@@ -102,22 +165,8 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         val_f1_arr = []
         val_denoise_loss = []
 
-        for i, batch_data in enumerate(train_loader, 1):
-
-            inputs, labels = batch_data
-            inputs = inputs.to(device)
-            mask = torch.squeeze(labels['mask'].to(device))
-            mask = mask.to(torch.long)
-            binary = torch.squeeze(labels['classification'].to(device))
-            binary = binary.to(torch.long)
-            bbox = labels['bbox'].to(device)
+        for i, (inputs, mask, binary, bbox, denoised_target) in enumerate(train_batches, 1):
 
-            try:
-                denoised_target = labels['denoised'].to(device)
-            except:
-                denoised_target = None
-
-            bbox = bbox.float()
             optimizer.zero_grad()
             classes, boxes, segmask, denoised_pred = model(inputs)
             loss, labels_loss, segmentation_loss, bboxes_loss, denoise_loss = loss_criterion(input_labels=classes,
@@ -166,23 +215,14 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
             train_loss.append(loss.item())
             loss.backward()
             optimizer.step()
+            if checkpoint_path and checkpoint_every and (start_batch + i) % checkpoint_every == 0:
+                model_utils.save_checkpoint(checkpoint_path, model, optimizer, epoch, start_batch + i,
+                                            scheduler=scheduler.state_dict())
+        start_batch = 0
 
-        for i, batch_data in enumerate(validation_loader, 1):
+        for i, (inputs, mask, binary, bbox, denoised_target) in enumerate(validation_batches, 1):
 
             with torch.no_grad():
-                inputs, labels = batch_data
-                inputs = inputs.to(device)
-                mask = torch.squeeze(labels['mask'].to(device))
-                mask = mask.to(torch.long)
-                binary = torch.squeeze(labels['classification'].to(device))
-                binary = binary.to(torch.long)
-                bbox = labels['bbox'].to(device)
-                bbox = bbox.float()
-                try:
-                    denoised_target = labels['denoised'].to(device)
-                except:
-                    denoised_target = None
-
                 classes, boxes, segmask, denoised_pred = model(inputs)
                 loss, labels_loss, segmentation_loss, bboxes_loss, denoise_loss = loss_criterion(input_labels=classes,
                                                                                                  input_segmentations=segmask, \
@@ -251,6 +291,8 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         print("Label-loss", round(np.mean(val_label_loss), 3))
         print("Jac", round(np.mean(val_jaca), 3))
         print("F1s", round(np.mean(val_f1_arr), 3))
+        print(f"Data wait: train {round(train_batches.wait_time, 3)} seconds, "
+              f"validation {round(validation_batches.wait_time, 3)} seconds")
 
         writer.add_scalar('Train-Epoch-Accuracy', round(np.mean(train_accuracy), 3), epoch)
         writer.add_scalar('Train-Epoch-IOU', round(np.mean(train_iou), 3), epoch)
@@ -267,9 +309,14 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         writer.add_scalar('Val-Epoch-label-loss', round(np.mean(val_label_loss), 3), epoch)
         writer.add_scalar('val-Epoch-JAC', round(np.mean(val_jaca), 3), epoch)
         writer.add_scalar('va,-Epoch-f1', round(np.mean(val_f1_arr), 3), epoch)
+        writer.add_scalar('Train-Epoch-data-wait', train_batches.wait_time, epoch)
+        writer.add_scalar('Val-Epoch-data-wait', validation_batches.wait_time, epoch)
 
         # if round(np.mean(val_iou),3) > best_val_iou: #and round(np.mean(val_accuracy),3) > best_val_accuracy:
 
         #  best_val_iou=round(np.mean(val_iou),3)
         #    best_val_accuracy=round(np.mean(val_accuracy),3)
         torch.save(model.state_dict(), model_type + '.pt')
+        if checkpoint_path:
+            model_utils.save_checkpoint(checkpoint_path, model, optimizer, epoch + 1, 0,
+                                        scheduler=scheduler.state_dict())
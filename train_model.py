@@ -1,4 +1,6 @@
+import os
 import sys
+import functools
 import torch
 import numpy as np
 import time
@@ -7,10 +9,35 @@ import pt_networks.segnet
 import torch.optim as optim
 from datetime import datetime
 from torch.utils.tensorboard import SummaryWriter
+import model_utils
+from load_data import normalise_batch, set_epoch
+from prefetcher import BatchPrefetcher
 
 
+def prepare_batch(batch_data, device, augment=None):
+    """A function used for moving a mini-batch to the device and normalising its inputs.
 
-def train_model(model_type, train_loader, validation_loader, model, optimizer, loss_criterion, epochs, device,soft_adapt = False):
+    The labels are collated to the types used by the losses by the data loader (see load_data.Batch).
+
+    Args:
+        batch_data (Batch): Raw images and labels, as returned by the data loader.
+        device (string): the device used for training of the model (cpu or cuda).
+        augment (BatchAugment, optional): flips, crops and colour jitter applied to the raw mini-batch and its labels
+        on the device, before they are normalised. Defaults to None.
+
+    Returns:
+        inputs, mask, binary, bbox (tensors): Normalised images, segmentation masks, classes and bounding boxes.
+        binary and bbox are None when the loader does not read them (ie: for Segnet-1task).
+    """
+    batch = batch_data.to(device, non_blocking=True)
+    if augment is not None:
+        batch = augment(batch)
+    inputs = normalise_batch(batch.image)
+    return inputs, batch.mask, batch.classification, batch.bbox
+
+
+def train_model(model_type, train_loader, validation_loader, model, optimizer, loss_criterion, epochs, device,soft_adapt = False,
+                prefetch_depth=2, checkpoint_path=None, checkpoint_every=0, augment=None):
    
     """A function used for the training routine of the selected model using the selected model type, trainloader,
     validation loader, optimizer, loss criterion.
@@ -24,6 +51,13 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         loss_criterion (pytorch object): a loss function for the respective model type.
         epochs (int): the number of epochs/iteration used for training.
         device (string): the device used for training of the model (cpu or cuda).
+        prefetch_depth (int, optional): the number of mini-batches prepared ahead on a background thread. Defaults to 2.
+        checkpoint_path (path, optional): file the training state is saved to after every epoch, and resumed from
+        when it exists. Defaults to None.
+        checkpoint_every (int, optional): also save the training state every checkpoint_every mini-batches, so an
+        interrupted epoch resumes at its first unseen mini-batch. Defaults to 0 (end of the epochs only).
+        augment (BatchAugment, optional): random flips, crops and colour jitter applied to the training mini-batches
+        on the device, with new transforms every epoch. Defaults to None.
     """
     log_name='model_type/'
     date=datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
@@ -76,8 +110,22 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
 
     alpha = torch.ones(3)
 
+    # Batches are moved to the device while the previous step runs
+    train_batches = BatchPrefetcher(train_loader, functools.partial(prepare_batch, augment=augment), device,
+                                    depth=prefetch_depth)
+    validation_batches = BatchPrefetcher(validation_loader, prepare_batch, device, depth=prefetch_depth)
+
     # Iterate over whole dataset
-    for epoch in range(epochs):
+    # Resume at the first mini-batch the checkpoint was not trained on
+    start_epoch, start_batch = 0, 0
+    if checkpoint_path and os.path.isfile(checkpoint_path):
+        checkpoint = model_utils.load_checkpoint(checkpoint_path, model, optimizer, device)
+        start_epoch, start_batch = checkpoint['epoch'], checkpoint['batch']
+
+    for epoch in range(start_epoch, epochs):
+        set_epoch(train_loader, epoch, start_batch)
+        if augment is not None:
+            augment.set_epoch(epoch, start_batch)
 
         # Set list to monitor performance
         time_epoch = time.time()
@@ -101,17 +149,7 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         val_f1_arr = []
 
         # Iterate over mini-batches
-        for i, batch_data in enumerate(train_loader, 1):
-            # Format data
-            inputs, labels = batch_data
-            inputs = inputs.to(device)
-            mask = torch.squeeze(labels['mask'].to(device))
-            mask = mask.to(torch.long)
-            binary = torch.squeeze(labels['classification'].to(device))
-            binary = binary.to(torch.long)
-            bbox = labels['bbox'].to(device)
-            bbox = bbox.float()
-
+        for i, (inputs, mask, binary, bbox) in enumerate(train_batches, 1):
             # Forward pass
             optimizer.zero_grad()
             classes, boxes, segmask = model(inputs)
@@ -128,8 +166,9 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
             train_bbox_loss.append(bboxes_loss.data.item())
 
             # Binary classification metrics.
-            pred_class = np.argmax(classes.detach().cpu().numpy(), axis=1)
-            train_accuracy.append(np.sum((binary.detach().cpu().numpy() == pred_class).astype(int)) / len(binary))
+            if binary is not None:
+                pred_class = np.argmax(classes.detach().cpu().numpy(), axis=1)
+                train_accuracy.append(np.sum((binary.detach().cpu().numpy() == pred_class).astype(int)) / len(binary))
        #     print(f'Minibatch Acc: {train_accuracy[i - 1]}')
 
             # Segmentation metrics.
@@ -157,27 +196,23 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
             # Backward propagations
             loss.backward()
             optimizer.step()
+            if checkpoint_path and checkpoint_every and (start_batch + i) % checkpoint_every == 0:
+                model_utils.save_checkpoint(checkpoint_path, model, optimizer, epoch, start_batch + i)
+        start_batch = 0
 
         # Compute validations metrics
-        for i, batch_data in enumerate(validation_loader, 1):
+        for i, (inputs, mask, binary, bbox) in enumerate(validation_batches, 1):
 
          with torch.no_grad():
-            inputs, labels = batch_data
-            inputs = inputs.to(device)
-            mask = torch.squeeze(labels['mask'].to(device))
-            mask = mask.to(torch.long)
-            binary = torch.squeeze(labels['classification'].to(device))
-            binary = binary.to(torch.long)
-            bbox = labels['bbox'].to(device)
-            bbox=bbox.float()            
             classes, boxes, segmask = model(inputs)
 
             loss,labels_loss,segmentation_loss,bboxes_loss=loss_criterion(input_labels=classes, input_segmentations=segmask, \
                 input_bboxes=boxes, target_labels=binary, target_segmentations=mask,
                 target_bboxes=bbox)
         
-            pred_ax=np.argmax(classes.detach().cpu().numpy(),axis=1)
-            val_accuracy.append(np.sum((binary.detach().cpu().numpy()==pred_ax).astype(int))/len(binary))    
+            if binary is not None:
+                pred_ax=np.argmax(classes.detach().cpu().numpy(),axis=1)
+                val_accuracy.append(np.sum((binary.detach().cpu().numpy()==pred_ax).astype(int))/len(binary))
             val_loss.append(loss.item())  
 
             val_label_loss.append(labels_loss.data.item())
@@ -221,7 +256,11 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         print('----------------------------------------------------------------------------------')
         print(f"Epoch: {epoch + 1} Time taken : {round(time_epoch_vl - time_epoch, 3)} seconds")
         print("-----------------------Training Metrics-------------------------------------------")
-        print("Loss: ", round(np.mean(train_loss), 3), "Train Accu: ", round(np.mean(train_accuracy), 3))
+        # Models without the classification task have no accuracy
+        if train_accuracy:
+            print("Loss: ", round(np.mean(train_loss), 3), "Train Accu: ", round(np.mean(train_accuracy), 3))
+        else:
+            print("Loss: ", round(np.mean(train_loss), 3))
         print("IOU: ", round(np.mean(train_iou), 3))
         print("BBOX-loss: ", round(np.mean(train_bbox_loss), 3))
         print("Segmnetaiton-loss", round(np.mean(train_segmentation_loss), 3))
@@ -230,16 +269,22 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         print("F1s", round(np.mean(train_f1_arr), 3))
 
         print("-----------------------Validation Metrics-------------------------------------------")
-        print("Loss: ", round(np.mean(val_loss), 3), "Val Accu: ", round(np.mean(val_accuracy), 3))
+        if val_accuracy:
+            print("Loss: ", round(np.mean(val_loss), 3), "Val Accu: ", round(np.mean(val_accuracy), 3))
+        else:
+            print("Loss: ", round(np.mean(val_loss), 3))
         print("IOU: ", round(np.mean(val_iou), 3))
         print("BBOX-loss: ", round(np.mean(val_bbox_loss), 3))
         print("Segmnetaiton-loss", round(np.mean(val_segmentation_loss), 3))
         print("Label-loss", round(np.mean(val_label_loss), 3))
         print("Jac", round(np.mean(val_jaca), 3))
         print("F1s", round(np.mean(val_f1_arr), 3))
+        print(f"Data wait: train {round(train_batches.wait_time, 3)} seconds, "
+              f"validation {round(validation_batches.wait_time, 3)} seconds")
 
         # Add values to tensorboard.
-        writer.add_scalar('Train-Epoch-Accuracy', round(np.mean(train_accuracy), 3), epoch)
+        if train_accuracy:
+            writer.add_scalar('Train-Epoch-Accuracy', round(np.mean(train_accuracy), 3), epoch)
         writer.add_scalar('Train-Epoch-IOU', round(np.mean(train_iou), 3), epoch)
         writer.add_scalar('Train-Epoch-BBOX', round(np.mean(train_bbox_loss), 3), epoch)
         writer.add_scalar('Train-Epoch-Seg-loss', round(np.mean(train_segmentation_loss), 3), epoch)
@@ -247,16 +292,21 @@ def train_model(model_type, train_loader, validation_loader, model, optimizer, l
         writer.add_scalar('Train-Epoch-JAC', round(np.mean(train_jaca), 3), epoch)
         writer.add_scalar('Train-Epoch-f1', round(np.mean(train_f1_arr), 3), epoch)
 
-        writer.add_scalar('Val-Epoch-Accuracy', round(np.mean(val_accuracy), 3), epoch)
+        if val_accuracy:
+            writer.add_scalar('Val-Epoch-Accuracy', round(np.mean(val_accuracy), 3), epoch)
         writer.add_scalar('Val-Epoch-IOU', round(np.mean(val_iou), 3), epoch)
         writer.add_scalar('Val-Epoch-BBOX', round(np.mean(val_bbox_loss), 3), epoch)
         writer.add_scalar('Val-Epoch-Seg-loss', round(np.mean(val_segmentation_loss), 3), epoch)
         writer.add_scalar('Val-Epoch-label-loss', round(np.mean(val_label_loss), 3), epoch)
         writer.add_scalar('val-Epoch-JAC', round(np.mean(val_jaca), 3), epoch)
         writer.add_scalar('va,-Epoch-f1', round(np.mean(val_f1_arr), 3), epoch)
+        writer.add_scalar('Train-Epoch-data-wait', train_batches.wait_time, epoch)
+        writer.add_scalar('Val-Epoch-data-wait', validation_batches.wait_time, epoch)
 
        # if round(np.mean(val_iou),3) > best_val_iou: #and round(np.mean(val_accuracy),3) > best_val_accuracy:
 
         best_val_iou=round(np.mean(val_iou),3)
         torch.save(model.state_dict(), model_type+'.pt')
+        if checkpoint_path:
+            model_utils.save_checkpoint(checkpoint_path, model, optimizer, epoch + 1, 0)
       